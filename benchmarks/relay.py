@@ -0,0 +1,348 @@
+"""
+Benchmark of the relay of the kernel sockets: forwarding each socket over its own channels (see
+`remote_kernel.forward`) against relaying all sockets over a single channel (``--multiplex``, see `remote_kernel.mux`),
+without and with compression (``--compress``), through an in-process SSH stand-in server on localhost.
+
+The kernel is stood in by echo servers on five sockets (TCP ports, or Unix sockets with ``--transport ipc``), except
+for the socket standing in for iopub, which sends a rich output (an HTML table) for each byte received. In modes
+``multiplex`` and ``compress``, the relay runs as a subprocess of the stand-in server. For each mode, the benchmark
+measures:
+
+- ``connect``: seconds to connect to all sockets and complete a round trip on each, as a client connecting to the kernel
+- ``latency``: round trip times of small messages (``--message-size``) on one connection, as shell requests
+- ``loaded_latency``: the same, while another connection transfers bulk data, as iopub with large outputs
+- ``throughput``: bytes per second of bulk data (``--bulk-size``) echoed on one connection
+- ``rich_output``: seconds to receive a rich output (``--output-size``), and in mode ``compress`` the compression
+  ratio and the seconds saved compared to mode ``multiplex``
+
+Usage::
+
+  python -m benchmarks.relay [--mode forward] [--rounds 200] [--wan latency=40ms] [--output results.json]
+
+Results are written as JSON to ``--output`` (or stdout), a summary is printed to stderr.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+import remote_kernel
+from remote_kernel import format_size, parse_size
+from remote_kernel.forward import PortForwarder
+from remote_kernel.helpers.relay import COMPRESS_THRESHOLD
+from remote_kernel.mux import get_relay_cmd, MuxForwarder
+from remote_kernel.wan import WANProfile, WANSocket
+
+from .server import StandInServer
+
+logger = logging.getLogger('benchmarks.relay')
+
+MODES = ('forward', 'multiplex', 'compress')
+SOCKETS = 5
+# Connections used for the latency measurements (as shell), the rich outputs (as iopub) and the bulk transfers
+LATENCY_SOCKET = 1
+OUTPUT_SOCKET = 2
+BULK_SOCKET = 3
+OUTPUT_ROUNDS = 5
+
+
+def generate_output(size):
+  """
+  Generate a rich output of ``size`` bytes: a DataFrame of random numbers rendered as HTML.
+  """
+  random_state = random.Random(0)
+  rows = []
+  length = 0
+  while length < size:
+    rows.append('<tr><th>%i</th>%s</tr>\n' % (len(rows), ''.join('<td>%.6f</td>' % random_state.gauss(0., 1.)
+                                                               for _ in range(8))))
+    length += len(rows[-1])
+  return ''.join(rows).encode('ascii')[:size]
+
+
+class EchoServers(object):
+  """
+  Stand-in kernel: servers on ``addresses`` echoing all data received on each connection, except for the server with
+  index ``output_index``, which sends ``output`` for each byte received.
+  """
+  def __init__(self, addresses, output=b'', output_index=OUTPUT_SOCKET):
+    self.output = output
+    self.listeners = []
+    for index, address in enumerate(addresses):
+      if isinstance(address, str):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      listener.bind(address)
+      listener.listen(16)
+      self.listeners.append(listener)
+      handler = self._publish if index == output_index else self._echo
+      threading.Thread(target=self._serve, args=(listener, handler), daemon=True).start()
+
+  @property
+  def addresses(self):
+    return [listener.getsockname() for listener in self.listeners]
+
+  def close(self):
+    for listener in self.listeners:
+      listener.close()
+
+  def _serve(self, listener, handler):
+    while True:
+      try:
+        conn, _ = listener.accept()
+      except OSError:
+        return
+      if conn.family == socket.AF_INET:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # As set by ZeroMQ
+      threading.Thread(target=handler, args=(conn,), daemon=True).start()
+
+  @staticmethod
+  def _echo(conn):
+    try:
+      for data in iter(lambda: conn.recv(1 << 20), b''):
+        conn.sendall(data)
+    except OSError:
+      pass
+    finally:
+      conn.close()
+
+  def _publish(self, conn):
+    try:
+      for data in iter(lambda: conn.recv(1 << 10), b''):
+        for _ in data:
+          conn.sendall(self.output)
+    except OSError:
+      pass
+    finally:
+      conn.close()
+
+
+def connect(address):
+  sock = socket.create_connection(address)
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  return sock
+
+
+def round_trip(sock, message):
+  sock.sendall(message)
+  received = 0
+  while received < len(message):
+    data = sock.recv(len(message) - received)
+    if not data:
+      raise EOFError('Connection closed')
+    received += len(data)
+
+
+def echo_bulk(sock, size):
+  """
+  Send ``size`` bytes over ``sock`` and receive the echo, returns the number of seconds.
+  """
+  started = time.time()
+  block = os.urandom(min(size, 1 << 20))
+  sender = threading.Thread(target=lambda: [sock.sendall(block[:min(len(block), size - offset)])
+                                            for offset in range(0, size, len(block))])
+  sender.start()
+  received = 0
+  while received < size:
+    data = sock.recv(1 << 20)
+    if not data:
+      raise EOFError('Connection closed')
+    received += len(data)
+  sender.join()
+  return time.time() - started
+
+
+def receive_output(sock, size):
+  """
+  Request an output of ``size`` bytes on ``sock`` and receive it, returns the number of seconds.
+  """
+  started = time.perf_counter()
+  sock.sendall(b'\0')
+  received = 0
+  while received < size:
+    data = sock.recv(1 << 20)
+    if not data:
+      raise EOFError('Connection closed')
+    received += len(data)
+  return time.perf_counter() - started
+
+
+def measure_latency(sock, message, rounds):
+  samples = []
+  for _ in range(rounds):
+    started = time.perf_counter()
+    round_trip(sock, message)
+    samples.append(time.perf_counter() - started)
+  samples.sort()
+  return dict(median=statistics.median(samples), p99=samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+              mean=statistics.mean(samples))
+
+
+def start_tunnel(ssh_client, mode, kernel_addresses, threshold=COMPRESS_THRESHOLD):
+  """
+  Start forwarding local ports to ``kernel_addresses`` in ``mode``.
+
+  :return: Tuple of the tunnel and the exec channel of the relay (None in mode 'forward')
+  """
+  local_addresses = [('127.0.0.1', 0)] * len(kernel_addresses)
+  if mode == 'forward':
+    return PortForwarder(ssh_client.get_transport(), local_addresses, kernel_addresses).start(), None
+  channel = ssh_client.get_transport().open_session()
+  # The relay runs on the same host, the stand-in kernel is a command that waits until the relay terminates it
+  compress = (LATENCY_SOCKET, OUTPUT_SOCKET) if mode == 'compress' else ()
+  channel.exec_command(get_relay_cmd(kernel_addresses, 'sleep 86400', sys.executable, compress, threshold))
+  return MuxForwarder(channel, local_addresses).start(), channel
+
+
+def run_mode(ssh_client, mode, kernel_addresses, args):
+  tunnel, channel = start_tunnel(ssh_client, mode, kernel_addresses, args.compress_threshold)
+  socks = []
+  try:
+    addresses = [('127.0.0.1', port) for port in tunnel.local_bind_ports]
+    message = os.urandom(args.message_size)
+    # Warm up, so the relay process has started (as it starts along with the kernel)
+    with connect(addresses[0]) as sock:
+      round_trip(sock, message)
+
+    started = time.time()
+    for address in addresses:
+      socks.append(connect(address))
+      round_trip(socks[-1], message)
+    connect_seconds = time.time() - started
+
+    latency = measure_latency(socks[LATENCY_SOCKET], message, args.rounds)
+    throughput = args.bulk_size / echo_bulk(socks[BULK_SOCKET], args.bulk_size)
+    rich_output = dict(seconds=statistics.median(receive_output(socks[OUTPUT_SOCKET], args.output_size)
+                                                 for _ in range(OUTPUT_ROUNDS)))
+
+    stop = threading.Event()
+
+    def load():
+      while not stop.is_set():
+        echo_bulk(socks[BULK_SOCKET], 4 << 20)
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    try:
+      loaded_latency = measure_latency(socks[LATENCY_SOCKET], message, args.rounds)
+    finally:
+      stop.set()
+      loader.join()
+  finally:
+    for sock in socks:
+      sock.close()
+    tunnel.close()
+    if channel is not None:
+      channel.close()
+
+  if mode == 'compress':
+    stats = tunnel._relay.stats
+    rich_output['ratio'] = stats['raw_bytes'] / max(stats['compressed_bytes'], 1)
+    rich_output['decompress_seconds'] = stats['seconds']
+  result = dict(mode=mode, connect=connect_seconds, latency=latency, loaded_latency=loaded_latency,
+                throughput=throughput, rich_output=rich_output)
+  print('%-9s connect %7.1f ms  latency %7.2f ms (p99 %7.2f ms)  loaded %7.2f ms (p99 %7.2f ms)  %10s/s  '
+        'output %7.1f ms' % (mode, connect_seconds * 1000, latency['median'] * 1000, latency['p99'] * 1000,
+                             loaded_latency['median'] * 1000, loaded_latency['p99'] * 1000, format_size(throughput),
+                             rich_output['seconds'] * 1000), file=sys.stderr)
+  return result
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark forwarding the kernel sockets against relaying them over a '
+                                               'single channel (with and without compression), using a local SSH '
+                                               'server.')
+  parser.add_argument('--mode', action='append', choices=MODES,
+                      help='Mode to run, can be specified multiple times (default all)')
+  parser.add_argument('--transport', choices=['tcp', 'ipc'], default='tcp',
+                      help='Transport of the sockets of the stand-in kernel (default "tcp")')
+  parser.add_argument('--rounds', type=int, default=200, help='Number of round trips per latency measurement')
+  parser.add_argument('--message-size', type=parse_size, default=1 << 10, metavar='SIZE',
+                      help='Size of the messages of the latency measurements (default 1K)')
+  parser.add_argument('--bulk-size', type=parse_size, default=64 << 20, metavar='SIZE',
+                      help='Size of the bulk transfer of the throughput measurement (default 64M)')
+  parser.add_argument('--output-size', type=parse_size, default=8 << 20, metavar='SIZE',
+                      help='Size of the rich outputs (default 8M)')
+  parser.add_argument('--compress-threshold', type=parse_size, default=COMPRESS_THRESHOLD, metavar='SIZE',
+                      help='Minimum size of the data that is compressed at once in mode "compress" (default 16K)')
+  parser.add_argument('--wan', type=WANProfile.parse, default=None, metavar='SETTINGS',
+                      help='Emulate the conditions of a wide area network, e.g. "latency=40ms,bandwidth=2M"')
+  parser.add_argument('--output', '-o', default=None, help='File to write the JSON results to (default stdout)')
+  parser.add_argument('--verbose', '-v', action='store_true', help='If specified, log the relays')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.WARNING)
+  logging.getLogger('remote_kernel').setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+  started = time.time()
+  work_dir = tempfile.mkdtemp(prefix='remote_kernel-benchmark-')
+  if args.transport == 'ipc':
+    kernel_addresses = [os.path.join(work_dir, 'kernel-%i' % (i + 1)) for i in range(SOCKETS)]
+  else:
+    kernel_addresses = [('127.0.0.1', 0)] * SOCKETS
+  kernel = EchoServers(kernel_addresses, generate_output(args.output_size))
+  results = []
+  try:
+    with StandInServer(work_dir) as server:
+      ssh_client = paramiko.SSHClient()
+      ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      sock = socket.create_connection(('127.0.0.1', server.port))
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      if args.wan is not None:
+        sock = WANSocket(sock, args.wan)
+      ssh_client.connect('127.0.0.1', server.port, 'benchmark', 'benchmark', sock=sock, look_for_keys=False,
+                         allow_agent=False)
+      try:
+        for mode in args.mode or MODES:
+          results.append(run_mode(ssh_client, mode, kernel.addresses, args))
+      finally:
+        ssh_client.close()
+  finally:
+    kernel.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  baseline = [result for result in results if result['mode'] == 'multiplex']
+  for result in results:
+    if result['mode'] == 'compress' and baseline:
+      output = result['rich_output']
+      output['seconds_saved'] = baseline[0]['rich_output']['seconds'] - output['seconds']
+      print('compress  ratio %.1f, saves %.1f ms per rich output of %s (decompressing %.1f ms in total)' % (
+        output['ratio'], output['seconds_saved'] * 1000, format_size(args.output_size),
+        output['decompress_seconds'] * 1000), file=sys.stderr)
+
+  output = dict(
+    started=started,
+    environment=dict(python=platform.python_version(), platform=platform.platform(),
+                     paramiko=paramiko.__version__, remote_kernel=remote_kernel.__version__),
+    transport=args.transport,
+    wan=None if args.wan is None else str(args.wan),
+    rounds=args.rounds,
+    message_size=args.message_size,
+    bulk_size=args.bulk_size,
+    output_size=args.output_size,
+    compress_threshold=args.compress_threshold,
+    results=results,
+  )
+  if args.output is None:
+    json.dump(output, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.output, mode='w') as out_fs:
+      json.dump(output, out_fs, indent=2)
+  return 0
+
+
+if __name__ == '__main__':
+  exit(main())
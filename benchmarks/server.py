@@ -0,0 +1,335 @@
+"""
+In-process SSH/SFTP stand-in server used to benchmark remote_kernel without a real remote host.
+
+The server accepts any username/password, serves SFTP from the local filesystem (paths are resolved relative to
+``root``), runs exec requests through the local shell (with ``root`` as working directory) and supports
+``direct-tcpip`` forwarding to localhost and ``direct-streamlocal@openssh.com`` forwarding to local Unix sockets.
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko.sftp import SFTP_OK
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_handle import SFTPHandle
+from paramiko.sftp_server import SFTPServer
+from paramiko.sftp_si import SFTPServerInterface
+
+from remote_kernel.forward import StreamlocalTransport
+
+logger = logging.getLogger('benchmarks.server')
+
+
+def _set_file_attr(path, attr):
+  # SFTPServer.set_file_attr truncates the file to 0 bytes before setting the size, so handle the size separately
+  if attr._flags & attr.FLAG_SIZE:
+    os.truncate(path, attr.st_size)
+    attr._flags &= ~attr.FLAG_SIZE
+  SFTPServer.set_file_attr(path, attr)
+
+
+class _Handle(SFTPHandle):
+  def stat(self):
+    try:
+      return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+  def chattr(self, attr):
+    try:
+      _set_file_attr(self.filename, attr)
+      return SFTP_OK
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+
+class LocalSFTPInterface(SFTPServerInterface):
+  root = None
+
+  def _path(self, path):
+    if os.path.isabs(path):
+      return path
+    return os.path.normpath(os.path.join(self.root, path))
+
+  def canonicalize(self, path):
+    return self._path(path)
+
+  def open(self, path, flags, attr):
+    path = self._path(path)
+    try:
+      binary_flag = getattr(os, 'O_BINARY', 0)
+      flags |= binary_flag
+      mode = getattr(attr, 'st_mode', None)
+      fd = os.open(path, flags, mode if mode is not None else 0o666)
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    if (flags & os.O_CREAT) and (attr is not None):
+      attr._flags &= ~attr.FLAG_PERMISSIONS
+      SFTPServer.set_file_attr(path, attr)
+    if flags & os.O_WRONLY:
+      fstr = 'ab' if flags & os.O_APPEND else 'wb'
+    elif flags & os.O_RDWR:
+      fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+    else:
+      fstr = 'rb'
+    try:
+      f = os.fdopen(fd, fstr)
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    handle = _Handle(flags)
+    handle.filename = path
+    handle.readfile = f
+    handle.writefile = f
+    return handle
+
+  def list_folder(self, path):
+    path = self._path(path)
+    try:
+      out = []
+      for fname in os.listdir(path):
+        attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, fname)))
+        attr.filename = fname
+        out.append(attr)
+      return out
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+  def stat(self, path):
+    try:
+      return SFTPAttributes.from_stat(os.stat(self._path(path)))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+  def lstat(self, path):
+    try:
+      return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+
+  def remove(self, path):
+    try:
+      os.remove(self._path(path))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+  def rename(self, oldpath, newpath):
+    try:
+      os.rename(self._path(oldpath), self._path(newpath))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+  def posix_rename(self, oldpath, newpath):
+    try:
+      os.replace(self._path(oldpath), self._path(newpath))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+  def mkdir(self, path, attr):
+    try:
+      os.mkdir(self._path(path))
+      if attr is not None:
+        SFTPServer.set_file_attr(self._path(path), attr)
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+  def rmdir(self, path):
+    try:
+      os.rmdir(self._path(path))
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+  def chattr(self, path, attr):
+    try:
+      _set_file_attr(self._path(path), attr)
+    except OSError as e:
+      return SFTPServer.convert_errno(e.errno)
+    return SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+  def __init__(self, server):
+    self.server = server
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_auth_publickey(self, username, key):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_auth_none(self, username):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def get_allowed_auths(self, username):
+    return 'password,publickey,none'
+
+  def check_channel_request(self, kind, chanid):
+    if kind == 'session':
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+    self.server.pending_forwards[chanid] = destination
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_direct_streamlocal_request(self, chanid, path):
+    self.server.pending_forwards[chanid] = path
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+    return True
+
+  def check_channel_exec_request(self, channel, command):
+    t = threading.Thread(target=self.server.run_command, args=(channel, command))
+    t.daemon = True
+    t.start()
+    return True
+
+
+class StandInServer(object):
+  """
+  SSH server listening on localhost, serving the filesystem below ``root``.
+
+  :param root: Directory that acts as the remote home directory (SFTP relative paths and exec working directory).
+  :param port: Port to listen on, 0 (default) selects a free port.
+  """
+  def __init__(self, root, port=0):
+    self.root = os.path.abspath(root)
+    self.host_key = paramiko.RSAKey.generate(2048)
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('127.0.0.1', port))
+    self.port = self.sock.getsockname()[1]
+    self.pending_forwards = {}
+    self.transports = []
+    self.channels = set()
+    self._thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def start(self):
+    self.sock.listen(16)
+    self._thread = threading.Thread(target=self._serve)
+    self._thread.daemon = True
+    self._thread.start()
+    logger.debug('Stand-in SSH server listening on port %i, serving %s', self.port, self.root)
+    return self
+
+  def close(self):
+    try:
+      self.sock.close()
+    except OSError:
+      pass
+    for t in self.transports:
+      t.close()
+
+  def _serve(self):
+    while True:
+      try:
+        client, _ = self.sock.accept()
+      except OSError:
+        return
+      # As OpenSSH for interactive sessions, so small messages are not delayed waiting for acknowledgements
+      client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      t = StreamlocalTransport(client)
+      t.add_server_key(self.host_key)
+      sftp_interface = type('BoundSFTPInterface', (LocalSFTPInterface,), {'root': self.root})
+      t.set_subsystem_handler('sftp', SFTPServer, sftp_interface)
+      self.transports.append(t)
+      t.start_server(server=_ServerInterface(self))
+      threading.Thread(target=self._accept_channels, args=(t,), daemon=True).start()
+
+  def _accept_channels(self, transport):
+    while transport.is_active():
+      chan = transport.accept(1)
+      if chan is None:
+        continue
+      dest = self.pending_forwards.pop(chan.get_id(), None)
+      # Channels are only weakly referenced by the transport, and closed when garbage collected
+      self.channels.add(chan)
+      if dest is not None:
+        threading.Thread(target=self._forward, args=(chan, dest), daemon=True).start()
+
+  @staticmethod
+  def _forward(chan, dest):
+    try:
+      if isinstance(dest, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(dest)
+      else:
+        sock = socket.create_connection(dest)
+    except OSError:
+      chan.close()
+      return
+
+    def pump(src, dst, shutdown):
+      try:
+        while True:
+          data = src.recv(65536)
+          if not data:
+            break
+          dst.sendall(data)
+        shutdown()  # Pass on EOF, the other direction may still be sending
+      except (OSError, EOFError):  # EOFError if the SSH connection was closed
+        for s in (src, dst):
+          s.close()  # Also stops the other direction
+
+    thread = threading.Thread(target=pump, args=(sock, chan, chan.shutdown_write), daemon=True)
+    thread.start()
+    pump(chan, sock, lambda: sock.shutdown(socket.SHUT_WR))
+    thread.join()
+    sock.close()
+    chan.close()
+
+  def run_command(self, channel, command):
+    if isinstance(command, bytes):
+      command = command.decode('utf-8')
+    proc = subprocess.Popen(command, shell=True, cwd=self.root,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed_stdin():
+      try:
+        while True:
+          data = channel.recv(65536)
+          if not data:
+            break
+          proc.stdin.write(data)
+          proc.stdin.flush()
+      except (OSError, ValueError):
+        pass
+      finally:
+        try:
+          proc.stdin.close()
+        except OSError:
+          pass
+
+    def drain(pipe, send):
+      try:
+        for data in iter(lambda: pipe.read1(65536), b''):
+          send(data)
+      except OSError:
+        pass  # The channel was closed by the client
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    err_thread = threading.Thread(target=drain, args=(proc.stderr, channel.sendall_stderr), daemon=True)
+    err_thread.start()
+    drain(proc.stdout, channel.sendall)
+    err_thread.join()
+    # The reply to the exec request is sent after check_channel_exec_request returns, make sure it precedes the close
+    time.sleep(0.05)
+    channel.send_exit_status(proc.wait())
+    channel.close()
+    self.channels.discard(channel)
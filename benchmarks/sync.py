@@ -0,0 +1,217 @@
+"""
+Benchmark of ParamikoSync against an in-process SFTP stand-in server on localhost, so the performance of the
+synchronization can be tracked without a real remote host.
+
+For each scenario (see `benchmarks.trees`) and direction, a synthetic tree is generated on the source side and three
+synchronizations are timed, each by a new ParamikoSync instance (as when a kernel is restarted):
+
+- ``cold``: the destination is empty, all files are transferred
+- ``warm``: nothing changed since the cold synchronization, no files are transferred
+- ``incremental``: 5% of the files were modified and as many files were added on the source side
+
+In direction ``pull``, files are retrieved from the remote. In direction ``push``, the synchronization is
+bi-directional and the files are pushed to the remote. After each synchronization, the destination is compared to the
+source. Files that are fetched lazily (``--lazy-threshold``) and were not fetched are only compared by the size
+recorded for them.
+
+Usage::
+
+  python -m benchmarks.sync [--scenario small] [--direction pull] [--scale 0.1] [--output results.json] \\
+    [-- synchronization arguments, e.g. --sync-channels 8 --batch-threshold 64K]
+
+With ``--wan``, the connection to the server emulates the conditions of a wide area network (see
+`remote_kernel.wan`), e.g. ``--wan latency=80ms,bandwidth=2M``.
+
+Results are written as JSON to ``--output`` (or stdout), a summary is printed to stderr.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import paramiko
+
+import remote_kernel
+from remote_kernel import format_size, get_parser
+from remote_kernel.sync import ParamikoSync, SYNC_ARGS
+from remote_kernel.wan import WANProfile, WANSocket
+
+from .server import StandInServer
+from .trees import generate_tree, modify_tree, SCENARIOS
+
+logger = logging.getLogger('benchmarks.sync')
+
+DIRECTIONS = ('pull', 'push')
+PHASES = ('cold', 'warm', 'incremental')
+
+
+def get_sync_kwargs(argv):
+  """
+  Parse the synchronization arguments ``argv`` using the parser of remote_kernel, returning the keyword arguments of
+  ParamikoSync. The sync folders are set by the benchmark.
+  """
+  args = get_parser(connection_file_arg=False).parse_args(['--target', 'benchmark'] + list(argv))
+  return {k: v for k, v in args.__dict__.items() if k in SYNC_ARGS and k not in ('local_folder', 'remote_folder',
+                                                                                  'bi_directional')}
+
+
+def list_files(root):
+  """
+  Returns a dictionary mapping the relative paths of the synchronized files in ``root`` to their sizes.
+  """
+  files = {}
+  for dirpath, dirnames, filenames in os.walk(root):
+    for fname in filenames:
+      if fname.startswith('.remote_kernel'):
+        continue
+      path = os.path.relpath(os.path.join(dirpath, fname), root).replace(os.sep, '/')
+      files[path] = os.path.getsize(os.path.join(dirpath, fname))
+  return files
+
+
+def run_sync(ssh_client, local_folder, remote_folder, direction, sync_kwargs):
+  """
+  Run a single synchronization using a new ParamikoSync instance.
+
+  :return: Tuple of the wall time in seconds, the SyncMetrics, the (absolute) remote sync folder and the files that are
+    fetched lazily (see `ParamikoSync.list_lazy`)
+  """
+  synchronizer = ParamikoSync(ssh_client, local_folder=local_folder, remote_folder=remote_folder,
+                              bi_directional=direction == 'push', **sync_kwargs)
+  synchronizer.set_subfolder('benchmark')
+  try:
+    with synchronizer.connect():
+      started = time.time()
+      synchronizer.sync()
+      seconds = time.time() - started
+      lazy_files = synchronizer.list_lazy()
+    return seconds, synchronizer.last_metrics['sync'], synchronizer.remote_folder, lazy_files
+  finally:
+    synchronizer.close()
+
+
+def verify(source_files, dest_files, lazy_files):
+  """
+  Returns True if the destination matches the source (files as returned by `list_files`). Files that are fetched
+  lazily and were not fetched are placeholders: their local copy may be missing or outdated, but the size recorded for
+  them must match the source.
+  """
+  placeholders = {path: size for path, size, fetched in lazy_files if not fetched}
+  if any(source_files.get(path, None) != size for path, size in placeholders.items()):
+    return False
+  return ({path: size for path, size in dest_files.items() if path not in placeholders} ==
+          {path: size for path, size in source_files.items() if path not in placeholders})
+
+
+def run_scenario(ssh_client, work_dir, scenario, direction, scale, sync_kwargs):
+  """
+  Time the cold, warm and incremental synchronizations of ``scenario`` in ``direction``.
+
+  :param work_dir: Folder served by the stand-in server, in which the local and remote sync folders are created
+  :return: List of result dictionaries, one per phase
+  """
+  name = '%s-%s' % (scenario, direction)
+  local_folder = os.path.join(work_dir, name, 'local')
+  os.makedirs(local_folder)
+  # Create the remote sync folder of the benchmark, so the source tree can be generated in it
+  remote_folder = run_sync(ssh_client, local_folder, name + '/remote', 'pull', sync_kwargs)[2]
+  source, dest = (remote_folder, local_folder) if direction == 'pull' else (local_folder, remote_folder)
+  paths = generate_tree(source, scenario, scale)
+
+  results = []
+  for phase in PHASES:
+    if phase == 'incremental':
+      modify_tree(source, paths)
+    seconds, metrics, _, lazy_files = run_sync(ssh_client, local_folder, name + '/remote', direction, sync_kwargs)
+    expected = list_files(source)
+    result = dict(scenario=scenario, direction=direction, phase=phase, seconds=seconds,
+                  files=metrics.files, bytes=metrics.bytes, tree_files=len(expected),
+                  tree_bytes=sum(expected.values()), lazy_files=sum(1 for lazy_file in lazy_files if not lazy_file[2]),
+                  verified=verify(expected, list_files(dest), lazy_files), metrics=metrics.to_dict())
+    if not result['verified']:
+      logger.error('%s %s %s: the destination does not match the source', scenario, direction, phase)
+    print('%-8s %-5s %-12s %8.2f s %7i files %10s %10s/s' % (
+      scenario, direction, phase, seconds, metrics.files, format_size(metrics.bytes),
+      format_size(metrics.bytes / seconds if seconds > 0 else 0)), file=sys.stderr)
+    results.append(result)
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the file synchronization against a local SFTP server. '
+                                               'Arguments after "--" are passed on to the synchronization.')
+  parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                      help='Scenario to run, can be specified multiple times (default all)')
+  parser.add_argument('--direction', action='append', choices=DIRECTIONS,
+                      help='Direction to run, can be specified multiple times (default both)')
+  parser.add_argument('--scale', type=float, default=1., help='Scale of the synthetic trees (default 1)')
+  parser.add_argument('--wan', type=WANProfile.parse, default=None, metavar='SETTINGS',
+                      help='Emulate the conditions of a wide area network, e.g. "latency=80ms,bandwidth=2M"')
+  parser.add_argument('--output', '-o', default=None, help='File to write the JSON results to (default stdout)')
+  parser.add_argument('--work-dir', default=None, help='Folder to generate the trees in (default a temporary folder)')
+  parser.add_argument('--keep', action='store_true', help='If specified, the generated trees are not removed')
+  parser.add_argument('--verbose', '-v', action='store_true', help='If specified, log the synchronization')
+
+  if argv is None:
+    argv = sys.argv[1:]
+  sync_argv = []
+  if '--' in argv:
+    sync_argv = argv[argv.index('--') + 1:]
+    argv = argv[:argv.index('--')]
+  args = parser.parse_args(argv)
+  sync_kwargs = get_sync_kwargs(sync_argv)
+
+  logging.basicConfig(level=logging.WARNING)
+  # remote_kernel logs to its own handler, at level INFO by default
+  logging.getLogger('remote_kernel').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+  started = time.time()
+  work_dir = tempfile.mkdtemp(prefix='remote_kernel-benchmark-', dir=args.work_dir)
+  results = []
+  try:
+    with StandInServer(work_dir) as server:
+      ssh_client = paramiko.SSHClient()
+      ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      sock = socket.create_connection(('127.0.0.1', server.port))
+      if args.wan is not None:
+        sock = WANSocket(sock, args.wan)
+      ssh_client.connect('127.0.0.1', server.port, 'benchmark', 'benchmark', sock=sock, look_for_keys=False,
+                         allow_agent=False)
+      try:
+        for scenario in args.scenario or SCENARIOS:
+          for direction in args.direction or DIRECTIONS:
+            results += run_scenario(ssh_client, work_dir, scenario, direction, args.scale, sync_kwargs)
+      finally:
+        ssh_client.close()
+  finally:
+    if args.keep:
+      print('Generated trees are kept in %s' % work_dir, file=sys.stderr)
+    else:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  output = dict(
+    started=started,
+    environment=dict(python=platform.python_version(), platform=platform.platform(),
+                     paramiko=paramiko.__version__, remote_kernel=remote_kernel.__version__),
+    scale=args.scale,
+    wan=None if args.wan is None else str(args.wan),
+    sync_args=sync_argv,
+    results=results,
+  )
+  if args.output is None:
+    json.dump(output, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.output, mode='w') as out_fs:
+      json.dump(output, out_fs, indent=2)
+  return 0 if all(result['verified'] for result in results) else 1
+
+
+if __name__ == '__main__':
+  exit(main())
@@ -0,0 +1,97 @@
+"""
+Synthetic file trees for the benchmarks. Trees are generated from a seed, so every run of a benchmark synchronizes
+the same files. File contents are random bytes, so they do not compress.
+
+Each scenario is scaled by ``scale``, which multiplies the number of files (and, for the huge files, their size):
+
+- ``small``: many small files (1 - 16 KiB) in a few folders
+- ``huge``: a few huge files (32 MiB)
+- ``deep``: deeply nested folders, with a few small files at every level
+- ``mixed``: small, medium (64 KiB - 4 MiB) and huge files in a moderately nested tree
+"""
+import os
+import random
+import time
+
+SCENARIOS = ('small', 'huge', 'deep', 'mixed')
+
+# Files are generated with a modified time in the past, so changes made by the incremental benchmark are newer
+BASE_MTIME = 24 * 3600
+
+
+def _write(fname, size, mtime, rng):
+  os.makedirs(os.path.dirname(fname), exist_ok=True)
+  with open(fname, 'wb') as out_fs:
+    remaining = size
+    while remaining > 0:
+      chunk = min(remaining, 1 << 20)
+      out_fs.write(rng.getrandbits(chunk * 8).to_bytes(chunk, 'little'))
+      remaining -= chunk
+  os.utime(fname, (mtime, mtime))
+
+
+def _get_files(scenario, scale, rng):
+  """
+  Returns a list of (relative path, size) of the files in ``scenario``.
+  """
+  def count(n):
+    return max(1, int(round(n * scale)))
+
+  files = []
+  if scenario == 'small':
+    for i in range(count(2000)):
+      files.append(('d%02i/f%05i.dat' % (i % 20, i), rng.randint(1 << 10, 16 << 10)))
+  elif scenario == 'huge':
+    for i in range(count(4)):
+      files.append(('huge%i.bin' % i, max(1 << 20, int((32 << 20) * min(scale, 1.)))))
+  elif scenario == 'deep':
+    for chain in range(count(20)):
+      fldr = 'chain%02i' % chain
+      for level in range(16):
+        fldr += '/level%02i' % level
+        for i in range(2):
+          files.append(('%s/f%i.dat' % (fldr, i), rng.randint(256, 4 << 10)))
+  elif scenario == 'mixed':
+    for i in range(count(1000)):
+      path = ['p%i' % rng.randint(0, 3) for _ in range(rng.randint(0, 4))] + ['small%05i.dat' % i]
+      files.append(('/'.join(path), rng.randint(1 << 10, 16 << 10)))
+    for i in range(count(40)):
+      files.append(('medium/m%03i.dat' % i, rng.randint(64 << 10, 4 << 20)))
+    files.append(('huge.bin', max(1 << 20, int((32 << 20) * min(scale, 1.)))))
+  else:
+    raise ValueError('Unknown scenario %s, choose from %s' % (scenario, ', '.join(SCENARIOS)))
+  return files
+
+
+def generate_tree(root, scenario, scale=1., seed=0):
+  """
+  Generate the files of ``scenario`` in folder ``root``.
+
+  :return: List of the relative paths of the generated files
+  """
+  rng = random.Random('%s-%i' % (scenario, seed))
+  files = _get_files(scenario, scale, rng)
+  for path, size in files:
+    _write(os.path.join(root, path), size, BASE_MTIME, rng)
+  return [path for path, size in files]
+
+
+def modify_tree(root, paths, fraction=0.05, seed=0):
+  """
+  Simulate work on the tree in ``root``: rewrite ``fraction`` of the files in ``paths`` with new contents of the same
+  size, and add the same number of new small files. The changed files are newer than all generated files.
+
+  :return: List of the relative paths of the modified and added files
+  """
+  rng = random.Random('modify-%i' % seed)
+  changed = rng.sample(paths, max(1, int(len(paths) * fraction)))
+  mtime = time.time()
+  for path in changed:
+    fname = os.path.join(root, path)
+    _write(fname, os.path.getsize(fname), mtime, rng)
+  added = []
+  for i in range(len(changed)):
+    path = 'added/new%05i.dat' % i
+    _write(os.path.join(root, path), rng.randint(1 << 10, 16 << 10), mtime, rng)
+    added.append(path)
+  return changed + added
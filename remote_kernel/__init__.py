@@ -13,7 +13,7 @@ control_port          --control
 signature_scheme      --Session.signature_scheme    must have the form hmac-HASH
 key                   --Session.key                 b''
 kernel_name           --
-transport             --transport  ['tcp', 'icp']
+transport             --transport  ['tcp', 'ipc']
 """
 
 import argparse
@@ -38,7 +38,44 @@ def get_resource_dir():
   return os.path.abspath(resource_dir)
 
 
+def parse_size(size):
+  """
+  Parse a size in bytes, optionally followed by a (binary) unit suffix K, M, G or T, e.g. "64M".
+  Used as argument type in `get_parser`.
+  """
+  units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+  size = size.strip().upper().rstrip('B')
+  try:
+    if size[-1:] in units:
+      return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+  except ValueError:
+    raise argparse.ArgumentTypeError('Invalid size "%s"' % size)
+
+
+def parse_include(pattern):
+  """
+  Parse the pattern of --include into a negated gitignore-style pattern. A leading "!" is optional, so "!foo" does not
+  become "!!foo", which would match files named "!foo". Used as argument type in `get_parser`.
+  """
+  if pattern.startswith('!'):
+    pattern = pattern[1:]
+  if pattern.strip() == '':
+    raise argparse.ArgumentTypeError('Invalid pattern "%s"' % pattern)
+  return '!' + pattern
+
+
+def format_size(size):
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if abs(size) < 1024:
+      return '%.1f %s' % (size, unit) if unit != 'B' else '%i B' % size
+    size /= 1024.
+  return '%.1f TiB' % size
+
+
 def get_parser(connection_file_arg=True):
+  from .wan import WANProfile
+
   parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
 
   ssh_group = parser.add_argument_group(title='SSH Connection', description="Arguments specifying the SSH connection "
@@ -48,6 +85,16 @@ def get_parser(connection_file_arg=True):
   ssh_group.add_argument('-J', dest='jump_server', metavar='[username@]host[:port]', default=None, action='append',
                          help='Optional jump servers to connect through to the host')
   ssh_group.add_argument('-i', dest='ssh_key', default=None, help='ssh key to use for authentication')
+  ssh_group.add_argument('--control-persist', type=float, default=None, metavar='SECONDS',
+                         help='If specified, connect through a local broker process that keeps the SSH connection '
+                              '(including all jump hosts) open for this many seconds after the last kernel, '
+                              'installation or synchronization using it finished, like ControlPersist of OpenSSH. '
+                              'Connections to the same host reuse the connection instead of a new handshake. Not '
+                              'available on Windows.')
+  ssh_group.add_argument('--wan-emulation', type=WANProfile.parse, default=None, metavar='SETTINGS',
+                         help='For testing: emulate the conditions of a wide area network on the SSH connection, e.g. '
+                              '"latency=80ms,jitter=5ms,bandwidth=2M,loss=0.01". See remote_kernel.wan for all '
+                              'settings.')
 
   ipykernel_group = parser.add_argument_group(title='IPyKernel Arguments', description="Arguments to start the "
                                                                                        "ipykernel on the remote server")
@@ -62,6 +109,24 @@ def get_parser(connection_file_arg=True):
   if connection_file_arg:
     ipykernel_group.add_argument('--file', '-f', help='Connection file to configure the kernel')
 
+  ipykernel_group.add_argument('--transport', choices=['tcp', 'ipc'], default='tcp',
+                               help='Transport of the kernel sockets on the remote host (default "tcp"). With "ipc", '
+                                    'the kernel binds Unix sockets in the remote home folder instead of TCP ports, '
+                                    'which are forwarded over direct-streamlocal@openssh.com channels. Requires '
+                                    'OpenSSH 6.7 or later on the remote host. Sockets of the local connection file '
+                                    'can use either transport.')
+  ipykernel_group.add_argument('--multiplex', action='store_true',
+                               help='If specified, the connections to all kernel sockets are relayed over a single SSH '
+                                    'channel, by a relay that is started along with the kernel, instead of a '
+                                    'forwarded channel per connection. Requires python on the remote host (see '
+                                    '--remote-python).')
+  ipykernel_group.add_argument('--compress', action='store_true',
+                               help='If specified, the replies on the shell socket and the outputs on the iopub socket '
+                                    '(e.g. plots and HTML tables) are compressed by the relay, using Zstandard or LZ4 '
+                                    'if available on both hosts, or zlib. Implies --multiplex.')
+  ipykernel_group.add_argument('--compress-threshold', type=parse_size, default=16 << 10, metavar='SIZE',
+                               help='Minimum size of the data that is compressed at once, smaller messages are '
+                                    'relayed as is (default 16K)')
   ipykernel_group.add_argument('--no-remote-files', action='store_true',
                                help='If specified, no remote files are created/removed on the remote host.\n'
                                     'Connection arguments are passed via commandline.\n'
@@ -78,6 +143,86 @@ def get_parser(connection_file_arg=True):
                           help='Remote root folder to sync (containing sub-folders for each unique local folder')
   sync_group.add_argument('--local-folder', '-lf', default='remote_kernel_sync',
                           help='Name of local sub-folder to synchronize')
+  sync_group.add_argument('--sync-channels', '-sc', dest='channels', type=int, default=4,
+                          help='Number of parallel SFTP channels used to transfer files (default 4)')
+  sync_group.add_argument('--sftp-window', type=int, default=64, metavar='REQUESTS',
+                          help='Maximum number of SFTP requests in flight per channel (default 64). Files are '
+                               'transferred in groups, sending the requests of all files without waiting for the '
+                               'replies to each file in turn. Specify 0 to transfer files one at a time.')
+  sync_group.add_argument('--sync-order', choices=['size', 'path'], default='size',
+                          help='Order in which files are transferred (default "size"): smallest first, so small files '
+                               'are not held up by large files, or by path')
+  sync_group.add_argument('--sync-priority', action='append', default=None, metavar='PATTERN',
+                          help='Transfer files matching this gitignore-style pattern (e.g. "*.ipynb") before all other '
+                               'files. Can be specified multiple times, in order of decreasing priority.')
+  sync_group.add_argument('--bwlimit', type=parse_size, default=None, metavar='SIZE',
+                          help='If specified, limit file transfers to this many bytes per second (e.g. 2M) in each '
+                               'direction, leaving bandwidth for the kernel')
+  sync_group.add_argument('--delta-threshold', '-dt', type=parse_size, default=None, metavar='SIZE',
+                          help='If specified, files of at least this size (e.g. 64M) that exist on both hosts are '
+                               'updated using rsync-style delta transfers, which only send the changed blocks.\n'
+                               'Requires python on the remote host.')
+  sync_group.add_argument('--resume-threshold', type=parse_size, default=64 << 20, metavar='SIZE',
+                          help='Files of at least this size (default 64M) are transferred in chunks, so a transfer '
+                               'that is interrupted (e.g. when the connection drops) is resumed by the next '
+                               'synchronization. Specify 0 to transfer all files in chunks.')
+  sync_group.add_argument('--no-resume', action='store_const', const=None, dest='resume_threshold',
+                          help='If specified, interrupted transfers are always restarted')
+  sync_group.add_argument('--batch-threshold', '-bt', type=parse_size, default=None, metavar='SIZE',
+                          help='If specified, files smaller than this size (e.g. 1M) are transferred in batches, as '
+                               'a single tar stream. Requires tar on the remote host.')
+  sync_group.add_argument('--batch-compression', choices=['none', 'gzip', 'zstd'], default='gzip',
+                          help='Compression of batched transfers (default "gzip"). Already compressed file types '
+                               'are not compressed. "zstd" requires the zstandard package locally and zstd on the '
+                               'remote host.')
+  sync_group.add_argument('--dedup-threshold', type=parse_size, default=None, metavar='SIZE',
+                          help='If specified, pushed files of at least this size (e.g. 1M) are deduplicated between '
+                               'the remote sync folders of different kernels: each file is uploaded once to a '
+                               'content-addressed store in the remote root sync folder, and hard linked into the sync '
+                               'folder of each kernel. Linked files are read-only on the remote host. Requires python '
+                               'on the remote host.')
+  sync_group.add_argument('--lazy-threshold', type=parse_size, default=None, metavar='SIZE',
+                          help='If specified, remote files of at least this size (e.g. 100M) are not pulled, but '
+                               'fetched on demand with "python -m remote_kernel fetch". Fetched files are kept up to '
+                               'date, until they are removed from the lazy cache.')
+  sync_group.add_argument('--lazy-cache-size', type=parse_size, default=10 << 30, metavar='SIZE',
+                          help='Maximum total size of the files fetched on demand (default 10G). When exceeded, the '
+                               'least recently fetched files that were not modified locally are removed.')
+  sync_group.add_argument('--content-hash', action='store_true',
+                          help='If specified, files of the same size that changed since the last synchronization are '
+                               'compared by their content hashes, so files that were only touched are not '
+                               'transferred and changes within the same second are detected. Uses xxhash or blake3 '
+                               'if installed (on both hosts), otherwise blake2b. Requires python on the remote host.')
+  sync_group.add_argument('--sync-interval', type=float, default=None, metavar='SECONDS',
+                          help='If specified, files are also synchronized while the kernel is running: remote changes '
+                               'are pulled every SECONDS seconds and, if synchronization is bi-directional, local '
+                               'changes are pushed as they occur. Local changes are detected using inotify if the '
+                               'inotify_simple package is installed.')
+  sync_group.add_argument('--remote-watch', action='store_true',
+                          help='If specified, remote changes are streamed from the remote host while the kernel is '
+                               'running and pulled as they occur, instead of only every --sync-interval seconds. '
+                               'Uses inotifywait if installed on the remote host, otherwise a python watcher.')
+  sync_group.add_argument('--sync-debounce', type=float, default=1., metavar='SECONDS',
+                          help='Period without further changes before the changes are transferred (default 1 second)')
+  sync_group.add_argument('--exclude', action='append', dest='sync_ignore', metavar='PATTERN',
+                          help='Exclude files and folders matching this gitignore-style pattern (e.g. ".git/" or '
+                               '"*.ckpt") from synchronization. Can be specified multiple times, and is applied after '
+                               'the patterns in the file .remote_kernel_syncignore in the local sync folder. Excluded '
+                               'folders are not listed at all, on either host.')
+  sync_group.add_argument('--include', action='append', dest='sync_ignore', type=parse_include,
+                          metavar='PATTERN',
+                          help='Synchronize files matching this pattern, even if excluded by a previous pattern. A '
+                               'leading "!" is optional.')
+  sync_group.add_argument('--sync-metrics', default=None, metavar='FILE',
+                          help='If specified, the metrics of each synchronization (files and bytes transferred, time '
+                               'spent listing and transferring, throughput and SFTP round trips) are appended to FILE '
+                               'as a JSON line')
+  sync_group.add_argument('--sync-metrics-textfile', default=None, metavar='FILE',
+                          help='If specified, the metrics of the last synchronization are written to FILE in the '
+                               'Prometheus text format, e.g. for the textfile collector of the node exporter')
+  sync_group.add_argument('--remote-python', default='python',
+                          help='Python interpreter on the remote host used to run sync helper scripts and the relay '
+                               'of --multiplex (default "python")')
   return parser
 
 
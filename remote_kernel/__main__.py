@@ -22,7 +22,7 @@ def main(argv=None):
       return parse_args(argv)
     else:
       parser = argparse.ArgumentParser(add_help=False)
-      parser.add_argument('cmd', choices=['install', 'from-spec', 'sync'])
+      parser.add_argument('cmd', choices=['install', 'from-spec', 'sync', 'fetch', 'broker'])
       args, remainder = parser.parse_known_args(argv)
 
       if args.cmd == 'install':
@@ -41,10 +41,32 @@ def main(argv=None):
         from remote_kernel.sync import parse_args
         if remainder[0] == 'from-spec':
           from remote_kernel import get_spec
-          kernel_args = get_spec(remainder[1:])
+          # Options of the sync command itself are passed on after the arguments in the kernel spec
+          sync_args = [arg for arg in remainder[1:] if arg == '--dry-run']
+          kernel_args = get_spec([arg for arg in remainder[1:] if arg not in sync_args]) + sync_args
         else:
           kernel_args = remainder
         return parse_args(kernel_args)
+      elif args.cmd == 'fetch':
+        from remote_kernel.sync import parse_args
+        script = 'Fetch files'
+        if len(remainder) > 0 and remainder[0] == 'from-spec':
+          from remote_kernel import get_spec
+          # fetch from-spec <kernel name> [path ...], lists the lazily fetched files if no paths are given
+          paths = remainder[2:]
+          kernel_args = get_spec(remainder[1:2])
+          kernel_args += ['--fetch=%s' % path for path in paths] if len(paths) > 0 else ['--list-lazy']
+        else:
+          # fetch <connection args> [--fetch PATH ...], lists the lazily fetched files if no paths are given
+          kernel_args = remainder
+          if not any(arg in ('--fetch', '--list-lazy') or arg.startswith('--fetch=') for arg in kernel_args):
+            kernel_args = kernel_args + ['--list-lazy']
+        return parse_args(kernel_args)
+      elif args.cmd == 'broker':
+        from remote_kernel.broker import parse_args
+        script = 'Connection broker'
+        logger.debug('Starting connection broker with args %s', remainder)
+        return parse_args(remainder)
       return 0
   except Exception:
     logger.error('%s error', script, exc_info=True)
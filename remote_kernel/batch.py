@@ -0,0 +1,205 @@
+"""
+Batched transfer of many small files as a single tar stream over one exec channel, avoiding the per-file round trips
+of opening, writing, closing and setting the times of each file over SFTP.
+"""
+import gzip
+import logging
+import os
+import posixpath
+import shlex
+import shutil
+import tarfile
+
+from .helpers.delta import TMP_SUFFIX
+
+logger = logging.getLogger('remote_kernel.batch')
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# Limits of a single batch, so batches can be transferred in parallel and a failure only affects part of the files
+MAX_BATCH_FILES = 1000
+MAX_BATCH_BYTES = 64 << 20
+
+# File types that are already compressed and are therefore batched without compression
+COMPRESSED_EXTENSIONS = {
+  '.7z', '.avi', '.bz2', '.docx', '.gif', '.gz', '.jpeg', '.jpg', '.lz4', '.mkv', '.mov', '.mp3', '.mp4', '.npz',
+  '.parquet', '.pptx', '.png', '.rar', '.tgz', '.webp', '.xlsx', '.xz', '.zip', '.zst'
+}
+
+# Arguments for the remote tar command to (de)compress the stream
+TAR_COMPRESSION = {
+  None: '',
+  'gzip': ' -z',
+  'zstd': ' --use-compress-program=zstd',
+}
+
+
+# Exit status of the remote shell if the tar command is not found
+COMMAND_NOT_FOUND = 127
+
+
+class RemoteTarError(IOError):
+  """
+  The remote tar command failed with ``exit_status``, e.g. COMMAND_NOT_FOUND if the remote host has no tar.
+  """
+  def __init__(self, exit_status, message):
+    super(RemoteTarError, self).__init__('Remote tar exited with status %i: %s' % (exit_status, message))
+    self.exit_status = exit_status
+
+
+def get_compressions():
+  """
+  Returns the stream compressions supported by this host. The remote host may not support zstd, which is then only
+  detected when a batch fails.
+  """
+  compressions = [None, 'gzip']
+  if zstandard is not None:
+    compressions.append('zstd')
+  return compressions
+
+
+def is_compressible(path):
+  return posixpath.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def split_batches(entries, compression=None):
+  """
+  Split ``entries`` (SyncEntry instances) into batches of at most MAX_BATCH_FILES files and MAX_BATCH_BYTES bytes.
+  Files that are already compressed are put into separate, uncompressed batches.
+
+  :return: Generator yielding tuples of (compression, list of entries)
+  """
+  groups = {}
+  for entry in entries:
+    group_compression = compression if is_compressible(entry.path) else None
+    groups.setdefault(group_compression, []).append(entry)
+
+  for group_compression, group in groups.items():
+    batch = []
+    batch_bytes = 0
+    for entry in group:
+      if len(batch) > 0 and (len(batch) >= MAX_BATCH_FILES or batch_bytes + entry.st_size > MAX_BATCH_BYTES):
+        yield group_compression, batch
+        batch = []
+        batch_bytes = 0
+      batch.append(entry)
+      batch_bytes += entry.st_size
+    if len(batch) > 0:
+      yield group_compression, batch
+
+
+def _open_reader(fs, compression):
+  if compression == 'gzip':
+    return gzip.GzipFile(fileobj=fs, mode='rb')
+  elif compression == 'zstd':
+    return zstandard.ZstdDecompressor().stream_reader(fs)
+  return fs
+
+
+def _open_writer(fs, compression):
+  if compression == 'gzip':
+    return gzip.GzipFile(fileobj=fs, mode='wb', compresslevel=1)
+  elif compression == 'zstd':
+    return zstandard.ZstdCompressor().stream_writer(fs, closefd=False)
+  return None
+
+
+def get_batch(ssh_client, remote_root, local_root, entries, compression=None, on_file=None):
+  """
+  Retrieve the files described by ``entries`` from ``remote_root`` into ``local_root`` as a single tar stream, created
+  on the remote host by ``tar``. The local files are set to the atime and mtime of their entry.
+
+  :param ssh_client: Connected paramiko.SSHClient
+  :param remote_root: Absolute remote folder to which the entry paths are relative
+  :param local_root: Local folder to which the entry paths are relative
+  :param entries: List of SyncEntry instances of the files to retrieve
+  :param compression: Compression of the stream, one of the values returned by `get_compressions`
+  :param on_file: Optional function, called with the SyncEntry of each retrieved file
+  :return: Set of paths of the retrieved files. If the remote command fails, some files may be missing.
+  :raises RemoteTarError: if the remote command fails without sending a valid stream
+  """
+  wanted = {entry.path: entry for entry in entries}
+  cmd = 'tar -C %s -h --null -T - -cf -%s' % (shlex.quote(remote_root), TAR_COMPRESSION[compression])
+  logger.debug('Retrieving %i files using cmd %s', len(entries), cmd)
+  stdin, stdout, stderr = ssh_client.exec_command(cmd)
+
+  retrieved = set()
+  try:
+    stdin.write(b''.join(path.encode('utf-8', errors='surrogateescape') + b'\0' for path in wanted))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    try:
+      with tarfile.open(fileobj=_open_reader(stdout, compression), mode='r|') as tar:
+        for member in tar:
+          entry = wanted.get(member.name, None)
+          if entry is None or not member.isfile():
+            continue  # Only extract files that were requested
+
+          local_file = os.path.join(local_root, entry.path)
+          tmp_file = local_file + TMP_SUFFIX
+          src_fs = tar.extractfile(member)
+          with open(tmp_file, 'wb') as dst_fs:
+            shutil.copyfileobj(src_fs, dst_fs, 1 << 20)
+          os.replace(tmp_file, local_file)
+          os.utime(local_file, (entry.st_atime, entry.st_mtime))
+
+          retrieved.add(entry.path)
+          if on_file is not None:
+            on_file(entry)
+    except Exception:
+      # An invalid stream is most likely caused by the remote command failing. Only wait for its exit status if it
+      # finished sending, as it may otherwise be blocked on the channel.
+      if stdout.channel.eof_received:
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+          raise RemoteTarError(exit_status, stderr.read().decode('utf-8', errors='replace').strip())
+      raise
+
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+      logger.warning('Remote tar exited with status %i: %s', exit_status,
+                     stderr.read().decode('utf-8', errors='replace').strip())
+  finally:
+    stdin.channel.close()
+  return retrieved
+
+
+def put_batch(ssh_client, local_root, remote_root, entries, compression=None, on_file=None):
+  """
+  Send the files described by ``entries`` from ``local_root`` to ``remote_root`` as a single tar stream, which is
+  unpacked on the remote host by ``tar``. Modified times are preserved.
+
+  Arguments are identical to those of `get_batch`.
+
+  :return: Set of paths of the sent files
+  :raises RemoteTarError: if the remote tar command fails. In that case, an unknown subset of the files has been
+    updated.
+  """
+  cmd = 'tar -C %s --no-same-owner -xf -%s' % (shlex.quote(remote_root), TAR_COMPRESSION[compression])
+  logger.debug('Sending %i files using cmd %s', len(entries), cmd)
+  stdin, stdout, stderr = ssh_client.exec_command(cmd)
+
+  try:
+    writer = _open_writer(stdin, compression)
+    with tarfile.open(fileobj=writer or stdin, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+      for entry in entries:
+        tar.add(os.path.join(local_root, entry.path), arcname=entry.path, recursive=False)
+    if writer is not None:
+      writer.close()
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+      raise RemoteTarError(exit_status, stderr.read().decode('utf-8', errors='replace').strip())
+  finally:
+    stdin.channel.close()
+
+  if on_file is not None:
+    for entry in entries:
+      on_file(entry)
+  return {entry.path for entry in entries}
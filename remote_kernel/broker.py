@@ -0,0 +1,391 @@
+"""
+Resident SSH connection broker, similar to the ControlMaster/ControlPersist feature of OpenSSH.
+
+Connecting to a remote host through several jump hosts takes a handshake (and authentication) per hop, which adds
+seconds to each kernel start, installation and manual synchronization. With ``--control-persist SECONDS``, the first
+connection starts a broker process in the background, which connects to the remote host and keeps the connection open
+while it is used, and for the given number of seconds after the last client disconnected.
+
+Clients connect to the broker over a Unix socket in the Jupyter runtime folder, one per remote host, key and chain of
+jump hosts. The broker acts as an SSH server on that socket, without authentication (the socket is only accessible by
+the user): sessions (commands, SFTP), forwarded ports and forwarded Unix sockets opened by the client are relayed over
+channels of the connection to the remote host, so clients use a regular paramiko Transport without any handshake over
+the network.
+
+Before the SSH protocol starts, the broker sends a JSON line describing the connection (username, host and port),
+as the username may have been entered in a dialog by the broker.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paramiko
+try:
+  import fcntl
+except ImportError:  # Not available on Windows
+  fcntl = None
+
+from .forward import open_streamlocal_channel, StreamlocalTransport
+
+logger = logging.getLogger('remote_kernel.broker')
+
+# Seconds to wait for a broker to connect to the remote host, including entering a password or passphrase
+CONNECT_TIMEOUT = 120.
+# Seconds between keepalive packets on the connection to the remote host
+KEEPALIVE = 30
+RELAY_SIZE = 32768
+
+
+def is_available():
+  return fcntl is not None and hasattr(socket, 'AF_UNIX')
+
+
+def get_socket_path(host, pkey=None, jump_host=None, wan=None):
+  """
+  Returns the path of the Unix socket of the broker connecting to ``host`` using key ``pkey`` through the jump hosts
+  ``jump_host`` (None or a list of strings), and WAN emulation ``wan``.
+  """
+  from jupyter_core.paths import jupyter_runtime_dir
+
+  spec = json.dumps([host, pkey, list(jump_host or ()), None if wan is None else str(wan)])
+  digest = hashlib.sha1(spec.encode('utf-8')).hexdigest()[:16]
+  return os.path.join(jupyter_runtime_dir(), 'remote_kernel-broker-%s.sock' % digest)
+
+
+def _try_connect(socket_path):
+  if not os.path.exists(socket_path):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except OSError:
+    sock.close()
+    return None
+  return sock
+
+
+def _read_header(sock):
+  header = b''
+  while not header.endswith(b'\n'):
+    data = sock.recv(1)
+    if len(data) == 0 or len(header) > 4096:
+      raise IOError('Invalid response from the connection broker')
+    header += data
+  return json.loads(header.decode('utf-8'))
+
+
+def connect(host, pkey=None, jump_host=None, persist=0., wan=None, timeout=CONNECT_TIMEOUT):
+  """
+  Connect to the broker of ``host`` (see `get_socket_path`), starting it if it is not running.
+
+  :param persist: Seconds the broker keeps the connection open after the last client disconnected, if started
+  :return: Tuple of the connected Unix socket and the header of the broker (a dictionary of username, host and port)
+  :raises IOError: if the broker fails to connect to the remote host
+  """
+  if not is_available():
+    raise IOError('The connection broker is not supported on this platform')
+
+  socket_path = get_socket_path(host, pkey, jump_host, wan)
+  sock = _try_connect(socket_path)
+  if sock is None:
+    args = [sys.executable, '-m', 'remote_kernel', 'broker', '-t', host, '--control-persist', str(persist)]
+    for jump in jump_host or ():
+      args += ['-J', jump]
+    if pkey is not None:
+      args += ['-i', pkey]
+    if wan is not None:
+      args += ['--wan-emulation', str(wan)]
+    logger.info('Starting connection broker for %s', host)
+    with open(socket_path + '.log', mode='ab') as log_fs:
+      process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log_fs, stderr=log_fs,
+                                 start_new_session=True)
+
+    deadline = time.time() + timeout
+    while sock is None:
+      # The broker exits successfully without connecting if another broker is starting
+      if process.poll() not in (None, 0):
+        raise IOError('Connection broker failed with exit status %i, see %s.log' % (process.returncode, socket_path))
+      if time.time() > deadline:
+        raise IOError('Connection broker did not start within %i seconds, see %s.log' % (timeout, socket_path))
+      time.sleep(0.1)
+      sock = _try_connect(socket_path)
+
+  try:
+    header = _read_header(sock)
+  except Exception:
+    sock.close()
+    raise
+  logger.debug('Connected to broker %s (pid %s)', socket_path, header.get('pid', None))
+  return sock, header
+
+
+def _relay(channel, upstream, session=False):
+  """
+  Relay data between ``channel`` (a channel of a client of the broker) and ``upstream`` (the corresponding channel of
+  the connection to the remote host) in both directions, until both are closed. For sessions, stderr and the exit
+  status of the remote command are relayed as well.
+  """
+  def to_upstream():
+    try:
+      while True:
+        data = channel.recv(RELAY_SIZE)
+        if len(data) == 0:
+          break
+        upstream.sendall(data)
+      if channel.closed:
+        upstream.close()
+      else:
+        upstream.shutdown_write()
+    except (socket.error, EOFError) as e:
+      logger.debug('Relay to the remote host failed (%s)', e)
+      upstream.close()
+
+  def stderr_to_channel():
+    try:
+      while True:
+        data = upstream.recv_stderr(RELAY_SIZE)
+        if len(data) == 0:
+          break
+        channel.sendall_stderr(data)
+    except (socket.error, EOFError) as e:
+      logger.debug('Relay of stderr failed (%s)', e)
+
+  def to_channel():
+    try:
+      while True:
+        data = upstream.recv(RELAY_SIZE)
+        if len(data) == 0:
+          break
+        channel.sendall(data)
+      if session:
+        stderr_thread.join()
+        exit_status = upstream.recv_exit_status()
+        if exit_status >= 0:  # -1 if the remote host closed the channel without an exit status
+          channel.send_exit_status(exit_status)
+    except (socket.error, EOFError) as e:
+      logger.debug('Relay from the remote host failed (%s)', e)
+    finally:
+      channel.close()
+      upstream.close()
+
+  threads = [threading.Thread(target=to_upstream), threading.Thread(target=to_channel)]
+  stderr_thread = threading.Thread(target=stderr_to_channel)
+  if session:
+    threads.append(stderr_thread)
+  for thread in threads:
+    thread.daemon = True
+    thread.name = 'remote_kernel-broker-relay'
+    thread.start()
+
+
+class _BrokerInterface(paramiko.ServerInterface):
+  """
+  Server interface of a single client connection, opening a channel to the remote host for each channel of the client.
+  """
+  def __init__(self, upstream_transport):
+    self.upstream_transport = upstream_transport
+    # Channel ID -> channel to the remote host, of sessions without a command yet
+    self.upstream = {}
+    # Channel ID -> channel to the remote host, of forwarded connections that were not accepted yet
+    self.forwarded = {}
+
+  def get_allowed_auths(self, username):
+    return 'none'
+
+  def check_auth_none(self, username):
+    # Only the user can access the socket of the broker
+    return paramiko.AUTH_SUCCESSFUL
+
+  def check_channel_request(self, kind, chanid):
+    if kind != 'session':
+      return paramiko.OPEN_FAILED_UNKNOWN_CHANNEL_TYPE
+    try:
+      self.upstream[chanid] = self.upstream_transport.open_session()
+    except (paramiko.SSHException, socket.error) as e:
+      logger.warning('Failed to open a session on the remote host (%s)', e)
+      return paramiko.OPEN_FAILED_CONNECT_FAILED
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+    try:
+      self.forwarded[chanid] = self.upstream_transport.open_channel('direct-tcpip', destination, origin)
+    except (paramiko.SSHException, socket.error) as e:
+      logger.warning('Failed to forward a connection to %s:%i (%s)', destination[0], destination[1], e)
+      return paramiko.OPEN_FAILED_CONNECT_FAILED
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_direct_streamlocal_request(self, chanid, path):
+    try:
+      self.forwarded[chanid] = open_streamlocal_channel(self.upstream_transport, path)
+    except (paramiko.SSHException, socket.error) as e:
+      logger.warning('Failed to forward a connection to %s (%s)', path, e)
+      return paramiko.OPEN_FAILED_CONNECT_FAILED
+    return paramiko.OPEN_SUCCEEDED
+
+  def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+    self.upstream[channel.get_id()].get_pty(term, width, height, pixelwidth, pixelheight)
+    return True
+
+  def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+    self.upstream[channel.get_id()].resize_pty(width, height, pixelwidth, pixelheight)
+    return True
+
+  def check_channel_env_request(self, channel, name, value):
+    self.upstream[channel.get_id()].set_environment_variable(name, value)
+    return True
+
+  def check_channel_exec_request(self, channel, command):
+    upstream = self.upstream.pop(channel.get_id())
+    upstream.exec_command(command)
+    _relay(channel, upstream, session=True)
+    return True
+
+  def check_channel_shell_request(self, channel):
+    upstream = self.upstream.pop(channel.get_id())
+    upstream.invoke_shell()
+    _relay(channel, upstream, session=True)
+    return True
+
+  def check_channel_subsystem_request(self, channel, name):
+    upstream = self.upstream.pop(channel.get_id())
+    upstream.invoke_subsystem(name)
+    _relay(channel, upstream, session=True)
+    return True
+
+
+class ConnectionBroker(object):
+  """
+  Broker of the connection to ``host``, see the module documentation. Arguments are identical to those of
+  `ParamikoClient.connect_override`.
+
+  :param persist: Seconds to keep the connection open after the last client disconnected
+  """
+  def __init__(self, host, pkey=None, jump_host=None, persist=0., wan=None):
+    self.host = host
+    self.pkey = pkey
+    self.jump_host = jump_host
+    self.persist = persist
+    self.wan = wan
+    self.socket_path = get_socket_path(host, pkey, jump_host, wan)
+
+    self.ssh_client = None
+    self._host_key = None
+    self._clients = 0
+    self._idle_since = time.time()
+    self._lock = threading.Lock()
+
+  def serve(self):
+    """
+    Connect to the remote host and serve clients until the connection is lost or the broker has been idle for longer
+    than ``persist`` seconds.
+
+    :return: False if another broker of the same connection is starting or running, True otherwise
+    """
+    from .ssh_client import ParamikoClient
+
+    with open(self.socket_path + '.lock', mode='w') as lock_fs:
+      try:
+        fcntl.flock(lock_fs.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        logger.info('Another connection broker for %s is running', self.host)
+        return False
+
+      with ParamikoClient().connect_override(self.host, self.pkey, self.jump_host, wan=self.wan) as ssh_client:
+        self.ssh_client = ssh_client
+        ssh_client.get_transport().set_keepalive(KEEPALIVE)
+        self._host_key = paramiko.ECDSAKey.generate()
+
+        if os.path.exists(self.socket_path):
+          os.remove(self.socket_path)  # Left by a broker that did not exit cleanly
+        server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+          server_sock.bind(self.socket_path)
+        finally:
+          os.umask(umask)
+        server_sock.listen(16)
+        server_sock.settimeout(1.)
+        logger.info('Connection broker for %s@%s:%i listening on %s', ssh_client.username, ssh_client.host,
+                    ssh_client.port, self.socket_path)
+
+        try:
+          while ssh_client.get_transport().is_active():
+            try:
+              conn, _ = server_sock.accept()
+            except socket.timeout:
+              with self._lock:
+                if self._clients == 0 and time.time() - self._idle_since > self.persist:
+                  logger.info('Connection broker idle for %g seconds, closing the connection', self.persist)
+                  break
+              continue
+            with self._lock:
+              self._clients += 1
+            handler = threading.Thread(target=self._handle, args=(conn,), name='remote_kernel-broker-client')
+            handler.daemon = True
+            handler.start()
+          else:
+            logger.warning('Connection to %s was lost', self.host)
+        finally:
+          os.remove(self.socket_path)
+          server_sock.close()
+    return True
+
+  def _handle(self, conn):
+    try:
+      ssh_client = self.ssh_client
+      header = dict(username=ssh_client.username, host=ssh_client.host, port=ssh_client.port, pid=os.getpid())
+      conn.sendall(json.dumps(header).encode('utf-8') + b'\n')
+
+      transport = StreamlocalTransport(conn)
+      transport.add_server_key(self._host_key)
+      interface = _BrokerInterface(ssh_client.get_transport())
+      transport.start_server(server=interface)
+      logger.debug('Client connected')
+      # Channels are only weakly referenced by the transport, keep them until they are closed
+      channels = set()
+      try:
+        while transport.is_active():
+          # Sessions are relayed once their command is known, forwarded connections as soon as they are accepted
+          channel = transport.accept(1.)
+          channels = {chan for chan in channels if not chan.closed}
+          if channel is None:
+            continue
+          channels.add(channel)
+          if channel.get_id() in interface.forwarded:
+            _relay(channel, interface.forwarded.pop(channel.get_id()))
+      finally:
+        for upstream in list(interface.upstream.values()) + list(interface.forwarded.values()):
+          upstream.close()
+      logger.debug('Client disconnected')
+    except Exception as e:
+      logger.warning('Client connection failed (%s)', e)
+    finally:
+      conn.close()
+      with self._lock:
+        self._clients -= 1
+        if self._clients == 0:
+          self._idle_since = time.time()
+
+
+def parse_args(argv=None):
+  """
+  Run a connection broker using the connection arguments ``argv``, as parsed by `get_parser`. Started by `connect`.
+
+  :return: exit code for the process
+  """
+  from . import get_parser
+
+  args, _ = get_parser(connection_file_arg=False).parse_known_args(argv)
+  try:
+    ConnectionBroker(args.target, args.ssh_key, args.jump_server, args.control_persist or 0.,
+                     args.wan_emulation).serve()
+  except Exception:
+    logger.error('Connection broker failed!', exc_info=True)
+    return 1
+  return 0
@@ -0,0 +1,74 @@
+"""
+Deduplication of uploads between the remote sync folders of different kernels, using a content-addressed store of
+blobs on the remote host (see `helpers.blobs`).
+
+The store is kept next to the sync subfolders of the kernels (in the remote root sync folder), so kernels that share
+input files upload each file only once: a pushed file whose content hash is already in the store is hard linked to the
+blob instead of being uploaded, and uploaded files are added to the store for the next kernel. Linked files are
+read-only on the remote host, as modifying them in place would modify the files of all kernels.
+"""
+import logging
+
+from .helpers import get_remote_cmd
+
+logger = logging.getLogger('remote_kernel.dedup')
+
+BLOB_FOLDER = '.remote_kernel_blobs'
+
+# Maximum number of requests handled by a single remote command
+MAX_REMOTE_REQUESTS = 1000
+
+
+class BlobStore(object):
+  """
+  Content-addressed store of blobs in remote folder ``folder``.
+
+  :param ssh_client: Connected paramiko.SSHClient
+  :param folder: Remote folder of the store
+  :param remote_python: Python interpreter on the remote host, used to run the blobs helper
+  """
+  def __init__(self, ssh_client, folder, remote_python='python'):
+    self.ssh_client = ssh_client
+    self.folder = folder
+    self.remote_python = remote_python
+
+  @staticmethod
+  def get_blob(algorithm, file_hash):
+    """
+    Returns the path of the blob with content hash ``file_hash``, relative to the store.
+    """
+    return '%s/%s/%s' % (algorithm, file_hash[:2], file_hash)
+
+  def run(self, requests):
+    """
+    Handle ``requests`` on the remote host, using one command for up to MAX_REMOTE_REQUESTS requests.
+
+    :param requests: List of tuples (operation, blob, remote path), see `helpers.blobs`
+    :return: Dictionary mapping the remote paths to tuples of (status, size, mtime)
+    :raises IOError: if the helper fails on the remote host
+    """
+    results = {}
+    for i in range(0, len(requests), MAX_REMOTE_REQUESTS):
+      batch = requests[i:i + MAX_REMOTE_REQUESTS]
+      logger.debug('Handling %i blob store requests', len(batch))
+      stdin, stdout, stderr = self.ssh_client.exec_command(
+        get_remote_cmd('blobs', ('run', self.folder), self.remote_python))
+      stdin.write(b''.join(b''.join(field.encode('utf-8', errors='surrogateescape') + b'\0' for field in request)
+                           for request in batch))
+      stdin.flush()
+      stdin.channel.shutdown_write()
+      output = stdout.read()
+
+      exit_status = stdout.channel.recv_exit_status()
+      errors = stderr.read().decode('utf-8', errors='replace').strip()
+      if exit_status != 0:
+        raise IOError('Blob store failed with exit status %i: %s' % (exit_status, errors))
+      elif errors != '':
+        logger.warning('Blob store requests failed: %s', errors)
+
+      for line in output.split(b'\0'):
+        if line == b'':
+          continue
+        status, size, mtime, path = line.split(b' ', 3)
+        results[path.decode('utf-8', errors='surrogateescape')] = (status.decode('ascii'), int(size), float(mtime))
+    return results
@@ -0,0 +1,477 @@
+"""
+Forwarding of local TCP ports to addresses on the remote host, over channels of an SSH connection.
+
+All listeners and connections of a PortForwarder are handled by a single thread, using a selector: paramiko channels
+provide a file descriptor that is readable when data (or EOF) was received. The channel of a new connection is
+requested without waiting for the reply of the remote host (see `request_channel`), so the data of the other
+connections keeps flowing while it is opened. Data is forwarded in both directions from a single reusable buffer (see
+`recv_into` for the channels). Each direction of a connection is flow controlled: while data is pending because the
+SSH window of the channel is exhausted, the socket is not read (so the sender is held back by TCP), and while the
+socket does not accept data, the channel is not read (so the remote host is held back by the SSH window).
+
+Both local and remote addresses are either (host, port) tuples or paths of Unix sockets. Connections to remote Unix
+sockets use direct-streamlocal@openssh.com channels (as ``ssh -L local:remote_socket`` of OpenSSH), which paramiko does
+not implement: see `request_channel`, and `StreamlocalTransport` for the server side.
+"""
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+
+import paramiko
+from paramiko.common import (cMSG_CHANNEL_OPEN, cMSG_CHANNEL_OPEN_FAILURE, cMSG_CHANNEL_OPEN_SUCCESS,
+                             cMSG_CHANNEL_WINDOW_ADJUST)
+
+logger = logging.getLogger('remote_kernel.forward')
+
+BUFFER_SIZE = 256 << 10
+# Seconds between checks of channels that are waiting for the SSH window or to be opened, which have no file descriptor
+WINDOW_POLL = 0.005
+# Seconds to wait for the remote host to open a channel
+OPEN_TIMEOUT = 10.
+DIRECT_STREAMLOCAL = 'direct-streamlocal@openssh.com'
+
+
+def format_address(address):
+  return address if isinstance(address, str) else '%s:%i' % tuple(address)
+
+
+def create_listener(address):
+  """
+  Create a non-blocking socket listening on ``address``, a (host, port) tuple or the path of a Unix socket. Unix sockets
+  are only accessible by the user, remove them with `close_listener`.
+  """
+  if isinstance(address, str):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(address):
+      os.remove(address)  # Left by a forwarder that did not exit cleanly
+    umask = os.umask(0o177)
+    try:
+      listener.bind(address)
+    finally:
+      os.umask(umask)
+  else:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+  listener.listen(16)
+  listener.setblocking(False)
+  return listener
+
+
+def close_listener(listener):
+  if listener.family == getattr(socket, 'AF_UNIX', None):
+    try:
+      os.remove(listener.getsockname())
+    except OSError:
+      pass
+  listener.close()
+
+
+def request_channel(transport, destination, origin=('127.0.0.1', 0)):
+  """
+  Request a channel to ``destination`` on the remote host, a (host, port) tuple (a direct-tcpip channel, from
+  ``origin``) or the path of a Unix socket (a direct-streamlocal@openssh.com channel), without waiting for the reply.
+
+  :return: Tuple of the channel and a threading.Event that is set when the remote host replied. Then call
+    `get_requested_channel` to check whether the channel was opened.
+  """
+  m = paramiko.Message()
+  m.add_byte(cMSG_CHANNEL_OPEN)
+  with transport.lock:
+    chanid = transport._next_channel()
+    m.add_string(DIRECT_STREAMLOCAL if isinstance(destination, str) else 'direct-tcpip')
+    m.add_int(chanid)
+    m.add_int(transport.default_window_size)
+    m.add_int(transport.default_max_packet_size)
+    if isinstance(destination, str):
+      m.add_string(destination)
+      m.add_string('')  # Reserved
+      m.add_int(0)  # Reserved
+    else:
+      m.add_string(destination[0])
+      m.add_int(destination[1])
+      m.add_string(origin[0])
+      m.add_int(origin[1])
+    channel = paramiko.Channel(chanid)
+    transport._channels.put(chanid, channel)
+    transport.channel_events[chanid] = event = threading.Event()
+    transport.channels_seen[chanid] = True
+    channel._set_transport(transport)
+    channel._set_window(transport.default_window_size, transport.default_max_packet_size)
+  transport._send_user_message(m)
+  return channel, event
+
+
+def get_requested_channel(transport, channel):
+  """
+  Returns ``channel`` as returned by `request_channel`, once the remote host replied.
+
+  :raises paramiko.SSHException: if the channel could not be opened
+  """
+  if not transport.is_active() or transport._channels.get(channel.get_id()) is None:
+    raise transport.get_exception() or paramiko.SSHException('Unable to open channel.')
+  return channel
+
+
+def open_streamlocal_channel(transport, path, timeout=OPEN_TIMEOUT):
+  """
+  Open a channel to the Unix socket ``path`` on the remote host, like `paramiko.Transport.open_channel` does for
+  direct-tcpip channels.
+
+  :raises paramiko.SSHException: if the channel could not be opened
+  """
+  channel, event = request_channel(transport, path)
+  deadline = time.time() + timeout
+  while not event.wait(0.1) and transport.is_active():
+    if time.time() > deadline:
+      raise paramiko.SSHException('Timeout opening channel.')
+  return get_requested_channel(transport, channel)
+
+
+def recv_into(channel, buffer):
+  """
+  Receive data from the non-blocking paramiko ``channel`` into ``buffer``, like ``socket.recv_into``. `Channel.recv`
+  returns a new bytes object for all data it receives, so this takes the data from the buffer of the channel directly,
+  and adjusts the SSH window like `Channel.recv` does.
+
+  :return: Number of bytes received, 0 at EOF
+  :raises socket.timeout: if no data was received
+  """
+  pipe = channel.in_buffer
+  with pipe._lock:
+    n = min(len(pipe._buffer), len(buffer))
+    if n == 0:
+      if pipe._closed:
+        return 0
+      raise socket.timeout()
+    with memoryview(pipe._buffer) as received:
+      buffer[:n] = received[:n]
+    del pipe._buffer[:n]
+    if len(pipe._buffer) == 0 and pipe._event is not None and not pipe._closed:
+      pipe._event.clear()
+
+  ack = channel._check_add_window(n)
+  if ack > 0:
+    m = paramiko.Message()
+    m.add_byte(cMSG_CHANNEL_WINDOW_ADJUST)
+    m.add_int(channel.remote_chanid)
+    m.add_int(ack)
+    channel.transport._send_user_message(m)
+  return n
+
+
+class StreamlocalTransport(paramiko.Transport):
+  """
+  Server-side transport that also accepts direct-streamlocal@openssh.com channels. The socket path is passed to
+  ``check_channel_direct_streamlocal_request(chanid, path)`` of the server interface, which returns an ``OPEN_*`` code
+  like ``check_channel_direct_tcpip_request``. The channel is returned by `accept`.
+  """
+  def _parse_channel_open(self, m):
+    kind = m.get_text()
+    if kind != DIRECT_STREAMLOCAL or not self.server_mode:
+      m.rewind()
+      return super(StreamlocalTransport, self)._parse_channel_open(m)
+
+    remote_chanid = m.get_int()
+    window_size = m.get_int()
+    max_packet_size = m.get_int()
+    path = m.get_text()
+    with self.lock:
+      chanid = self._next_channel()
+    check = getattr(self.server_object, 'check_channel_direct_streamlocal_request', None)
+    reason = check(chanid, path) if check is not None else paramiko.OPEN_FAILED_UNKNOWN_CHANNEL_TYPE
+    if reason != paramiko.OPEN_SUCCEEDED:
+      m = paramiko.Message()
+      m.add_byte(cMSG_CHANNEL_OPEN_FAILURE)
+      m.add_int(remote_chanid)
+      m.add_int(reason)
+      m.add_string('')
+      m.add_string('en')
+      self._send_message(m)
+      return
+
+    channel = paramiko.Channel(chanid)
+    with self.lock:
+      self._channels.put(chanid, channel)
+      self.channels_seen[chanid] = True
+      channel._set_transport(self)
+      channel._set_window(self.default_window_size, self.default_max_packet_size)
+      channel._set_remote_channel(remote_chanid, window_size, max_packet_size)
+    m = paramiko.Message()
+    m.add_byte(cMSG_CHANNEL_OPEN_SUCCESS)
+    m.add_int(remote_chanid)
+    m.add_int(chanid)
+    m.add_int(self.default_window_size)
+    m.add_int(self.default_max_packet_size)
+    self._send_message(m)
+    self._queue_incoming_channel(channel)
+
+
+class _Connection(object):
+  """
+  A forwarded connection: a local socket and the channel to the remote address.
+  """
+  def __init__(self, sock, channel):
+    self.sock = sock
+    self.channel = channel
+    # Data that was received but not sent yet, because the SSH window or the socket buffer is full
+    self.to_channel = b''
+    self.to_sock = b''
+    # True when EOF was received from the socket or channel, and when it has been passed on
+    self.sock_eof = False
+    self.channel_eof = False
+    self.sock_shutdown = False
+    self.channel_shutdown = False
+    # Registered selector events of the socket and channel
+    self.sock_events = 0
+    self.channel_events = 0
+
+  @property
+  def done(self):
+    return self.sock_shutdown and self.channel_shutdown
+
+
+class PortForwarder(object):
+  """
+  Forwards connections to local addresses ``local_bind_addresses`` to the corresponding remote addresses in
+  ``remote_bind_addresses`` (lists of (host, port) tuples or Unix socket paths), over channels of the SSH
+  ``transport``. Call `start` to start listening, and `close` to stop and close all connections. Local Unix sockets are
+  only accessible by the user, and removed by `close`.
+  """
+  def __init__(self, transport, local_bind_addresses, remote_bind_addresses):
+    if len(local_bind_addresses) != len(remote_bind_addresses):
+      raise ValueError('Specify a remote address for each local address')
+    self.transport = transport
+    self.local_bind_addresses = list(local_bind_addresses)
+    self.remote_bind_addresses = list(remote_bind_addresses)
+
+    self._selector = None
+    self._listeners = []
+    self._connections = set()
+    self._buffer = bytearray(BUFFER_SIZE)
+    self._thread = None
+    self._closing = False
+    self._wake_recv, self._wake_send = None, None
+    # Accepted connections of which the channel is being opened, as (socket, channel, event, deadline, remote address)
+    self._opening = []
+
+  @property
+  def local_bind_ports(self):
+    return [listener.getsockname()[1] for listener, remote_address in self._listeners
+            if listener.family != getattr(socket, 'AF_UNIX', None)]
+
+  def start(self):
+    if self._thread is not None:
+      return self
+
+    self._selector = selectors.DefaultSelector()
+    self._wake_recv, self._wake_send = socket.socketpair()
+    self._wake_recv.setblocking(False)
+    self._selector.register(self._wake_recv, selectors.EVENT_READ, None)
+    try:
+      for local_address, remote_address in zip(self.local_bind_addresses, self.remote_bind_addresses):
+        listener = create_listener(local_address)
+        self._listeners.append((listener, remote_address))
+        self._selector.register(listener, selectors.EVENT_READ, (listener, remote_address))
+        logger.debug('Forwarding %s to remote %s', format_address(listener.getsockname()),
+                     format_address(remote_address))
+    except Exception:
+      self._close_all()
+      for sock in (self._wake_recv, self._wake_send):
+        sock.close()
+      raise
+
+    self._thread = threading.Thread(target=self._run, name='remote_kernel-forward')
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def close(self):
+    if self._thread is None:
+      return
+    self._closing = True
+    self._wake_send.send(b'\0')
+    self._thread.join()
+    self._thread = None
+    for sock in (self._wake_recv, self._wake_send):
+      sock.close()
+
+  def _run(self):
+    try:
+      while not self._closing and self.transport.is_active():
+        waiting = len(self._opening) > 0 or any(len(conn.to_channel) > 0 for conn in self._connections)
+        for key, events in self._selector.select(WINDOW_POLL if waiting else 1.):
+          if key.data is None:
+            self._wake_recv.recv(64)
+          elif isinstance(key.data[0], _Connection):
+            self._handle(key.data[0], key.data[1], events)
+          else:
+            self._accept(*key.data)
+        if waiting:
+          self._check_opening()
+          for conn in [conn for conn in self._connections if len(conn.to_channel) > 0]:
+            self._handle(conn, True, 0)
+    except Exception:
+      logger.error('Port forwarding failed', exc_info=True)
+    finally:
+      self._close_all()
+
+  def _accept(self, listener, remote_address):
+    try:
+      sock, peer = listener.accept()
+    except BlockingIOError:
+      return
+    if not isinstance(peer, tuple):
+      peer = ('127.0.0.1', 0)  # Unix sockets have no peer address
+    try:
+      channel, event = request_channel(self.transport, remote_address, peer)
+    except Exception as e:
+      logger.warning('Could not forward connection to remote %s (%s)', format_address(remote_address), e)
+      sock.close()
+      return
+    self._opening.append((sock, channel, event, time.time() + OPEN_TIMEOUT, remote_address))
+
+  def _check_opening(self):
+    """
+    Add the connections of which the remote host replied to the request to open the channel.
+    """
+    opening, self._opening = self._opening, []
+    for sock, channel, event, deadline, remote_address in opening:
+      if not event.is_set() and time.time() < deadline:
+        self._opening.append((sock, channel, event, deadline, remote_address))
+        continue
+      try:
+        if not event.is_set():
+          raise paramiko.SSHException('Timeout opening channel.')
+        get_requested_channel(self.transport, channel)
+      except Exception as e:
+        logger.warning('Could not forward connection to remote %s (%s)', format_address(remote_address), e)
+        channel.close()
+        sock.close()
+        continue
+      sock.setblocking(False)
+      if sock.family != getattr(socket, 'AF_UNIX', None):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      channel.settimeout(0.)
+      conn = _Connection(sock, channel)
+      self._connections.add(conn)
+      self._update(conn)
+
+  def _handle(self, conn, is_sock, events):
+    """
+    Handle ``events`` of the socket (if ``is_sock``) or channel of ``conn``, and send pending data.
+    """
+    try:
+      if len(conn.to_channel) > 0:
+        self._flush_channel(conn)  # Waiting for the SSH window
+      if is_sock and events & selectors.EVENT_READ:
+        n = conn.sock.recv_into(self._buffer)
+        if n == 0:
+          conn.sock_eof = True
+        else:
+          conn.to_channel = memoryview(self._buffer)[:n]
+          self._flush_channel(conn)
+          # Data left in the shared buffer must be copied
+          conn.to_channel = bytes(conn.to_channel)
+      if is_sock and events & selectors.EVENT_WRITE:
+        self._flush_sock(conn)
+      if not is_sock:
+        try:
+          n = recv_into(conn.channel, self._buffer)
+        except socket.timeout:
+          n = None  # Only a window adjustment or a request was received
+        if n == 0:
+          conn.channel_eof = True
+        elif n is not None:
+          conn.to_sock = memoryview(self._buffer)[:n]
+          self._flush_sock(conn)
+          conn.to_sock = bytes(conn.to_sock)
+      self._shutdown(conn)
+    except (socket.error, EOFError) as e:
+      logger.debug('Forwarded connection failed (%s)', e)
+      self._close(conn)
+      return
+    self._update(conn)
+
+  def _flush_channel(self, conn):
+    while len(conn.to_channel) > 0:
+      try:
+        sent = conn.channel.send(conn.to_channel)
+      except socket.timeout:
+        return  # The SSH window is exhausted
+      if sent == 0:
+        raise EOFError('Channel is closed')
+      conn.to_channel = conn.to_channel[sent:]
+
+  def _flush_sock(self, conn):
+    while len(conn.to_sock) > 0:
+      try:
+        sent = conn.sock.send(conn.to_sock)
+      except BlockingIOError:
+        return
+      conn.to_sock = conn.to_sock[sent:]
+
+  def _shutdown(self, conn):
+    # Pass on EOF once all data has been sent
+    if conn.sock_eof and not conn.channel_shutdown and len(conn.to_channel) == 0:
+      conn.channel.shutdown_write()
+      conn.channel_shutdown = True
+    if conn.channel_eof and not conn.sock_shutdown and len(conn.to_sock) == 0:
+      try:
+        conn.sock.shutdown(socket.SHUT_WR)
+      except OSError:
+        pass
+      conn.sock_shutdown = True
+
+  def _update(self, conn):
+    """
+    Register the events of the socket and channel of ``conn`` that can be handled, or close it when it is done.
+    """
+    if conn.done:
+      self._close(conn)
+      return
+    sock_events = 0
+    if not conn.sock_eof and len(conn.to_channel) == 0:
+      sock_events |= selectors.EVENT_READ
+    if len(conn.to_sock) > 0:
+      sock_events |= selectors.EVENT_WRITE
+    channel_events = selectors.EVENT_READ if not conn.channel_eof and len(conn.to_sock) == 0 else 0
+    conn.sock_events = self._register(conn.sock, conn.sock_events, sock_events, (conn, True))
+    conn.channel_events = self._register(conn.channel, conn.channel_events, channel_events, (conn, False))
+
+  def _register(self, fileobj, old_events, events, data):
+    if events == old_events:
+      pass
+    elif old_events == 0:
+      self._selector.register(fileobj, events, data)
+    elif events == 0:
+      self._selector.unregister(fileobj)
+    else:
+      self._selector.modify(fileobj, events, data)
+    return events
+
+  def _close(self, conn):
+    for fileobj, events in ((conn.sock, conn.sock_events), (conn.channel, conn.channel_events)):
+      if events != 0:
+        self._selector.unregister(fileobj)
+    conn.sock_events = conn.channel_events = 0
+    conn.sock.close()
+    conn.channel.close()
+    self._connections.discard(conn)
+
+  def _close_all(self):
+    for conn in list(self._connections):
+      self._close(conn)
+    for sock, channel, event, deadline, remote_address in self._opening:
+      channel.close()
+      sock.close()
+    self._opening = []
+    for listener, remote_address in self._listeners:
+      close_listener(listener)
+    self._listeners = []
+    if self._selector is not None:
+      self._selector.close()
+      self._selector = None
@@ -0,0 +1,150 @@
+"""
+Content hashes of synchronized files. Local hashes are cached by the identity and state of each file, remote hashes
+are computed on the remote host for many files at once.
+"""
+import json
+import logging
+import os
+import threading
+
+from .helpers import get_remote_cmd
+from .helpers.hasher import get_hasher, hash_file
+
+logger = logging.getLogger('remote_kernel.hashing')
+
+# Maximum number of files hashed by a single remote command
+MAX_REMOTE_FILES = 1000
+
+
+class HashCache(object):
+  """
+  Persistent cache of the content hashes of local files. A cached hash is used as long as the inode, size and modified
+  time (in nanoseconds) of the file are unchanged, so files are only hashed again when they are modified.
+
+  :param fname: File to store the cache in. If None, the cache is kept in memory only.
+  """
+  version = 1
+
+  def __init__(self, fname=None):
+    self.fname = fname
+    # Relative path -> [inode, size, mtime_ns, algorithm, hash]
+    self.files = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def load(cls, fname):
+    cache = cls(fname)
+    if not os.path.isfile(fname):
+      return cache
+
+    try:
+      with open(fname) as cache_fs:
+        data = json.load(cache_fs)
+    except ValueError:
+      logger.warning('Hash cache %s is corrupt, starting with an empty cache', fname)
+      return cache
+
+    if data.get('version', None) == cls.version:
+      cache.files = data.get('files', {})
+    logger.debug('Loaded %i entries from hash cache %s', len(cache.files), fname)
+    return cache
+
+  def save(self):
+    if self.fname is None:
+      return
+
+    with self._lock:
+      data = dict(version=self.version, files=self.files)
+      tmp_fname = self.fname + '.tmp'
+      with open(tmp_fname, mode='w') as cache_fs:
+        json.dump(data, cache_fs)
+      os.replace(tmp_fname, self.fname)
+
+  def get_hash(self, root, path, algorithm):
+    """
+    Returns the hash of local file ``path`` (relative to ``root``), computing it only if the file changed since it was
+    last hashed. Returns None if the file does not exist.
+    """
+    local_file = os.path.join(root, path)
+    try:
+      st = os.stat(local_file)
+    except OSError:
+      return None
+
+    key = [st.st_ino, st.st_size, st.st_mtime_ns, algorithm]
+    with self._lock:
+      record = self.files.get(path, None)
+    if record is not None and record[:4] == key:
+      return record[4]
+
+    file_hash = hash_file(local_file, get_hasher(algorithm))
+    with self._lock:
+      self.files[path] = key + [file_hash]
+    return file_hash
+
+  def prune(self, paths):
+    """
+    Remove the cached hashes of files that are not in ``paths``.
+    """
+    with self._lock:
+      for path in set(self.files.keys()) - set(paths):
+        del self.files[path]
+
+
+def remote_hashes(ssh_client, root, paths, algorithm, remote_python='python'):
+  """
+  Compute the hashes of remote files ``paths`` (relative to ``root``) on the remote host, using one command for up to
+  MAX_REMOTE_FILES files.
+
+  :return: Dictionary mapping relative paths to hashes. Files that do not exist are omitted.
+  :raises ValueError: if ``algorithm`` is not available on the remote host.
+  :raises IOError: if the hash helper fails on the remote host.
+  """
+  paths = list(paths)
+  hashes = {}
+  for i in range(0, len(paths), MAX_REMOTE_FILES):
+    batch = paths[i:i + MAX_REMOTE_FILES]
+    cmd = get_remote_cmd('hasher', ('hash', algorithm, root), remote_python)
+    logger.debug('Hashing %i remote files', len(batch))
+    stdin, stdout, stderr = ssh_client.exec_command(cmd)
+    stdin.write(b''.join(path.encode('utf-8', errors='surrogateescape') + b'\0' for path in batch))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    output = stdout.read()
+
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status == 3:
+      raise ValueError('Hash algorithm %s is not available on the remote host' % algorithm)
+    elif exit_status != 0:
+      raise IOError('Remote hashing failed with exit status %i: %s' %
+                    (exit_status, stderr.read().decode('utf-8', errors='replace').strip()))
+
+    for line in output.split(b'\0'):
+      if line == b'':
+        continue
+      file_hash, path = line.split(b' ', 1)
+      hashes[path.decode('utf-8', errors='surrogateescape')] = file_hash.decode('ascii')
+  return hashes
+
+
+def remote_chunk_hashes(ssh_client, path, algorithm, chunk_size, count, remote_python='python'):
+  """
+  Compute the hashes of the first ``count`` chunks of ``chunk_size`` bytes of remote file ``path`` on the remote host.
+
+  :return: List of the hashes of the chunks, shorter than ``count`` if the file is shorter
+  :raises ValueError: if ``algorithm`` is not available on the remote host.
+  :raises IOError: if the hash helper fails on the remote host, e.g. if the file does not exist.
+  """
+  cmd = get_remote_cmd('hasher', ('chunks', algorithm, chunk_size, count, path), remote_python)
+  logger.debug('Hashing %i chunks of remote file %s', count, path)
+  stdin, stdout, stderr = ssh_client.exec_command(cmd)
+  stdin.close()
+  output = stdout.read()
+
+  exit_status = stdout.channel.recv_exit_status()
+  if exit_status == 3:
+    raise ValueError('Hash algorithm %s is not available on the remote host' % algorithm)
+  elif exit_status != 0:
+    raise IOError('Remote hashing failed with exit status %i: %s' %
+                  (exit_status, stderr.read().decode('utf-8', errors='replace').strip()))
+  return output.decode('ascii').split()
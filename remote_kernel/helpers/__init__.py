@@ -0,0 +1,26 @@
+"""
+Helper scripts that are executed on the remote host.
+
+Each helper is a self-contained module (depending only on the python standard library), which is also importable
+locally, so both sides of a transfer share the same implementation. To run a helper remotely, its source is sent
+along with the command, so nothing needs to be installed on the remote host.
+"""
+import base64
+import pkgutil
+import shlex
+import zlib
+
+
+def get_remote_cmd(helper, args=(), python='python'):
+  """
+  Build a shell command that runs helper module ``helper`` on the remote host as a script, with arguments ``args``.
+
+  :param helper: Name of the helper module in this package (e.g. 'delta')
+  :param args: Arguments passed to the helper (available in ``sys.argv[1:]``)
+  :param python: Python interpreter to use on the remote host
+  :return: Command string to execute on the remote host
+  """
+  source = pkgutil.get_data(__name__, '%s.py' % helper)
+  payload = base64.b64encode(zlib.compress(source, 9)).decode('ascii')
+  bootstrap = "import base64,zlib;exec(zlib.decompress(base64.b64decode('%s')))" % payload
+  return ' '.join([python, '-c', shlex.quote(bootstrap)] + [shlex.quote(str(arg)) for arg in args])
@@ -0,0 +1,102 @@
+"""
+Content-addressed store of files on the remote host, used to deduplicate uploads between the sync folders of different
+kernels. Each file in the store (a blob) is named by its content hash, and files with that content are hard links to
+the blob, so they take no additional disk space. Blobs (and thereby all files linked to them) are made read-only, so
+they cannot be modified in place.
+
+When run as a script (on the remote host):
+
+- ``run <store>``: read requests from stdin, each consisting of three NULL-terminated fields ``<op> <blob> <path>``,
+  where ``<blob>`` is the path of the blob relative to ``<store>`` and ``<path>`` the absolute path of a synchronized
+  file. Operations:
+
+  - ``link``: if the blob exists, replace the file by a hard link to the blob. Otherwise, remove the file if it is
+    (or was) linked to a blob, so it can be uploaded.
+  - ``store``: add the (uploaded) file to the store as the blob, making it read-only.
+  - ``unshare``: remove the file if it is (or was) linked to a blob, so it can be replaced by an upload. ``<blob>`` is
+    ignored.
+
+  For each request, a line ``<status> <size> <mtime> <path>`` is written, terminated by a NULL character. Status is
+  ``linked``, ``stored``, ``missing`` (the blob does not exist), ``ok`` or ``error``.
+"""
+import os
+import stat
+import sys
+
+# Suffix of the temporary links, identical to the suffix of incomplete transfers (which are not synchronized)
+TMP_SUFFIX = b'.rkpart'
+
+
+def _unshare(path):
+  try:
+    path_stat = os.stat(path)
+  except FileNotFoundError:
+    return
+  # Files linked to a blob, or stored as a blob before, are read-only
+  if path_stat.st_nlink > 1 or not path_stat.st_mode & stat.S_IWUSR:
+    os.remove(path)
+
+
+def _replace_by_link(blob, path):
+  tmp_path = path + TMP_SUFFIX
+  if os.path.lexists(tmp_path):
+    os.remove(tmp_path)
+  os.link(blob, tmp_path)
+  os.replace(tmp_path, path)
+
+
+def handle(op, store, blob, path):
+  """
+  Handle a single request, see the module documentation.
+
+  :return: Status of the request
+  """
+  blob = os.path.join(store, blob)
+  if op == b'link':
+    if not os.path.isfile(blob):
+      _unshare(path)
+      return b'missing'
+    if not (os.path.exists(path) and os.path.samefile(blob, path)):
+      _replace_by_link(blob, path)
+    return b'linked'
+  elif op == b'store':
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~0o222)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+      os.link(path, blob)
+    except FileExistsError:
+      # Stored concurrently (e.g. by another kernel), link to the existing blob instead
+      if not os.path.samefile(blob, path):
+        _replace_by_link(blob, path)
+    return b'stored'
+  elif op == b'unshare':
+    _unshare(path)
+    return b'ok'
+  raise ValueError('Unknown operation %s' % op)
+
+
+def main(argv):
+  mode = argv[0]
+  if mode == 'run':
+    store = os.fsencode(argv[1])
+    stdout = sys.stdout.buffer
+    fields = sys.stdin.buffer.read().split(b'\0')
+    for i in range(0, len(fields) - 2, 3):
+      op, blob, path = fields[i:i + 3]
+      try:
+        status = handle(op, store, blob, path)
+        if status in (b'linked', b'stored'):
+          path_stat = os.stat(path)
+          stdout.write(b'%s %i %a %s\0' % (status, path_stat.st_size, path_stat.st_mtime, path))
+        else:
+          stdout.write(b'%s 0 0 %s\0' % (status, path))
+      except OSError as e:
+        sys.stderr.write('%s: %s\n' % (os.fsdecode(path), e))
+        stdout.write(b'error 0 0 %s\0' % path)
+    stdout.flush()
+  else:
+    raise ValueError('Unknown mode %s' % mode)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,315 @@
+"""
+rsync-style delta transfer of files.
+
+The receiving side splits its (outdated) copy of a file into blocks and sends a signature, containing a weak rolling
+checksum and a strong hash of each block. The sending side scans the new version of the file for blocks matching the
+signature and sends a delta, consisting of references to matching blocks and literal data for the parts that
+differ. The receiving side then rebuilds the new version from its old copy and the delta.
+
+When run as a script (on the remote host), two modes are available:
+
+- ``delta <path>``: read a signature from stdin and write the delta of file ``path`` to stdout (remote sends).
+- ``patch <path> [<atime> <mtime>]``: write the signature of file ``path`` to stdout, then read a delta from stdin and
+  replace ``path`` with the rebuilt file (remote receives).
+
+This module only depends on the python standard library.
+"""
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+SIGNATURE_MAGIC = b'RKSG'
+SIGNATURE_HEADER = struct.Struct('>QI')  # file size, block size
+BLOCK_SIGNATURE = struct.Struct('>I16s')  # weak checksum, strong hash
+
+OP_COPY = b'C'  # followed by index of the first block and number of blocks to copy
+OP_LITERAL = b'L'  # followed by the length and the literal data
+OP_END = b'E'  # followed by the hash of the complete new file
+COPY_ARGS = struct.Struct('>II')
+LITERAL_ARGS = struct.Struct('>I')
+
+MOD_ADLER = 65521
+READ_SIZE = 1 << 22
+MAX_LITERAL = 1 << 20
+
+TMP_SUFFIX = '.rkpart'
+
+
+def get_block_size(file_size):
+  """
+  Block size for a file of ``file_size`` bytes: the power of 2 nearest to the square root of the file size, limited
+  to the range 2 KiB - 128 KiB.
+  """
+  block_size = 2048
+  while block_size * block_size < file_size and block_size < 131072:
+    block_size *= 2
+  return block_size
+
+
+def strong_hash(data):
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def read_exact(fs, size):
+  data = fs.read(size)
+  while len(data) < size:
+    chunk = fs.read(size - len(data))
+    if not chunk:
+      raise EOFError('Unexpected end of stream')
+    data += chunk
+  return data
+
+
+class Signature(object):
+  def __init__(self, file_size, block_size):
+    self.file_size = file_size
+    self.block_size = block_size
+    self.strong = []
+    self.lookup = {}
+
+  def add(self, weak, strong):
+    self.lookup.setdefault(weak, []).append(len(self.strong))
+    self.strong.append(strong)
+
+  def match(self, weak, data):
+    """
+    Returns the index of the block matching ``data`` (with weak checksum ``weak``), or None if no block matches.
+    """
+    candidates = self.lookup.get(weak, None)
+    if candidates is None:
+      return None
+    strong = strong_hash(data)
+    for idx in candidates:
+      if self.strong[idx] == strong:
+        return idx
+    return None
+
+
+def write_signature(basis_fs, out_fs, file_size):
+  """
+  Write the signature of ``basis_fs`` (a file of ``file_size`` bytes, opened for binary reading) to ``out_fs``.
+
+  :return: Block size used in the signature and the number of bytes written.
+  """
+  block_size = get_block_size(file_size)
+  out_fs.write(SIGNATURE_MAGIC + SIGNATURE_HEADER.pack(file_size, block_size))
+  written = len(SIGNATURE_MAGIC) + SIGNATURE_HEADER.size
+
+  n_blocks = (file_size + block_size - 1) // block_size
+  for _ in range(n_blocks):
+    block = basis_fs.read(block_size)
+    out_fs.write(BLOCK_SIGNATURE.pack(zlib.adler32(block), strong_hash(block)))
+    written += BLOCK_SIGNATURE.size
+  return block_size, written
+
+
+def read_signature(in_fs):
+  if read_exact(in_fs, len(SIGNATURE_MAGIC)) != SIGNATURE_MAGIC:
+    raise ValueError('Invalid signature stream')
+  file_size, block_size = SIGNATURE_HEADER.unpack(read_exact(in_fs, SIGNATURE_HEADER.size))
+  signature = Signature(file_size, block_size)
+  for _ in range((file_size + block_size - 1) // block_size):
+    signature.add(*BLOCK_SIGNATURE.unpack(read_exact(in_fs, BLOCK_SIGNATURE.size)))
+  return signature
+
+
+class _DeltaWriter(object):
+  def __init__(self, out_fs):
+    self.out_fs = out_fs
+    self.literal = bytearray()
+    self.copy_start = None
+    self.copy_count = 0
+    self.literal_bytes = 0
+    self.written = 0
+
+  def copy(self, idx):
+    self.flush_literal()
+    if self.copy_start is not None and self.copy_start + self.copy_count == idx:
+      self.copy_count += 1
+    else:
+      self.flush_copy()
+      self.copy_start = idx
+      self.copy_count = 1
+
+  def add_literal(self, data):
+    self.flush_copy()
+    self.literal += data
+    if len(self.literal) >= MAX_LITERAL:
+      self.flush_literal()
+
+  def flush_copy(self):
+    if self.copy_start is not None:
+      self._write(OP_COPY + COPY_ARGS.pack(self.copy_start, self.copy_count))
+      self.copy_start = None
+      self.copy_count = 0
+
+  def flush_literal(self):
+    while len(self.literal) > 0:
+      data = bytes(self.literal[:MAX_LITERAL])
+      del self.literal[:MAX_LITERAL]
+      self._write(OP_LITERAL + LITERAL_ARGS.pack(len(data)) + data)
+      self.literal_bytes += len(data)
+
+  def end(self, file_hash):
+    self.flush_copy()
+    self.flush_literal()
+    self._write(OP_END + file_hash)
+
+  def _write(self, data):
+    self.out_fs.write(data)
+    self.written += len(data)
+
+
+def write_delta(new_fs, signature, out_fs, max_misses=16):
+  """
+  Compare file ``new_fs`` (opened for binary reading) to ``signature`` and write the delta to ``out_fs``.
+
+  Blocks are first compared at the current offset. If this fails, the following offsets are searched using a rolling
+  checksum, allowing blocks that shifted due to insertions or deletions to be found. After ``max_misses`` consecutive
+  blocks without a match, only the block-aligned offsets are checked until a block matches again, which keeps the scan
+  of very different files fast.
+
+  :return: Tuple of the number of literal bytes and the total number of bytes written to ``out_fs``
+  """
+  block_size = signature.block_size
+  file_hash = hashlib.blake2b(digest_size=32)
+  writer = _DeltaWriter(out_fs)
+
+  buf = b''
+  pos = 0
+  eof = False
+  misses = 0
+  while True:
+    # Ensure the buffer holds at least 2 blocks (needed for the rolling search), unless the end of the file is reached
+    if not eof and len(buf) - pos < 2 * block_size:
+      buf = buf[pos:]
+      pos = 0
+      while not eof and len(buf) < 2 * block_size:
+        data = new_fs.read(READ_SIZE)
+        if not data:
+          eof = True
+        file_hash.update(data)
+        buf += data
+
+    remaining = len(buf) - pos
+    if remaining == 0:
+      break
+
+    block = buf[pos:pos + block_size]
+    weak = zlib.adler32(block)
+    idx = signature.match(weak, block)
+    if idx is not None:
+      writer.copy(idx)
+      pos += len(block)
+      misses = 0
+      continue
+
+    if len(block) == block_size and misses < max_misses:
+      # Roll the checksum through the block to find a match at a shifted offset
+      a = weak & 0xffff
+      b = (weak >> 16) & 0xffff
+      end = min(block_size, len(buf) - pos - block_size + 1)
+      for k in range(1, end):
+        byte_out = buf[pos + k - 1]
+        a = (a - byte_out + buf[pos + k + block_size - 1]) % MOD_ADLER
+        b = (b - block_size * byte_out + a - 1) % MOD_ADLER
+        idx = signature.match((b << 16) | a, buf[pos + k:pos + k + block_size])
+        if idx is not None:
+          writer.add_literal(buf[pos:pos + k])
+          writer.copy(idx)
+          pos += k + block_size
+          misses = 0
+          break
+
+    if idx is None:
+      writer.add_literal(block)
+      pos += len(block)
+      misses += 1
+
+  writer.end(file_hash.digest())
+  return writer.literal_bytes, writer.written
+
+
+def apply_delta(in_fs, basis_fs, block_size, out_fs):
+  """
+  Rebuild a file from ``basis_fs`` (opened for binary reading) and the delta read from ``in_fs`` and write it to
+  ``out_fs``.
+
+  :return: Number of literal bytes in the delta
+  :raises ValueError: if the hash of the rebuilt file does not match the hash of the new file.
+  """
+  file_hash = hashlib.blake2b(digest_size=32)
+  literal_bytes = 0
+  while True:
+    op = read_exact(in_fs, 1)
+    if op == OP_COPY:
+      idx, count = COPY_ARGS.unpack(read_exact(in_fs, COPY_ARGS.size))
+      basis_fs.seek(idx * block_size)
+      remaining = count * block_size
+      while remaining > 0:
+        data = basis_fs.read(min(remaining, READ_SIZE))
+        if not data:
+          break  # Last block of the file may be shorter
+        out_fs.write(data)
+        file_hash.update(data)
+        remaining -= len(data)
+    elif op == OP_LITERAL:
+      size, = LITERAL_ARGS.unpack(read_exact(in_fs, LITERAL_ARGS.size))
+      data = read_exact(in_fs, size)
+      out_fs.write(data)
+      file_hash.update(data)
+      literal_bytes += size
+    elif op == OP_END:
+      if read_exact(in_fs, 32) != file_hash.digest():
+        raise ValueError('Rebuilt file does not match the source file')
+      return literal_bytes
+    else:
+      raise ValueError('Invalid delta operation %r' % op)
+
+
+def patch_file(path, in_fs, sig_fs, times=None):
+  """
+  Write the signature of file ``path`` to ``sig_fs``, then rebuild the new version of the file from the delta read
+  from ``in_fs``. The new version is written to a temporary file, which replaces ``path`` when it is complete.
+
+  :param times: Optional tuple of (atime, mtime) to set on the new file.
+  :return: Tuple of the number of bytes in the signature and the number of literal bytes in the delta
+  """
+  tmp_path = path + TMP_SUFFIX
+  try:
+    with open(path, 'rb') as basis_fs:
+      block_size, sig_bytes = write_signature(basis_fs, sig_fs, os.fstat(basis_fs.fileno()).st_size)
+      sig_fs.flush()
+      with open(tmp_path, 'wb') as out_fs:
+        literal_bytes = apply_delta(in_fs, basis_fs, block_size, out_fs)
+    os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  if times is not None:
+    os.utime(path, times)
+  return sig_bytes, literal_bytes
+
+
+def main(argv):
+  mode = argv[0]
+  stdin = sys.stdin.buffer
+  stdout = sys.stdout.buffer
+  if mode == 'delta':
+    signature = read_signature(stdin)
+    with open(argv[1], 'rb') as new_fs:
+      write_delta(new_fs, signature, stdout)
+  elif mode == 'patch':
+    times = (float(argv[2]), float(argv[3])) if len(argv) > 3 else None
+    patch_file(argv[1], stdin, stdout, times)
+    stdout.write(b'OK')
+  else:
+    raise ValueError('Unknown mode %s' % mode)
+  stdout.flush()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
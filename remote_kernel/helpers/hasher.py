@@ -0,0 +1,116 @@
+"""
+Content hashes of files, used to detect whether files changed regardless of their modified times.
+
+Uses the fastest algorithm available: XXH3 (``xxhash`` package), BLAKE3 (``blake3`` package) or BLAKE2b (python
+standard library). When run as a script (on the remote host):
+
+- ``hash <algorithm> <root>``: read NULL-separated paths (relative to ``root``) from stdin and write a line
+  ``<hash> <path>`` for each file, terminated by a NULL character. Files that do not exist are skipped. Exits with
+  status 3 if the algorithm is not available.
+- ``chunks <algorithm> <chunk size> <count> <path>``: write a line with the hash of each of the first ``count`` chunks
+  of file ``path``. A chunk at the end of the file that is shorter than ``chunk size`` is not hashed. Exits with status
+  3 if the algorithm is not available.
+"""
+import hashlib
+import os
+import sys
+
+READ_SIZE = 1 << 20
+
+# Algorithms in order of preference
+ALGORITHMS = ('xxh3_128', 'blake3', 'blake2b')
+
+
+def get_hasher(algorithm):
+  """
+  Returns a function creating a new hash object of ``algorithm``.
+
+  :raises ValueError: if the algorithm is not available.
+  """
+  try:
+    if algorithm == 'xxh3_128':
+      import xxhash
+      return xxhash.xxh3_128
+    elif algorithm == 'blake3':
+      import blake3
+      return blake3.blake3
+  except ImportError:
+    raise ValueError('Hash algorithm %s is not available' % algorithm)
+  if algorithm == 'blake2b':
+    return lambda: hashlib.blake2b(digest_size=16)
+  raise ValueError('Unknown hash algorithm %s' % algorithm)
+
+
+def get_algorithms():
+  """
+  Returns the hash algorithms available on this host, in order of preference.
+  """
+  algorithms = []
+  for algorithm in ALGORITHMS:
+    try:
+      get_hasher(algorithm)
+      algorithms.append(algorithm)
+    except ValueError:
+      pass
+  return algorithms
+
+
+def hash_file(path, hasher):
+  """
+  Returns the hexadecimal digest of file ``path``, using ``hasher`` as returned by `get_hasher`.
+  """
+  file_hash = hasher()
+  with open(path, 'rb') as in_fs:
+    for data in iter(lambda: in_fs.read(READ_SIZE), b''):
+      file_hash.update(data)
+  return file_hash.hexdigest()
+
+
+def hash_chunks(path, hasher, chunk_size, count):
+  """
+  Returns the hexadecimal digests of the first ``count`` chunks of ``chunk_size`` bytes of file ``path``. Chunks at the
+  end of the file that are incomplete are not hashed.
+  """
+  hashes = []
+  with open(path, 'rb') as in_fs:
+    while len(hashes) < count:
+      chunk_hash = hasher()
+      size = 0
+      for data in iter(lambda: in_fs.read(min(READ_SIZE, chunk_size - size)), b''):
+        chunk_hash.update(data)
+        size += len(data)
+      if size < chunk_size:
+        break
+      hashes.append(chunk_hash.hexdigest())
+  return hashes
+
+
+def main(argv):
+  mode = argv[0]
+  try:
+    hasher = get_hasher(argv[1])
+  except ValueError as e:
+    sys.stderr.write('%s\n' % e)
+    sys.exit(3)
+  if mode == 'hash':
+    root = argv[2]
+    stdout = sys.stdout.buffer
+    for path in sys.stdin.buffer.read().split(b'\0'):
+      if path == b'':
+        continue
+      try:
+        digest = hash_file(os.path.join(os.fsencode(root), path), hasher)
+      except OSError:
+        continue  # Removed, or not a regular file
+      stdout.write(digest.encode('ascii') + b' ' + path + b'\0')
+    stdout.flush()
+  elif mode == 'chunks':
+    for digest in hash_chunks(argv[4], hasher, int(argv[2]), int(argv[3])):
+      sys.stdout.write(digest + '\n')
+    sys.stdout.flush()
+  else:
+    raise ValueError('Unknown mode %s' % mode)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,422 @@
+"""
+Multiplexing relay of the kernel sockets: all connections to the sockets of a kernel (shell, iopub, stdin, control and
+heartbeat) are carried over a single stream, i.e. one SSH channel, instead of a forwarded channel per connection. The
+local side (see `remote_kernel.mux`) accepts the connections of the clients, and opens a stream for each of them, which
+the remote side connects to the corresponding socket of the kernel.
+
+Usage: ``relay.py [--compress <codecs> <threshold> <indices>] <address>... -- <command>``
+
+Runs ``command`` (the kernel) in the shell of the user (``$SHELL``) and relays streams to the sockets at ``address``
+(``host:port`` or the path of a Unix socket) over stdin and stdout. The output of the command is written to stderr. The
+command is terminated when stdin is closed, and the relay exits with the exit status of the command.
+
+With ``--compress``, data received from the sockets with the (comma separated) ``indices`` is compressed in chunks of
+at least ``threshold`` bytes, with the first of the (comma separated) ``codecs`` that is available: Zstandard
+(``compression.zstd`` module of python 3.14, or ``zstandard`` package), LZ4 (``lz4`` package) or zlib (python standard
+library). The bytes of the streams are unchanged, so the messages of the kernel keep their signatures.
+
+The stream consists of frames: a header (type, stream ID, length), followed by ``length`` bytes for DATA frames.
+
+- OPEN: open a stream to the address with index ``length``
+- DATA: data of the stream
+- ZDATA: compressed data of the stream, the first byte is the index of the codec in CODECS
+- EOF: no more data is sent on the stream
+- CLOSE: the stream was closed because of an error
+- ACK: ``length`` bytes of the stream were delivered. Each side sends at most WINDOW bytes of a stream that were not
+  acknowledged, so a connection that is not read (e.g. of a busy client) does not hold up the other connections.
+
+This module only depends on the python standard library.
+"""
+import os
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+HEADER = struct.Struct('!BII')
+OPEN, DATA, EOF, CLOSE, ACK, ZDATA = range(6)
+
+# Compression codecs in order of preference
+CODECS = ('zstd', 'lz4', 'zlib')
+
+# Maximum number of bytes of a stream in flight
+WINDOW = 1 << 20
+# Maximum size of a DATA frame, small enough to interleave the frames of different streams
+FRAME_SIZE = 32 << 10
+# Maximum number of bytes read at once from a socket of which the data is compressed
+COMPRESS_SIZE = 256 << 10
+# Default minimum number of bytes to compress at once, smaller chunks are not worth the time of the codec
+COMPRESS_THRESHOLD = 16 << 10
+# Maximum number of bytes read from or written to the link at once
+LINK_SIZE = 256 << 10
+# Size of the frames waiting to be sent, above which the sockets are not read
+SEND_LIMIT = 128 << 10
+# Seconds between attempts to send, if the link has no file descriptor to wait for
+SEND_POLL = 0.005
+# Seconds to wait for the command to exit after stdin was closed, before it is killed
+TERMINATE_TIMEOUT = 5.
+
+
+def get_codec(codec):
+  """
+  Returns the functions to compress and to decompress data with ``codec``.
+
+  :raises ValueError: if the codec is not available.
+  """
+  try:
+    if codec == 'zstd':
+      try:
+        from compression import zstd
+        return zstd.compress, zstd.decompress
+      except ImportError:
+        import zstandard
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    elif codec == 'lz4':
+      import lz4.frame
+      return lz4.frame.compress, lz4.frame.decompress
+  except ImportError:
+    raise ValueError('Compression codec %s is not available' % codec)
+  if codec == 'zlib':
+    return lambda data: zlib.compress(data, 1), zlib.decompress
+  raise ValueError('Unknown compression codec %s' % codec)
+
+
+def get_codecs():
+  """
+  Returns the compression codecs available on this host, in order of preference.
+  """
+  codecs = []
+  for codec in CODECS:
+    try:
+      get_codec(codec)
+      codecs.append(codec)
+    except ValueError:
+      pass
+  return codecs
+
+
+def parse_address(address):
+  """
+  Parse ``host:port`` into a (host, port) tuple, other addresses are paths of Unix sockets.
+  """
+  host, _, port = address.rpartition(':')
+  if '/' not in address and port.isdigit():
+    return host, int(port)
+  return address
+
+
+def connect(address):
+  if isinstance(address, str):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(address)
+    except OSError:
+      sock.close()
+      raise
+  else:
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  sock.setblocking(False)
+  return sock
+
+
+class _Stream(object):
+  def __init__(self, stream_id, sock, compress=False):
+    self.id = stream_id
+    self.sock = sock
+    self.compress = compress
+    # Data received over the link, not written to the socket yet
+    self.pending = bytearray()
+    # Number of bytes that may be sent over the link, and number of bytes delivered to the socket but not acknowledged
+    self.credit = WINDOW
+    self.delivered = 0
+    # True when EOF was read from the socket (and sent), and when EOF was received over the link (and passed on)
+    self.sock_eof = False
+    self.link_eof = False
+    self.shutdown = False
+    self.events = 0
+
+
+class StdioLink(object):
+  """
+  Link over the (non-blocking) stdin and stdout of this process.
+  """
+  def __init__(self):
+    os.set_blocking(0, False)
+    os.set_blocking(1, False)
+
+  def fileno(self):
+    return 0
+
+  def send_fileno(self):
+    return 1
+
+  def recv(self, size):
+    try:
+      return os.read(0, size)
+    except BlockingIOError:
+      return None
+
+  def send(self, data):
+    try:
+      return os.write(1, data)
+    except BlockingIOError:
+      return 0
+
+
+class Relay(object):
+  """
+  One side of the relay, multiplexing streams over ``link``. The link provides ``fileno()`` (readable when data was
+  received), ``send_fileno()`` (writable when data can be sent, or None to poll), ``recv(size)`` (None if no data was
+  received, b'' at EOF) and ``send(data)`` (number of bytes sent, 0 if the link is full).
+
+  :param addresses: Addresses of the sockets that streams are opened to (on the remote side)
+  :param compress: Indices of the addresses of which the data is compressed (on the remote side)
+  :param codec: Codec to compress with, see `get_codec`. Compressed data is decompressed with any available codec.
+  :param threshold: Minimum number of bytes to compress at once
+  """
+  def __init__(self, link, addresses=(), compress=(), codec='zlib', threshold=COMPRESS_THRESHOLD):
+    self.link = link
+    self.addresses = addresses
+    self.compress = frozenset(compress)
+    self.threshold = threshold
+    self.selector = selectors.DefaultSelector()
+    self.streams = {}
+    self.link_eof = False
+    # Bytes that were compressed (or decompressed), their compressed size, bytes that did not compress, and the
+    # seconds spent in the codec
+    self.stats = dict(raw_bytes=0, compressed_bytes=0, incompressible_bytes=0, seconds=0.)
+
+    self._next_id = 0
+    self._received = bytearray()
+    self._send = bytearray()
+    self._send_events = 0
+    self._buffer = bytearray(COMPRESS_SIZE if self.compress else FRAME_SIZE)
+    self._codec = CODECS.index(codec)
+    self._compress = get_codec(codec)[0] if self.compress else None
+    self._decompress = {}
+    self.selector.register(link.fileno(), selectors.EVENT_READ, self._read_link)
+
+  def open_stream(self, sock, index):
+    """
+    Relay connection ``sock`` to the address with ``index`` on the other side.
+    """
+    sock.setblocking(False)
+    self._next_id += 1
+    self.streams[self._next_id] = _Stream(self._next_id, sock)
+    self._add_frame(OPEN, self._next_id, index)
+
+  def run_once(self, timeout=None):
+    """
+    Wait at most ``timeout`` seconds for events, and handle them. Callbacks registered with the selector by the owner
+    of the relay are called with the events.
+
+    :raises OSError: if the link failed
+    """
+    for stream in list(self.streams.values()):
+      self._update(stream)
+    send_fileno = self.link.send_fileno()
+    if send_fileno is not None:
+      events = selectors.EVENT_WRITE if len(self._send) > 0 else 0
+      self._send_events = self._register(send_fileno, self._send_events, events, self._write_link)
+    elif len(self._send) > 0:
+      timeout = SEND_POLL if timeout is None else min(timeout, SEND_POLL)
+
+    for key, events in self.selector.select(timeout):
+      key.data(events)
+    if send_fileno is None and len(self._send) > 0:
+      self._write_link(selectors.EVENT_WRITE)
+
+  def close(self):
+    for stream in list(self.streams.values()):
+      self._close(stream)
+    self.selector.close()
+
+  def _add_frame(self, kind, stream_id, length, data=b''):
+    self._send += HEADER.pack(kind, stream_id, length)
+    self._send += data
+
+  def _add_data(self, stream, data):
+    if stream.compress and len(data) >= self.threshold:
+      started = time.perf_counter()
+      compressed = self._compress(data)
+      self.stats['seconds'] += time.perf_counter() - started
+      if len(compressed) < len(data):
+        self._add_frame(ZDATA, stream.id, len(compressed) + 1, bytes((self._codec,)) + compressed)
+        self.stats['raw_bytes'] += len(data)
+        self.stats['compressed_bytes'] += len(compressed) + 1
+        return
+      self.stats['incompressible_bytes'] += len(data)
+    for offset in range(0, len(data), FRAME_SIZE):
+      chunk = data[offset:offset + FRAME_SIZE]
+      self._add_frame(DATA, stream.id, len(chunk), chunk)
+
+  def _decompress_data(self, data):
+    codec = data[0]
+    if codec not in self._decompress:
+      self._decompress[codec] = get_codec(CODECS[codec])[1]
+    started = time.perf_counter()
+    raw = self._decompress[codec](bytes(data[1:]))
+    self.stats['seconds'] += time.perf_counter() - started
+    self.stats['raw_bytes'] += len(raw)
+    self.stats['compressed_bytes'] += len(data)
+    return raw
+
+  def _write_link(self, events):
+    while len(self._send) > 0:
+      sent = self.link.send(bytes(self._send[:LINK_SIZE]))
+      if sent == 0:
+        return
+      del self._send[:sent]
+
+  def _read_link(self, events):
+    data = self.link.recv(LINK_SIZE)
+    if data is None:
+      return
+    if data == b'':
+      self.link_eof = True
+      self.selector.unregister(self.link.fileno())
+      return
+    self._received += data
+    offset = 0
+    while len(self._received) - offset >= HEADER.size:
+      kind, stream_id, length = HEADER.unpack_from(self._received, offset)
+      size = HEADER.size + (length if kind in (DATA, ZDATA) else 0)
+      if len(self._received) - offset < size:
+        break
+      self._handle_frame(kind, stream_id, length, self._received[offset + HEADER.size:offset + size])
+      offset += size
+    del self._received[:offset]
+
+  def _handle_frame(self, kind, stream_id, length, data):
+    if kind == OPEN:
+      try:
+        self.streams[stream_id] = _Stream(stream_id, connect(self.addresses[length]), length in self.compress)
+      except (OSError, IndexError) as e:
+        sys.stderr.write('Relay could not connect to %s (%s)\n' % (self.addresses[length:length + 1], e))
+        self._add_frame(CLOSE, stream_id, 0)
+      return
+    stream = self.streams.get(stream_id, None)
+    if stream is None:
+      return  # Frames in flight when the stream was closed
+    if kind == DATA:
+      stream.pending += data
+    elif kind == ZDATA:
+      stream.pending += self._decompress_data(data)
+    elif kind == EOF:
+      stream.link_eof = True
+    elif kind == CLOSE:
+      self._close(stream, notify=False)
+      return
+    elif kind == ACK:
+      stream.credit += length
+    self._handle_stream(stream, selectors.EVENT_WRITE if len(stream.pending) > 0 else 0)
+
+  def _handle_stream(self, stream, events):
+    try:
+      if events & selectors.EVENT_READ:
+        n = stream.sock.recv_into(self._buffer, min(stream.credit, COMPRESS_SIZE if stream.compress else FRAME_SIZE))
+        if n == 0:
+          stream.sock_eof = True
+          self._add_frame(EOF, stream.id, 0)
+        else:
+          stream.credit -= n
+          self._add_data(stream, memoryview(self._buffer)[:n])
+      if events & selectors.EVENT_WRITE:
+        while len(stream.pending) > 0:
+          try:
+            sent = stream.sock.send(stream.pending)
+          except BlockingIOError:
+            break
+          del stream.pending[:sent]
+          stream.delivered += sent
+        # Acknowledge in larger chunks: small frames sent right after each other are delayed by Nagle's algorithm
+        if stream.delivered >= WINDOW // 4:
+          self._add_frame(ACK, stream.id, stream.delivered)
+          stream.delivered = 0
+      if stream.link_eof and not stream.shutdown and len(stream.pending) == 0:
+        stream.sock.shutdown(socket.SHUT_WR)
+        stream.shutdown = True
+    except OSError:
+      self._close(stream)
+
+  def _update(self, stream):
+    if stream.sock_eof and stream.shutdown:
+      self._close(stream, notify=False)
+      return
+    events = 0
+    if not stream.sock_eof and stream.credit > 0 and len(self._send) < SEND_LIMIT:
+      events |= selectors.EVENT_READ
+    if len(stream.pending) > 0:
+      events |= selectors.EVENT_WRITE
+    stream.events = self._register(stream.sock, stream.events, events,
+                                   lambda events, stream=stream: self._handle_stream(stream, events))
+
+  def _register(self, fileobj, old_events, events, callback):
+    if events == old_events:
+      pass
+    elif old_events == 0:
+      self.selector.register(fileobj, events, callback)
+    elif events == 0:
+      self.selector.unregister(fileobj)
+    else:
+      self.selector.modify(fileobj, events, callback)
+    return events
+
+  def _close(self, stream, notify=True):
+    if self.streams.pop(stream.id, None) is None:
+      return
+    if stream.events != 0:
+      self.selector.unregister(stream.sock)
+      stream.events = 0
+    stream.sock.close()
+    if notify:
+      self._add_frame(CLOSE, stream.id, 0)
+
+
+def main(argv):
+  split = argv.index('--')
+  compress, codec, threshold = (), 'zlib', COMPRESS_THRESHOLD
+  if argv[0] == '--compress':
+    codecs = [codec for codec in argv[1].split(',') if codec in get_codecs()]
+    if codecs:
+      codec, threshold, compress = codecs[0], int(argv[2]), [int(index) for index in argv[3].split(',')]
+    else:
+      sys.stderr.write('Relay does not compress, none of the codecs %s are available\n' % argv[1])
+    argv = argv[4:]
+    split -= 4
+  addresses = [parse_address(address) for address in argv[:split]]
+  command = ' '.join(argv[split + 1:])
+
+  # Output of the command goes to stderr, stdout carries the relay. New session, to terminate all its processes. Like
+  # sshd, the command runs in the shell of the user, so pre-commands such as "source" or "conda activate" still work.
+  process = subprocess.Popen([os.environ.get('SHELL', '/bin/sh'), '-c', command], stdin=subprocess.DEVNULL,
+                             stdout=sys.stderr.fileno(), start_new_session=True)
+  relay = Relay(StdioLink(), addresses, compress, codec, threshold)
+  try:
+    while not relay.link_eof and process.poll() is None:
+      relay.run_once(1.)
+  except OSError:
+    pass  # The link was closed
+  finally:
+    relay.close()
+    if process.poll() is None:
+      os.killpg(process.pid, signal.SIGTERM)
+      deadline = time.time() + TERMINATE_TIMEOUT
+      while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+      if process.poll() is None:
+        os.killpg(process.pid, signal.SIGKILL)
+  status = process.wait()
+  if relay.stats['raw_bytes'] > 0:
+    sys.stderr.write('Relay compressed %i bytes to %i with %s in %.3f s\n' % (
+      relay.stats['raw_bytes'], relay.stats['compressed_bytes'], codec, relay.stats['seconds']))
+  sys.exit(status if status >= 0 else 128 - status)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
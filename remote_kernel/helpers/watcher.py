@@ -0,0 +1,159 @@
+"""
+Watch a folder on the remote host for changed files, used when ``inotifywait`` is not available.
+
+Usage: ``watcher.py <root> <recursive>``
+
+Prints a line ``<events> <path>`` for each change, in the same format as ``inotifywait --format '%e %w%f'``, where
+``events`` is a comma separated list of event names (e.g. ``CLOSE_WRITE,CLOSE`` or ``CREATE,ISDIR``). Uses inotify
+(through ctypes) on Linux, otherwise the tree is scanned every few seconds. Exits when stdin is closed, i.e. when the
+channel to the watcher is closed.
+
+This module only depends on the python standard library.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+EVENT_NAMES = (
+  (IN_ATTRIB, 'ATTRIB'),
+  (IN_CLOSE_WRITE, 'CLOSE_WRITE'),
+  (IN_MOVED_TO, 'MOVED_TO'),
+  (IN_CREATE, 'CREATE'),
+  (IN_Q_OVERFLOW, 'Q_OVERFLOW'),
+  (IN_ISDIR, 'ISDIR'),
+)
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # watch descriptor, mask, cookie, length of the name
+
+POLL_INTERVAL = 2.
+
+
+def emit(mask, path):
+  names = [name for flag, name in EVENT_NAMES if mask & flag]
+  sys.stdout.write('%s %s\n' % (','.join(names), path))
+  sys.stdout.flush()
+
+
+def stdin_closed(timeout):
+  """
+  Wait at most ``timeout`` seconds for stdin to be closed, returns True if it was.
+  """
+  readable, _, _ = select.select([sys.stdin], [], [], timeout)
+  return len(readable) > 0 and os.read(sys.stdin.fileno(), 4096) == b''
+
+
+class INotify(object):
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    self.fd = libc.inotify_init()
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    self.watches = {}
+
+  def add_watch(self, path):
+    wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    self.watches[wd] = path
+
+  def add_tree(self, root, recursive):
+    self.add_watch(root)
+    if recursive:
+      for fldr, dirs, _ in os.walk(root):
+        for d in dirs:
+          self.add_watch(os.path.join(fldr, d))
+
+  def read_events(self):
+    data = os.read(self.fd, 65536)
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+      offset += EVENT_HEADER.size
+      name = data[offset:offset + length].rstrip(b'\0')
+      offset += length
+      yield wd, mask, os.fsdecode(name)
+
+
+def watch_inotify(root, recursive):
+  inotify = INotify()
+  inotify.add_tree(root, recursive)
+  while True:
+    readable, _, _ = select.select([inotify.fd, sys.stdin], [], [])
+    if sys.stdin in readable and os.read(sys.stdin.fileno(), 4096) == b'':
+      return
+    if inotify.fd not in readable:
+      continue
+    for wd, mask, name in inotify.read_events():
+      if mask & IN_Q_OVERFLOW:
+        emit(mask, root)
+        continue
+      if mask & IN_IGNORED:
+        inotify.watches.pop(wd, None)
+        continue
+      fldr = inotify.watches.get(wd, None)
+      if fldr is None or name == '':
+        continue
+      path = os.path.join(fldr, name)
+      if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        try:
+          inotify.add_tree(path, recursive)
+        except OSError:
+          pass  # Removed again before it could be watched
+      emit(mask, path)
+
+
+def scan(root, recursive):
+  states = {}
+  for fldr, dirs, files in os.walk(root):
+    if not recursive:
+      del dirs[:]
+    for fname in files:
+      path = os.path.join(fldr, fname)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      states[path] = (st.st_size, st.st_mtime)
+  return states
+
+
+def watch_poll(root, recursive):
+  states = scan(root, recursive)
+  while not stdin_closed(POLL_INTERVAL):
+    new_states = scan(root, recursive)
+    for path, state in new_states.items():
+      if states.get(path, None) != state:
+        emit(IN_CLOSE_WRITE, path)
+    states = new_states
+
+
+def main(argv):
+  root = argv[0]
+  recursive = argv[1] == '1'
+  try:
+    watch_inotify(root, recursive)
+  except (AttributeError, OSError) as e:  # No inotify on this platform, or the watch limit is exceeded
+    sys.stderr.write('inotify not available (%s), polling for changes\n' % e)
+    sys.stderr.flush()
+    watch_poll(root, recursive)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv[1:])
+  except (BrokenPipeError, KeyboardInterrupt):
+    pass
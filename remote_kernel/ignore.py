@@ -0,0 +1,210 @@
+"""
+gitignore-style rules to exclude files and folders from synchronization.
+
+Rules are read from the file ``.remote_kernel_syncignore`` in the local sync folder and from the command line, using
+the syntax of ``.gitignore`` files:
+
+- Blank lines and lines starting with ``#`` are ignored.
+- A pattern without a ``/`` (other than a trailing one) matches files and folders with that name at any level, e.g.
+  ``__pycache__`` or ``*.ckpt``. Other patterns are relative to the root of the sync folder, e.g. ``/data`` or
+  ``logs/*.txt``.
+- A trailing ``/`` only matches folders, e.g. ``wandb/``.
+- ``*`` and ``?`` match any characters except ``/``, ``**`` matches any number of folders.
+- A pattern starting with ``!`` includes files that were excluded by a previous pattern. Like git, files in an excluded
+  folder cannot be included again, as excluded folders are not listed at all.
+"""
+import logging
+import os
+import posixpath
+import re
+import shlex
+
+logger = logging.getLogger('remote_kernel.ignore')
+
+IGNORE_FILE = '.remote_kernel_syncignore'
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+def _translate(pattern):
+  """
+  Translate glob ``pattern`` (without leading or trailing '/') to a regular expression.
+  """
+  regex = ''
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+      regex += '(?:.*/)?'
+      i += 3
+      continue
+    elif pattern.startswith('**', i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == '/'):
+      regex += '.*'
+      i += 2
+      continue
+
+    if c == '*':
+      regex += '[^/]*'
+    elif c == '?':
+      regex += '[^/]'
+    elif c == '[':
+      end = pattern.find(']', i + 2)
+      if end == -1:
+        regex += re.escape(c)
+      else:
+        chars = pattern[i + 1:end]
+        if chars[0] in '!^':
+          chars = '^' + chars[1:]
+        regex += '[%s]' % chars.replace('\\', '\\\\')
+        i = end
+    elif c == '\\' and i + 1 < len(pattern):
+      i += 1
+      regex += re.escape(pattern[i])
+    else:
+      regex += re.escape(c)
+    i += 1
+  return regex
+
+
+class _Rule(object):
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self.negate = pattern.startswith('!')
+    if self.negate:
+      pattern = pattern[1:]
+    elif pattern.startswith('\\'):
+      pattern = pattern[1:]  # Escaped leading '!' or '#'
+
+    self.dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    self.anchored = '/' in pattern
+    self.glob = pattern.lstrip('/')
+
+    regex = _translate(self.glob)
+    if not self.anchored:
+      regex = '(?:.*/)?' + regex
+    self.regex = regex
+    self.compiled = re.compile(regex + r'\Z', re.DOTALL)
+
+  def get_find_test(self, root):
+    """
+    Returns the test for the ``find`` command matching the same paths as this rule, or None if the rule cannot be
+    expressed exactly in find syntax.
+    """
+    if not self.anchored:
+      test = '-name %s' % shlex.quote(self.glob)
+    elif '**' not in self.glob and GLOB_CHARS.search(self.glob) is None:
+      # The -path test also matches '/' by '*', so only use it for paths without wildcards
+      test = '-path %s' % shlex.quote(posixpath.join(re.sub(r'([*?\[\]\\])', r'\\\1', root), self.glob))
+    else:
+      return None
+    if self.dir_only:
+      test = '-type d %s' % test
+    return r'\( %s \)' % test
+
+
+class SyncIgnore(object):
+  """
+  Compiled set of gitignore-style rules. Without negated (``!``) patterns, all rules are combined into a single regular
+  expression, so matching a path costs a single regex match regardless of the number of rules.
+
+  :param patterns: Iterable of patterns, in order of increasing precedence
+  """
+  def __init__(self, patterns=()):
+    self.rules = []
+    for pattern in patterns:
+      pattern = pattern.rstrip('\n').rstrip(' ')
+      if pattern == '' or pattern.startswith('#'):
+        continue
+      self.rules.append(_Rule(pattern))
+
+    self._has_negations = any(rule.negate for rule in self.rules)
+    self._file_regex = None
+    self._dir_regex = None
+    if not self._has_negations and len(self.rules) > 0:
+      self._file_regex = self._combine(rule for rule in self.rules if not rule.dir_only)
+      self._dir_regex = self._combine(self.rules)
+
+  def __len__(self):
+    return len(self.rules)
+
+  @classmethod
+  def load(cls, fname, patterns=()):
+    """
+    Load the rules in file ``fname`` (if it exists), followed by ``patterns``, which take precedence.
+    """
+    file_patterns = []
+    if os.path.isfile(fname):
+      with open(fname) as ignore_fs:
+        file_patterns = ignore_fs.readlines()
+    ignore = cls(list(file_patterns) + list(patterns))
+    if len(ignore) > 0:
+      logger.debug('Loaded %i sync ignore rules', len(ignore))
+    return ignore
+
+  def matches(self, path, is_dir=False):
+    """
+    Returns True if ``path`` (relative to the sync folder, using '/' as separator) is excluded by the rules. The parent
+    folders of ``path`` are not checked, see `is_excluded`.
+    """
+    if len(self.rules) == 0:
+      return False
+    if not self._has_negations:
+      regex = self._dir_regex if is_dir else self._file_regex
+      return regex is not None and regex.match(path) is not None
+
+    for rule in reversed(self.rules):
+      if (is_dir or not rule.dir_only) and rule.compiled.match(path) is not None:
+        return not rule.negate
+    return False
+
+  def is_excluded(self, path, is_dir=False):
+    """
+    Returns True if ``path`` or any of its parent folders is excluded by the rules.
+    """
+    if len(self.rules) == 0:
+      return False
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+      if self.matches('/'.join(parts[:i]), True):
+        return True
+    return self.matches(path, is_dir)
+
+  def filter_entries(self, entries):
+    """
+    Remove the excluded entries from ``entries``, a dictionary mapping relative paths to SyncEntry instances, including
+    all entries in excluded folders.
+    """
+    if len(self.rules) == 0:
+      return entries
+
+    excluded_dirs = set()
+    # Sorted, so parent folders are checked before their contents
+    for path in sorted(entries.keys()):
+      is_dir = (entries[path].st_mode & 0o40000) == 0o40000
+      if posixpath.dirname(path) in excluded_dirs or self.matches(path, is_dir):
+        del entries[path]
+        if is_dir:
+          excluded_dirs.add(path)
+    return entries
+
+  def get_find_prune(self, root):
+    """
+    Returns an expression for the ``find`` command that prunes the excluded files and folders below ``root``, e.g.
+    ``\\( -name .git \\) -prune -o``, or an empty string if there are no rules that can be expressed in find syntax.
+    Entries listed by find should still be filtered using `filter_entries`.
+    """
+    if self._has_negations:
+      return ''  # Negated rules may include entries that match a previous rule
+    tests = [rule.get_find_test(root) for rule in self.rules]
+    tests = [test for test in tests if test is not None]
+    if len(tests) == 0:
+      return ''
+    return r'\( %s \) -prune -o' % ' -o '.join(tests)
+
+  @staticmethod
+  def _combine(rules):
+    regexes = [rule.regex for rule in rules]
+    if len(regexes) == 0:
+      return None
+    return re.compile('(?:%s)\\Z' % '|'.join(regexes), re.DOTALL)
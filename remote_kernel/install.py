@@ -8,7 +8,7 @@ from jupyter_core.paths import jupyter_data_dir
 
 from . import CMD_ARGS, get_parser, get_resource_dir
 from .ssh_client import ParamikoClient
-from .sync import ParamikoSync
+from .sync import ParamikoSync, SYNC_ARGS
 
 
 logger = logging.getLogger('remote_kernel.install')
@@ -37,6 +37,8 @@ def install_kernel(kernel_name, ssh_host, **kwargs):
 
   ssh_key = kwargs.get('ssh_key', None)
   jump_server = kwargs.get('jump_server', None)
+  wan_emulation = kwargs.get('wan_emulation', None)
+  control_persist = kwargs.get('control_persist', None)
 
   pre_command = kwargs.get('pre_command', None)
   kernel_cmd = kwargs.get('kernel', 'python -m ipykernel')
@@ -45,7 +47,8 @@ def install_kernel(kernel_name, ssh_host, **kwargs):
   no_remote_files = kwargs.get('no_remote_files', False)
 
   try:
-    with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server) as ssh_client:
+    with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server, wan=wan_emulation,
+                                           control_persist=control_persist) as ssh_client:
       logger.info('Connection to remote server successfull!')
 
       chan = ssh_client.get_transport().open_session()
@@ -84,8 +87,7 @@ def install_kernel(kernel_name, ssh_host, **kwargs):
 
       if kwargs.get('synchronize', False):
         try:
-          synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in kwargs.items() if k in
-                                                     ('local_folder=', 'remote_folder', 'recursive', 'bi_directional')})
+          synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in kwargs.items() if k in SYNC_ARGS})
 
           with synchronizer.connect(skip_check=True):
             synchronizer.check_remote_sync_folder()
@@ -119,12 +121,26 @@ def install_kernel(kernel_name, ssh_host, **kwargs):
           kernel_args += ['-J', j]
       if ssh_key is not None:
         kernel_args += ['-i', ssh_key]
+      if control_persist is not None:
+        kernel_args += ['--control-persist', str(control_persist)]
+      if wan_emulation is not None:
+        kernel_args += ['--wan-emulation', str(wan_emulation)]
       if pre_command is not None:
         kernel_args += ['-pc', pre_command]
       if kernel_cmd != 'python -m ipykernel':
         kernel_args += ['-k', kernel_cmd]
+      if kwargs.get('transport', 'tcp') != 'tcp':
+        kernel_args += ['--transport', kwargs['transport']]
+      if kwargs.get('multiplex', False):
+        kernel_args += ['--multiplex']
+      if kwargs.get('compress', False):
+        kernel_args += ['--compress']
+      if kwargs.get('compress_threshold', 16 << 10) != 16 << 10:
+        kernel_args += ['--compress-threshold', str(kwargs['compress_threshold'])]
       if no_remote_files:
         kernel_args += ['--no-remote-files']
+      if kwargs.get('remote_python', 'python') != 'python':
+        kernel_args += ['--remote-python', kwargs['remote_python']]
       kernel_args += ['-f', '{connection_file}']
 
       # Synchronization config
@@ -138,6 +154,49 @@ def install_kernel(kernel_name, ssh_host, **kwargs):
           kernel_args += ['--local-folder', kwargs['local_folder']]
         if kwargs.get('remote_folder', 'remote_kernel_sync') != 'remote_kernel_sync':
           kernel_args += ['--remote-folder', kwargs['remote_folder']]
+        if kwargs.get('channels', 4) != 4:
+          kernel_args += ['--sync-channels', str(kwargs['channels'])]
+        if kwargs.get('sftp_window', 64) != 64:
+          kernel_args += ['--sftp-window', str(kwargs['sftp_window'])]
+        if kwargs.get('sync_order', 'size') != 'size':
+          kernel_args += ['--sync-order', kwargs['sync_order']]
+        for pattern in kwargs.get('sync_priority', None) or ():
+          kernel_args += ['--sync-priority=%s' % pattern]
+        if kwargs.get('bwlimit', None) is not None:
+          kernel_args += ['--bwlimit', str(kwargs['bwlimit'])]
+        if kwargs.get('delta_threshold', None) is not None:
+          kernel_args += ['--delta-threshold', str(kwargs['delta_threshold'])]
+        if kwargs.get('resume_threshold', 64 << 20) is None:
+          kernel_args += ['--no-resume']
+        elif kwargs.get('resume_threshold', 64 << 20) != 64 << 20:
+          kernel_args += ['--resume-threshold', str(kwargs['resume_threshold'])]
+        if kwargs.get('batch_threshold', None) is not None:
+          kernel_args += ['--batch-threshold', str(kwargs['batch_threshold'])]
+        if kwargs.get('batch_compression', 'gzip') != 'gzip':
+          kernel_args += ['--batch-compression', kwargs['batch_compression']]
+        if kwargs.get('dedup_threshold', None) is not None:
+          kernel_args += ['--dedup-threshold', str(kwargs['dedup_threshold'])]
+        if kwargs.get('lazy_threshold', None) is not None:
+          kernel_args += ['--lazy-threshold', str(kwargs['lazy_threshold'])]
+        if kwargs.get('lazy_cache_size', 10 << 30) != 10 << 30:
+          kernel_args += ['--lazy-cache-size', str(kwargs['lazy_cache_size'])]
+        if kwargs.get('content_hash', False):
+          kernel_args += ['--content-hash']
+        if kwargs.get('sync_interval', None) is not None:
+          kernel_args += ['--sync-interval', str(kwargs['sync_interval'])]
+        if kwargs.get('remote_watch', False):
+          kernel_args += ['--remote-watch']
+        if kwargs.get('sync_debounce', 1.) != 1.:
+          kernel_args += ['--sync-debounce', str(kwargs['sync_debounce'])]
+        for arg in ('sync_metrics', 'sync_metrics_textfile'):
+          if kwargs.get(arg, None) is not None:
+            # The kernel is started from another working directory
+            kernel_args += ['--%s' % arg.replace('_', '-'), os.path.abspath(kwargs[arg])]
+        for pattern in kwargs.get('sync_ignore', None) or ():
+          if pattern.startswith('!'):
+            kernel_args += ['--include=%s' % pattern[1:]]
+          else:
+            kernel_args += ['--exclude=%s' % pattern]
 
       kernel_spec = dict(
         argv=kernel_args,
@@ -0,0 +1,100 @@
+"""
+Local cache of lazily fetched remote files.
+
+Remote files of at least the lazy threshold are not pulled by synchronizations, but recorded as placeholders in the
+manifest. They are fetched on demand (see `ParamikoSync.fetch`) into the local sync folder, which acts as the cache:
+when the fetched files exceed the maximum cache size, the least recently fetched files are removed again, provided
+they were not modified locally, and become placeholders.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('remote_kernel.lazy')
+
+
+class LazyCache(object):
+  """
+  Persistent index of the lazily fetched files in the local sync folder, with their sizes and the time they were last
+  fetched.
+
+  :param fname: File to store the index in. If None, the index is kept in memory only.
+  :param max_size: Maximum total size of the fetched files in bytes
+  """
+  version = 1
+
+  def __init__(self, fname=None, max_size=10 << 30):
+    self.fname = fname
+    self.max_size = max_size
+    # Relative path -> [size, last fetched]
+    self.files = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def load(cls, fname, max_size=10 << 30):
+    cache = cls(fname, max_size)
+    if not os.path.isfile(fname):
+      return cache
+
+    try:
+      with open(fname) as cache_fs:
+        data = json.load(cache_fs)
+    except ValueError:
+      logger.warning('Lazy cache index %s is corrupt, starting with an empty index', fname)
+      return cache
+
+    if data.get('version', None) == cls.version:
+      cache.files = data.get('files', {})
+    logger.debug('Loaded %i entries from lazy cache index %s', len(cache.files), fname)
+    return cache
+
+  def save(self):
+    if self.fname is None:
+      return
+
+    with self._lock:
+      data = dict(version=self.version, files=self.files)
+      tmp_fname = self.fname + '.tmp'
+      with open(tmp_fname, mode='w') as cache_fs:
+        json.dump(data, cache_fs)
+      os.replace(tmp_fname, self.fname)
+
+  @property
+  def size(self):
+    with self._lock:
+      return sum(size for size, fetched in self.files.values())
+
+  def __contains__(self, path):
+    with self._lock:
+      return path in self.files
+
+  def touch(self, path, size):
+    """
+    Record that file ``path`` of ``size`` bytes was fetched (again).
+    """
+    with self._lock:
+      self.files[path] = [size, time.time()]
+
+  def remove(self, path):
+    with self._lock:
+      self.files.pop(path, None)
+
+  def get_evictions(self, keep=()):
+    """
+    Returns the paths of the least recently fetched files that should be removed to bring the cache within its maximum
+    size, excluding the files in ``keep``.
+    """
+    with self._lock:
+      items = sorted(self.files.items(), key=lambda item: item[1][1])
+    total = sum(size for path, (size, fetched) in items)
+    evictions = []
+    for path, (size, fetched) in items:
+      if total <= self.max_size:
+        break
+      if path in keep:
+        continue
+      evictions.append(path)
+      total -= size
+    return evictions
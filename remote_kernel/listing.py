@@ -0,0 +1,254 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import os
+import posixpath
+import shlex
+import stat
+
+logger = logging.getLogger('remote_kernel.listing')
+
+# Single file or folder in a synchronized tree. ``path`` is relative to the root of the tree and uses '/' as separator.
+# Attribute names match those of os.stat_result and paramiko.SFTPAttributes.
+SyncEntry = namedtuple('SyncEntry', ('path', 'st_size', 'st_mode', 'st_mtime', 'st_atime'))
+
+# Format of a single entry in the output of the remote find command. Entries are separated by a NULL character, and
+# the path is the last field, so it may contain any character, including spaces.
+FIND_FORMAT = r'%y %s %m %T@ %A@ %P\0'
+
+# Size of the chunks in which the output of remote listings is read
+READ_SIZE = 1 << 20
+
+# Maximum number of error messages of a remote listing that are logged
+MAX_ERRORS = 10
+
+# Number of SFTP requests for directory entries that are kept in flight while listing a folder
+READ_AHEADS = 16
+
+# Number of threads listing the local tree, and the number of entries stat-ed by each task
+LOCAL_THREADS = 8
+STAT_CHUNK = 256
+
+FIND_TYPES = {
+  'f': stat.S_IFREG,
+  'd': stat.S_IFDIR,
+  'l': stat.S_IFLNK,
+}
+
+
+def get_find_cmd(root, recursive=True, since=None, ignore=None):
+  cmd = 'find %s -mindepth 1' % shlex.quote(root)
+  if not recursive:
+    cmd += ' -maxdepth 1'
+  if ignore is not None:
+    prune = ignore.get_find_prune(root)
+    if prune != '':
+      # Excluded folders are not descended into
+      cmd += ' ' + prune
+  if since is not None:
+    # Only list folders and the files of which the status changed after `since`. Unlike the modified time, the status
+    # change time is also updated when files are moved or copied with preserved timestamps.
+    cmd += r' \( -type d -o -newerct @%i \)' % since
+  # Print the current time on the remote host first, which is used as `since` in the next listing
+  return "date +%%s && %s -printf '%s'" % (cmd, FIND_FORMAT)
+
+
+def parse_find_entry(line):
+  """
+  Parse a single entry printed by the command returned by ``get_find_cmd``.
+
+  :param line: Decoded entry, without the terminating NULL character
+  :return: SyncEntry, or None if the entry is not a regular file, folder or symbolic link.
+  """
+  f_type, size, mode, mtime, atime, path = line.split(' ', 5)
+  if f_type not in FIND_TYPES:
+    return None
+  return SyncEntry(path, int(size), FIND_TYPES[f_type] | int(mode, 8), float(mtime), float(atime))
+
+
+def iter_find_entries(stdout):
+  """
+  Parse the entries printed by the command returned by ``get_find_cmd`` as they are received, so the complete output
+  of a listing of a huge tree is never held in memory.
+
+  :param stdout: Output stream of the remote command
+  :return: Generator yielding a SyncEntry for each listed regular file, folder and symbolic link
+  """
+  pending = b''
+  for data in iter(lambda: stdout.read(READ_SIZE), b''):
+    lines = (pending + data).split(b'\0')
+    pending = lines.pop()  # Incomplete entry, completed by the next chunk
+    for line in lines:
+      if line == b'':
+        continue
+      entry = parse_find_entry(line.decode('utf-8', errors='surrogateescape'))
+      if entry is not None:
+        yield entry
+
+
+def find_listing(ssh_client, root, recursive=True, since=None, ignore=None):
+  """
+  List the remote tree at ``root`` using a single ``find`` command, executed over the exec channel of the SSH
+  connection. This requires only one round trip, regardless of the number of folders in the tree.
+
+  :param ssh_client: Connected paramiko.SSHClient
+  :param root: Absolute path of the remote folder to list
+  :param recursive: If False, only the direct children of ``root`` are listed
+  :param since: Optional remote epoch time. If specified, all folders are listed, but files are only listed if their
+    status changed after this time.
+  :param ignore: Optional SyncIgnore, excluded files and folders are not listed
+  :return: Tuple of a dictionary mapping the relative path to the SyncEntry of each listed file and folder, and the
+    epoch time on the remote host when the listing was started (None if some folders could not be listed).
+  :raises IOError: if the command fails on the remote host without listing any entries, or ``find`` does not support
+    ``-printf``. If only some folders could not be listed, the other entries are returned and the errors are logged.
+  """
+  cmd = get_find_cmd(root, recursive, since, ignore)
+  logger.debug('Listing remote tree using cmd %s', cmd)
+  stdin, stdout, stderr = ssh_client.exec_command(cmd)
+  stdin.close()
+  remote_time = stdout.readline()
+  entries = {entry.path: entry for entry in iter_find_entries(stdout)}
+  exit_status = stdout.channel.recv_exit_status()
+  if exit_status != 0:
+    errors = stderr.read().decode('utf-8', errors='replace').strip().splitlines()
+    # find also fails if some folders could not be read (e.g. permission denied), but still lists all other entries
+    if len(entries) == 0 or any('printf' in error for error in errors):
+      raise IOError('Remote listing failed with exit status %i: %s' % (exit_status, '\n'.join(errors)))
+    logger.warning('Remote listing of %s is incomplete, find failed with exit status %i:\n%s', root, exit_status,
+                   '\n'.join(errors[:MAX_ERRORS] + (['...'] if len(errors) > MAX_ERRORS else [])))
+    # Files changed in the folders that were not listed are only found by a complete listing
+    remote_time = None
+
+  if ignore is not None:
+    ignore.filter_entries(entries)  # Rules that cannot be expressed in find syntax
+  return entries, int(remote_time) if remote_time is not None else None
+
+
+def find_paths_listing(ssh_client, root, paths, folders=()):
+  """
+  List specific entries in the remote tree at ``root`` using find commands, executed over the exec channel of the SSH
+  connection. Used to list the paths that changed, without listing the complete tree.
+
+  :param ssh_client: Connected paramiko.SSHClient
+  :param root: Absolute path of the remote folder to which ``paths`` and ``folders`` are relative
+  :param paths: Relative paths of the files to list. Files that no longer exist are ignored.
+  :param folders: Relative paths of folders of which all contents are listed
+  :return: Dictionary mapping the relative path to the SyncEntry of each listed file and folder
+  """
+  # Print the path including the starting point, which is the relative path prefixed by './'
+  find_format = FIND_FORMAT.replace('%P', '%p')
+  cmds = []
+  for start_points, args in ((paths, ' -maxdepth 0'), (folders, ' -mindepth 1')):
+    start_points = list(start_points)
+    # Split long lists of paths over several commands, to limit the length of the command line
+    for i in range(0, len(start_points), 1000):
+      quoted = ' '.join(shlex.quote('./' + path) for path in start_points[i:i + 1000])
+      cmds.append("find %s%s -printf '%s'" % (quoted, args, find_format))
+  if len(cmds) == 0:
+    return {}
+
+  # Missing paths are not an error, as files may have been removed after they were reported
+  cmd = 'cd %s && { %s; } 2>/dev/null; exit 0' % (shlex.quote(root), '; '.join(cmds))
+  logger.debug('Listing %i remote paths and %i folders', len(paths), len(folders))
+  stdin, stdout, stderr = ssh_client.exec_command(cmd)
+  stdin.close()
+  entries = {}
+  for entry in iter_find_entries(stdout):
+    entry = entry._replace(path=entry.path[2:])  # Strip the './' prefix
+    entries[entry.path] = entry
+  stdout.channel.recv_exit_status()
+  return entries
+
+
+def sftp_listing(sftp_client, root, recursive=True, ignore=None):
+  """
+  List the remote tree at ``root`` using SFTP, requiring one round trip per folder.
+  Arguments are identical to ``find_listing``, but this function always lists all entries and only returns the
+  dictionary of entries.
+  """
+  return {entry.path: entry for entry in iter_sftp_entries(sftp_client, root, recursive, ignore)}
+
+
+def iter_sftp_entries(sftp_client, root, recursive=True, ignore=None):
+  """
+  Generator version of ``sftp_listing``, yielding a SyncEntry for each entry as it is received. The entries of each
+  folder are streamed with a bounded number of requests in flight, so huge folders are never held in memory.
+  """
+  folder_stack = ['']
+  while len(folder_stack) > 0:
+    fldr = folder_stack.pop()
+    for attr in sftp_client.listdir_iter(posixpath.join(root, fldr), read_aheads=READ_AHEADS):
+      path = posixpath.join(fldr, attr.filename)
+      if ignore is not None and ignore.matches(path, stat.S_ISDIR(attr.st_mode)):
+        continue
+      yield SyncEntry(path, attr.st_size, attr.st_mode, attr.st_mtime, attr.st_atime)
+      if recursive and stat.S_ISDIR(attr.st_mode):
+        folder_stack.append(path)
+
+
+def local_listing(root, recursive=True, ignore=None, threads=LOCAL_THREADS):
+  """
+  List the local tree at ``root``. Folders are listed using os.scandir and the entries are stat-ed in chunks, both by a
+  pool of threads, so the latency of each call is overlapped on slow (e.g. network mounted) file systems.
+
+  :param root: Local folder to list
+  :param recursive: If False, only the direct children of ``root`` are listed
+  :param ignore: Optional SyncIgnore, excluded files and folders are not listed and excluded folders are not descended
+    into
+  :param threads: Number of threads listing folders and stat-ing entries
+  :return: Dictionary mapping the relative path (using '/' as separator) to the SyncEntry of each file and folder
+  """
+  entries = {}
+  with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='remote_kernel-scan') as executor:
+    # Future -> relative path of the folder being listed, or None for a chunk of entries being stat-ed
+    futures = {executor.submit(_scan_folder, root, ''): ''}
+    while len(futures) > 0:
+      done, _ = wait(futures, return_when=FIRST_COMPLETED)
+      for future in done:
+        fldr = futures.pop(future)
+        if fldr is not None:
+          try:
+            dir_entries = future.result()
+          except FileNotFoundError:
+            if fldr == '':
+              raise
+            continue  # Removed while the tree was listed
+          for i in range(0, len(dir_entries), STAT_CHUNK):
+            futures[executor.submit(_stat_entries, fldr, dir_entries[i:i + STAT_CHUNK], recursive, ignore)] = None
+        else:
+          found, folders = future.result()
+          entries.update((entry.path, entry) for entry in found)
+          for path in folders:
+            futures[executor.submit(_scan_folder, root, path)] = path
+  return entries
+
+
+def _scan_folder(root, fldr):
+  with os.scandir(os.path.join(root, fldr)) as dir_iter:
+    return list(dir_iter)
+
+
+def _stat_entries(fldr, dir_entries, recursive, ignore):
+  """
+  Returns the SyncEntry instances of ``dir_entries`` (os.DirEntry instances in folder ``fldr``) and the relative paths
+  of the folders among them that should be listed.
+  """
+  found = []
+  folders = []
+  for dir_entry in dir_entries:
+    path = posixpath.join(fldr, dir_entry.name)
+    try:
+      # The type of the entry is known from the listing, so excluded entries are skipped before they are stat-ed
+      if ignore is not None and ignore.matches(path, dir_entry.is_dir()):
+        continue
+      entry = entry_from_stat(path, dir_entry.stat())
+    except OSError:
+      continue  # Removed since it was listed, or a broken symbolic link
+    found.append(entry)
+    if recursive and stat.S_ISDIR(entry.st_mode):
+      folders.append(path)
+  return found, folders
+
+
+def entry_from_stat(path, stat_result):
+  return SyncEntry(path, stat_result.st_size, stat_result.st_mode, stat_result.st_mtime, stat_result.st_atime)
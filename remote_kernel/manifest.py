@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+
+
+class SyncManifest(object):
+  """
+  Persistent record of the state (size and modified time) of each synchronized file on both the local and remote side,
+  as it was observed at the end of the last synchronization. Files of which the state on both sides still matches the
+  manifest need not be compared again.
+
+  The manifest also stores the time on the remote host at which the remote tree was last listed, allowing the next
+  listing to only return entries that changed since then.
+
+  Remote files that are fetched lazily (on demand) are stored as placeholders until they are fetched: the local state
+  of a placeholder is that of the local copy, if any, which is outdated.
+
+  :param fname: File to store the manifest in. If None, the manifest is kept in memory only.
+  """
+  version = 1
+
+  # Number of recent synchronizations of which the throughput is stored
+  max_throughput = 10
+
+  def __init__(self, fname=None):
+    self.logger = logging.getLogger('remote_kernel.manifest')
+    self.fname = fname
+
+    # Relative path -> {'local': [size, mtime] or None, 'remote': [size, mtime] or None, 'hash': str or None}, with
+    # 'placeholder': True for placeholders
+    self.files = {}
+    # Remote epoch time at which the remote tree was last completely synchronized
+    self.remote_time = None
+    # [files, bytes, seconds] transferred by recent synchronizations, oldest first
+    self.throughput = []
+
+    self._lock = threading.Lock()
+
+  @classmethod
+  def load(cls, fname):
+    manifest = cls(fname)
+    if not os.path.isfile(fname):
+      return manifest
+
+    try:
+      with open(fname) as manifest_fs:
+        data = json.load(manifest_fs)
+    except ValueError:
+      manifest.logger.warning('Sync manifest %s is corrupt, starting with an empty manifest', fname)
+      return manifest
+
+    if data.get('version', None) != cls.version:
+      manifest.logger.info('Sync manifest %s has an unsupported version, starting with an empty manifest', fname)
+      return manifest
+
+    manifest.files = data.get('files', {})
+    manifest.remote_time = data.get('remote_time', None)
+    manifest.throughput = data.get('throughput', [])
+    manifest.logger.debug('Loaded %i entries from sync manifest %s', len(manifest.files), fname)
+    return manifest
+
+  def save(self):
+    if self.fname is None:
+      return
+
+    with self._lock:
+      data = dict(version=self.version, remote_time=self.remote_time, throughput=self.throughput, files=self.files)
+      # Write to a temporary file first, so an interrupted write does not corrupt the existing manifest
+      tmp_fname = self.fname + '.tmp'
+      with open(tmp_fname, mode='w') as manifest_fs:
+        json.dump(data, manifest_fs)
+      os.replace(tmp_fname, self.fname)
+    self.logger.debug('Saved %i entries to sync manifest %s', len(self.files), self.fname)
+
+  def clear(self):
+    with self._lock:
+      self.files = {}
+      self.remote_time = None
+
+  def is_unchanged(self, path, local_entry, remote_entry):
+    """
+    Returns True if both the local and the remote state of file ``path`` match the state stored in the manifest.
+    """
+    with self._lock:
+      record = self.files.get(path, None)
+    return (record is not None and
+            not record.get('placeholder', False) and
+            record['local'] == self._state(local_entry) and
+            record['remote'] == self._state(remote_entry))
+
+  def is_local_unchanged(self, path, local_entry):
+    """
+    Returns True if the local state of file ``path`` matches the state stored in the manifest.
+    """
+    with self._lock:
+      record = self.files.get(path, None)
+    return record is not None and record['local'] == self._state(local_entry)
+
+  def update(self, path, local_entry, remote_entry, file_hash=None, placeholder=False):
+    """
+    Store the state of file ``path``. ``local_entry`` and ``remote_entry`` are SyncEntry instances (or None if the
+    file does not exist on that side). If ``placeholder``, the remote file is not fetched until requested.
+    """
+    record = {
+      'local': self._state(local_entry),
+      'remote': self._state(remote_entry),
+      'hash': file_hash
+    }
+    if placeholder:
+      record['placeholder'] = True
+    with self._lock:
+      self.files[path] = record
+
+  def set_placeholder(self, path):
+    """
+    Turn file ``path`` into a placeholder without a local copy, e.g. when the local copy is evicted from the cache.
+    """
+    with self._lock:
+      record = self.files.get(path, None)
+      if record is not None:
+        self.files[path] = dict(record, local=None, placeholder=True)
+
+  def placeholders(self):
+    """
+    Yields tuples of (path, size, mtime) of the remote state of each placeholder.
+    """
+    with self._lock:
+      items = list(self.files.items())
+    for path, record in items:
+      if record.get('placeholder', False) and record['remote'] is not None:
+        yield (path, record['remote'][0], record['remote'][1])
+
+  def get_hash(self, path, remote_entry):
+    """
+    Returns the content hash stored for file ``path``, if the remote state of the file still matches ``remote_entry``.
+    Returns None otherwise, or if no hash was stored.
+    """
+    with self._lock:
+      record = self.files.get(path, None)
+    if record is None or record['remote'] != self._state(remote_entry):
+      return None
+    return record['hash']
+
+  def add_throughput(self, files, size, seconds):
+    """
+    Store the number of files and bytes transferred by a synchronization and the time it took, used to estimate the
+    duration of future synchronizations.
+    """
+    with self._lock:
+      self.throughput = (self.throughput + [[files, size, seconds]])[-self.max_throughput:]
+
+  def prune(self, paths):
+    """
+    Remove the records of files that are not in ``paths``, i.e. that no longer exist on either side.
+    """
+    paths = set(paths)
+    with self._lock:
+      removed = [path for path in self.files if path not in paths]
+      for path in removed:
+        del self.files[path]
+    if removed:
+      self.logger.debug('Removed %i files that no longer exist from the sync manifest', len(removed))
+
+  def remote_states(self):
+    """
+    Yields tuples of (path, size, mtime) for each file with a known remote state.
+    """
+    with self._lock:
+      items = list(self.files.items())
+    for path, record in items:
+      if record['remote'] is not None:
+        yield (path, record['remote'][0], record['remote'][1])
+
+  @staticmethod
+  def _state(entry):
+    if entry is None:
+      return None
+    return [entry.st_size, entry.st_mtime]
@@ -0,0 +1,196 @@
+"""
+Metrics of synchronization runs: counters of the files and bytes transferred, the time spent in each phase (listing,
+comparing, transferring) and histograms of the transferred file sizes and the duration of each transfer.
+
+The metrics of each run can be appended as a JSON line to a file, and written to a file in the Prometheus textfile
+format, to be collected by the textfile collector of the node exporter.
+"""
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('remote_kernel.metrics')
+
+# Upper bounds of the histogram buckets of transferred file sizes (bytes) and transfer durations (seconds)
+SIZE_BUCKETS = (1 << 10, 16 << 10, 256 << 10, 4 << 20, 64 << 20, 1 << 30)
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1., 5., 30., 120.)
+
+
+class Histogram(object):
+  """
+  Histogram with fixed (cumulative) buckets, as used by Prometheus. Thread-safe.
+  """
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.sum = 0
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    with self._lock:
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          self.counts[i] += 1
+      self.count += 1
+      self.sum += value
+
+  def to_dict(self):
+    return OrderedDict((('buckets', OrderedDict(zip([str(b) for b in self.buckets], self.counts))),
+                        ('count', self.count), ('sum', self.sum)))
+
+
+class SyncMetrics(object):
+  """
+  Metrics of a single synchronization run.
+
+  :param trigger: What started the run: 'sync' (a complete synchronization), 'push' or 'pull' (of changed files)
+  """
+  def __init__(self, trigger='sync'):
+    self.trigger = trigger
+    self.started = time.time()
+    self.duration = None
+    # Files and bytes per action, and the statistics of the transfer pool
+    self.counters = Counter()
+    # Phase -> seconds
+    self.timings = OrderedDict()
+    self.file_bytes = Histogram(SIZE_BUCKETS)
+    self.transfer_seconds = Histogram(TIME_BUCKETS)
+
+  @contextmanager
+  def time(self, phase):
+    """
+    Context manager adding the time spent in the block to ``phase``.
+    """
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.timings[phase] = self.timings.get(phase, 0.) + time.time() - started
+
+  def add_plan(self, plan):
+    """
+    Count the actions of SyncPlan ``plan``.
+    """
+    for action in plan:
+      if action.action in ('pull', 'push'):
+        self.counters['files_%sed' % action.action] += 1
+        self.counters['bytes_%sed' % action.action] += action.entry.st_size
+        self.file_bytes.observe(action.entry.st_size)
+      elif action.action == 'mkdir':
+        self.counters['folders_created'] += 1
+      else:
+        self.counters['files_skipped'] += 1
+
+  def finish(self, transfer_stats=None, failed=False):
+    """
+    Complete the metrics at the end of the run, adding the statistics of the TransferPool.
+    """
+    self.duration = time.time() - self.started
+    if transfer_stats is not None:
+      self.counters.update(transfer_stats)
+    if failed:
+      self.counters['errors'] += 1
+
+  @property
+  def files(self):
+    return self.counters['files_pulled'] + self.counters['files_pushed']
+
+  @property
+  def bytes(self):
+    return self.counters['bytes_pulled'] + self.counters['bytes_pushed']
+
+  def get_rates(self):
+    transfer_time = self.timings.get('transfer', 0.)
+    rates = OrderedDict()
+    rates['bytes_per_second'] = self.bytes / transfer_time if transfer_time > 0 else 0.
+    rates['files_per_second'] = self.files / transfer_time if transfer_time > 0 else 0.
+    sftp_files = self.counters['sftp_files']
+    rates['round_trips_per_file'] = self.counters['sftp_round_trips'] / sftp_files if sftp_files > 0 else 0.
+    return rates
+
+  def to_dict(self):
+    return OrderedDict((
+      ('trigger', self.trigger),
+      ('started', self.started),
+      ('duration', self.duration),
+      ('counters', OrderedDict(sorted(self.counters.items()))),
+      ('timings', self.timings),
+      ('rates', self.get_rates()),
+      ('histograms', OrderedDict((('file_bytes', self.file_bytes.to_dict()),
+                                  ('transfer_seconds', self.transfer_seconds.to_dict())))),
+    ))
+
+  def append_json(self, fname, **labels):
+    """
+    Append the metrics as a single JSON line to ``fname``, including ``labels``.
+    """
+    data = OrderedDict(labels)
+    data.update(self.to_dict())
+    with open(fname, mode='a') as metrics_fs:
+      metrics_fs.write(json.dumps(data) + '\n')
+
+
+def write_prometheus(fname, runs, **labels):
+  """
+  Write the metrics of the last run of each trigger to ``fname`` in the Prometheus textfile format. The file is
+  replaced atomically, as required by the textfile collector.
+
+  :param runs: Iterable of SyncMetrics, at most one per trigger
+  :param labels: Labels added to all samples, e.g. the local sync folder
+  """
+  metrics = OrderedDict()  # name -> (type, help, [(labels, value)])
+
+  def add(name, metric_type, help_text, value, **sample_labels):
+    metrics.setdefault(name, (metric_type, help_text, []))[2].append((sample_labels, value))
+
+  for run in runs:
+    base = OrderedDict(labels, trigger=run.trigger)
+    add('remote_kernel_sync_last_run_timestamp_seconds', 'gauge', 'Start time of the last synchronization',
+        run.started, **base)
+    add('remote_kernel_sync_duration_seconds', 'gauge', 'Duration of the last synchronization',
+        run.duration or 0., **base)
+    for phase, seconds in run.timings.items():
+      add('remote_kernel_sync_phase_seconds', 'gauge', 'Time spent in each phase of the last synchronization',
+          seconds, phase=phase, **base)
+    for direction in ('pull', 'push'):
+      add('remote_kernel_sync_files', 'gauge', 'Files transferred by the last synchronization',
+          run.counters['files_%sed' % direction], direction=direction, **base)
+      add('remote_kernel_sync_bytes', 'gauge', 'Bytes transferred by the last synchronization',
+          run.counters['bytes_%sed' % direction], direction=direction, **base)
+    for name, value in sorted(run.counters.items()):
+      if not name.startswith(('files_pu', 'bytes_pu')):
+        add('remote_kernel_sync_%s' % name, 'gauge', 'Counter %s of the last synchronization' % name, value, **base)
+    for name, value in run.get_rates().items():
+      add('remote_kernel_sync_%s' % name, 'gauge', 'Rate %s of the last synchronization' % name, value, **base)
+    for name, histogram in (('file_bytes', run.file_bytes), ('transfer_seconds', run.transfer_seconds)):
+      help_text = 'Histogram of the %s of the last synchronization' % name.replace('_', ' ')
+      name = 'remote_kernel_sync_%s' % name
+      for bound, count in zip(histogram.buckets, histogram.counts):
+        add(name, 'histogram', help_text, count, suffix='_bucket', le=str(bound), **base)
+      add(name, 'histogram', help_text, histogram.count, suffix='_bucket', le='+Inf', **base)
+      add(name, 'histogram', help_text, histogram.count, suffix='_count', **base)
+      add(name, 'histogram', help_text, histogram.sum, suffix='_sum', **base)
+
+  lines = []
+  for name, (metric_type, help_text, samples) in metrics.items():
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    for sample_labels, value in samples:
+      suffix = sample_labels.pop('suffix', '')
+      label_str = ','.join('%s="%s"' % (k, _escape(v)) for k, v in sample_labels.items())
+      lines.append('%s%s{%s} %s' % (name, suffix, label_str, repr(float(value))))
+
+  tmp_fname = fname + '.tmp'
+  with open(tmp_fname, mode='w') as metrics_fs:
+    metrics_fs.write('\n'.join(lines) + '\n')
+  os.replace(tmp_fname, fname)
+  logger.debug('Wrote sync metrics to %s', fname)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
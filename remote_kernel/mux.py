@@ -0,0 +1,152 @@
+"""
+Local side of the multiplexing relay of the kernel sockets (see `helpers.relay`): the connections of the clients to
+the local sockets of the kernel are relayed over the exec channel of the remote relay, which also runs the kernel.
+
+Compared to forwarding each socket (see `forward.PortForwarder`), connecting a client does not open any SSH channels,
+and all sockets share the SSH window of a single channel, which is opened once with the kernel. The relay can compress
+the data received from some of the sockets, e.g. the large rich outputs (plots, HTML tables) on iopub.
+"""
+import logging
+import selectors
+import socket
+import threading
+
+from . import format_size
+from .forward import close_listener, create_listener, format_address
+from .helpers import get_remote_cmd
+from .helpers.relay import COMPRESS_THRESHOLD, get_codecs, Relay
+
+logger = logging.getLogger('remote_kernel.mux')
+
+
+def get_relay_cmd(remote_addresses, command, python='python', compress=(), threshold=COMPRESS_THRESHOLD):
+  """
+  Build the command that runs ``command`` (the kernel) on the remote host, along with a relay to the sockets at
+  ``remote_addresses`` ((host, port) tuples or paths of Unix sockets).
+
+  :param compress: Indices of the remote addresses of which the data is compressed, with a codec available locally
+  :param threshold: Minimum number of bytes to compress at once
+  """
+  args = [format_address(address) for address in remote_addresses] + ['--', command]
+  if compress:
+    args = ['--compress', ','.join(get_codecs()), threshold, ','.join(str(index) for index in compress)] + args
+  return get_remote_cmd('relay', args, python)
+
+
+class _ChannelLink(object):
+  """
+  Link of a relay over a paramiko channel. The channel is left in blocking mode, as its stderr is read by another
+  thread: it is only read or written to when ready.
+  """
+  def __init__(self, channel):
+    self.channel = channel
+
+  def fileno(self):
+    return self.channel.fileno()
+
+  def send_fileno(self):
+    return None  # The SSH window has no file descriptor
+
+  def recv(self, size):
+    if not self.channel.recv_ready() and not self.channel.eof_received and not self.channel.closed:
+      return None  # Only a window adjustment, stderr or a request was received
+    return self.channel.recv(size)
+
+  def send(self, data):
+    if not self.channel.send_ready():
+      return 0  # The SSH window is exhausted
+    sent = self.channel.send(data)
+    if sent == 0:
+      raise EOFError('Channel is closed')
+    return sent
+
+
+class MuxForwarder(object):
+  """
+  Relays connections to local addresses ``local_bind_addresses`` ((host, port) tuples or paths of Unix sockets) over
+  the exec ``channel`` running the command built by `get_relay_cmd`, to the remote address with the same index. The
+  forwarder has the same interface as `forward.PortForwarder`: call `start` to start listening, and `close` to stop.
+  All connections are handled by a single thread.
+  """
+  def __init__(self, channel, local_bind_addresses):
+    self.channel = channel
+    self.local_bind_addresses = list(local_bind_addresses)
+
+    self._relay = None
+    self._listeners = []
+    self._thread = None
+    self._closing = False
+    self._wake_recv, self._wake_send = None, None
+
+  @property
+  def local_bind_ports(self):
+    return [listener.getsockname()[1] for listener in self._listeners
+            if listener.family != getattr(socket, 'AF_UNIX', None)]
+
+  def start(self):
+    if self._thread is not None:
+      return self
+
+    self._relay = Relay(_ChannelLink(self.channel))
+    self._wake_recv, self._wake_send = socket.socketpair()
+    self._wake_recv.setblocking(False)
+    self._relay.selector.register(self._wake_recv, selectors.EVENT_READ, lambda events: self._wake_recv.recv(64))
+    try:
+      for index, local_address in enumerate(self.local_bind_addresses):
+        listener = create_listener(local_address)
+        self._listeners.append(listener)
+        self._relay.selector.register(listener, selectors.EVENT_READ,
+                                      lambda events, listener=listener, index=index: self._accept(listener, index))
+        logger.debug('Relaying %s to remote socket %i', format_address(listener.getsockname()), index)
+    except Exception:
+      self._close_all()
+      for sock in (self._wake_recv, self._wake_send):
+        sock.close()
+      raise
+
+    self._thread = threading.Thread(target=self._run, name='remote_kernel-mux')
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def close(self):
+    if self._thread is None:
+      return
+    self._closing = True
+    self._wake_send.send(b'\0')
+    self._thread.join()
+    self._thread = None
+    for sock in (self._wake_recv, self._wake_send):
+      sock.close()
+
+  def _run(self):
+    try:
+      while not self._closing and not self._relay.link_eof:
+        self._relay.run_once(1.)
+    except (socket.error, EOFError) as e:
+      logger.debug('Relay channel closed (%s)', e)
+    except Exception:
+      logger.error('Relaying the kernel sockets failed', exc_info=True)
+    finally:
+      self._close_all()
+      stats = self._relay.stats
+      if stats['raw_bytes'] > 0:
+        logger.info('Decompressed %s of kernel output to %s (ratio %.1f) in %.3f s',
+                    format_size(stats['compressed_bytes']), format_size(stats['raw_bytes']),
+                    stats['raw_bytes'] / stats['compressed_bytes'], stats['seconds'])
+
+  def _accept(self, listener, index):
+    try:
+      sock, peer = listener.accept()
+    except BlockingIOError:
+      return
+    if sock.family != getattr(socket, 'AF_UNIX', None):
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._relay.open_stream(sock, index)
+
+  def _close_all(self):
+    for listener in self._listeners:
+      close_listener(listener)
+    self._listeners = []
+    if self._relay is not None:
+      self._relay.close()
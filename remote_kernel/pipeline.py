@@ -0,0 +1,317 @@
+"""
+Pipelined SFTP transfers of many files over a single SFTP session.
+
+paramiko's get and put wait for the reply to most requests of a file before sending the next one: opening the file,
+checking its size, closing it and setting its modified time each take a full round trip. For many small files, the
+transfer time is then dominated by the latency of the connection rather than its bandwidth.
+
+A PipelinedTransfer instead sends the requests of many files without waiting for their replies, keeping up to a
+window of requests in flight. The only requests that have to wait are those that need the handle returned when the
+file is opened, so each file takes two round trips, which overlap with those of the other files:
+
+- upload: OPEN, then WRITE..., FSETSTAT (times) and CLOSE
+- download: OPEN, then READ..., followed by CLOSE when all data has been received
+
+Requests on the same handle are processed in order by SFTP servers, so e.g. the times are set after all data has been
+written and the file is closed last.
+"""
+from collections import deque
+import logging
+import os
+
+from paramiko.sftp import (CMD_CLOSE, CMD_DATA, CMD_FSETSTAT, CMD_HANDLE, CMD_OPEN, CMD_READ, CMD_STATUS, CMD_WRITE,
+                           SFTP_EOF, SFTP_FLAG_CREATE, SFTP_FLAG_READ, SFTP_FLAG_TRUNC, SFTP_FLAG_WRITE, SFTP_OK, int64)
+from paramiko.sftp_attr import SFTPAttributes
+
+logger = logging.getLogger('remote_kernel.pipeline')
+
+# Size of single read and write requests, the maximum supported by all common servers
+REQUEST_SIZE = 32768
+
+# Maximum number of files and bytes in a single group of pipelined transfers
+MAX_GROUP_FILES = 256
+MAX_GROUP_BYTES = 64 << 20
+
+
+def split_groups(entries):
+  """
+  Split ``entries`` (SyncEntry instances) into groups of at most MAX_GROUP_FILES files and MAX_GROUP_BYTES bytes, so
+  the groups can be transferred in parallel over several SFTP sessions.
+
+  :return: Generator yielding lists of entries
+  """
+  group = []
+  group_bytes = 0
+  for entry in entries:
+    if len(group) > 0 and (len(group) >= MAX_GROUP_FILES or group_bytes + entry.st_size > MAX_GROUP_BYTES):
+      yield group
+      group = []
+      group_bytes = 0
+    group.append(entry)
+    group_bytes += entry.st_size
+  if len(group) > 0:
+    yield group
+
+
+def _check_status(t, msg):
+  if t != CMD_STATUS:
+    raise IOError('Unexpected SFTP response type %i' % t)
+  code = msg.get_int()
+  if code != SFTP_OK:
+    raise IOError(code, msg.get_text())
+
+
+class _Transfer(object):
+  """
+  State of the transfer of a single file. Instances are registered with the SFTP client as the owner of their
+  requests, so paramiko calls `_async_response` with the reply to each request.
+  """
+  def __init__(self, pipeline, localpath, remotepath, times, callback):
+    self.pipeline = pipeline
+    self.localpath = localpath
+    self.remotepath = remotepath
+    self.times = times
+    self.callback = callback
+
+    self.local_fs = None
+    self.handle = None
+    self.closing = False
+    self.done = False
+    self.error = None
+    # Requests waiting for a reply: request number -> (type, offset, length)
+    self.requests = {}
+    # Number of times the transfer had to wait for replies before it could send further requests
+    self.round_trips = 1
+
+  def start(self):
+    raise NotImplementedError()
+
+  def pump(self, budget):
+    """
+    Send at most ``budget`` requests that do not need to wait for other replies.
+
+    :return: Number of requests sent
+    """
+    try:
+      return self._pump(budget)
+    except Exception as e:
+      self._fail(e)
+      return 1
+
+  def _pump(self, budget):
+    raise NotImplementedError()
+
+  def _on_response(self, t, msg, request):
+    raise NotImplementedError()
+
+  def _request(self, t, *args, offset=0, length=0):
+    num = self.pipeline.sftp_client._async_request(self, t, *args)
+    self.requests[num] = (t, offset, length)
+    self.pipeline.in_flight += 1
+
+  def _async_response(self, t, msg, num):
+    request = self.requests.pop(num)
+    self.pipeline.in_flight -= 1
+    try:
+      if request[0] == CMD_CLOSE:
+        self._finish()
+      elif self.error is None:
+        self._on_response(t, msg, request)
+    except Exception as e:
+      self._fail(e)
+
+  def _open(self, flags):
+    self._request(CMD_OPEN, self.remotepath, flags, SFTPAttributes())
+
+  def _close(self):
+    self.closing = True
+    self._request(CMD_CLOSE, self.handle)
+
+  def _fail(self, error):
+    if self.error is None:
+      logger.debug('Pipelined transfer of %s failed (%s)', self.remotepath, error)
+      self.error = error
+    if self.local_fs is not None:
+      self.local_fs.close()
+    if self.handle is not None and not self.closing:
+      self._close()
+    elif len(self.requests) == 0:
+      self._finish()
+
+  def _finish(self):
+    if len(self.requests) == 0:
+      self.done = True
+      if self.local_fs is not None:
+        self.local_fs.close()
+
+
+class _Put(_Transfer):
+  def start(self):
+    self.local_fs = open(self.localpath, 'rb')
+    self.offset = 0
+    self.eof = False
+    self.setstat_sent = self.times is None
+    self._open(SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC)
+
+  def _pump(self, budget):
+    sent = 0
+    while self.handle is not None and not self.closing and self.error is None and sent < budget:
+      if not self.eof:
+        data = self.local_fs.read(REQUEST_SIZE)
+        if len(data) == 0:
+          self.eof = True
+          continue
+        self._request(CMD_WRITE, self.handle, int64(self.offset), data)
+        self.offset += len(data)
+      elif not self.setstat_sent:
+        attr = SFTPAttributes()
+        attr.st_atime, attr.st_mtime = self.times
+        self._request(CMD_FSETSTAT, self.handle, attr)
+        self.setstat_sent = True
+      else:
+        self._close()
+      sent += 1
+    return sent
+
+  def _on_response(self, t, msg, request):
+    if request[0] == CMD_OPEN:
+      if t != CMD_HANDLE:
+        _check_status(t, msg)
+      self.handle = msg.get_binary()
+      self.round_trips += 1
+    else:
+      _check_status(t, msg)
+
+  def _finish(self):
+    super(_Put, self)._finish()
+    if self.done and self.error is None and self.callback is not None:
+      self.callback()
+
+
+class _Get(_Transfer):
+  def __init__(self, pipeline, localpath, remotepath, size, times, callback):
+    super(_Get, self).__init__(pipeline, localpath, remotepath, times, callback)
+    self.size = size
+
+  def start(self):
+    self.offset = 0
+    # Parts of the file that were not returned by a read and need to be requested again
+    self.missing = deque()
+    self._open(SFTP_FLAG_READ)
+
+  def _pump(self, budget):
+    sent = 0
+    while self.handle is not None and not self.closing and self.error is None and sent < budget:
+      if len(self.missing) > 0:
+        offset, length = self.missing.popleft()
+      elif self.offset < self.size:
+        offset, length = self.offset, min(REQUEST_SIZE, self.size - self.offset)
+        self.offset += length
+      elif len(self.requests) == 0:
+        self._complete()
+        self._close()
+        return sent + 1
+      else:
+        break
+      self._request(CMD_READ, self.handle, int64(offset), length, offset=offset, length=length)
+      sent += 1
+    return sent
+
+  def _on_response(self, t, msg, request):
+    req_type, offset, length = request
+    if req_type == CMD_OPEN:
+      if t != CMD_HANDLE:
+        _check_status(t, msg)
+      self.handle = msg.get_binary()
+      self.local_fs = open(self.localpath, 'wb')
+      self.round_trips += 1
+    elif t == CMD_DATA:
+      data = msg.get_binary()
+      if len(data) == 0:
+        self.size = min(self.size, offset)
+        return
+      self.local_fs.seek(offset)
+      self.local_fs.write(data)
+      if len(data) < length:
+        # Servers may return less data than requested, e.g. when the file is being written
+        if len(self.missing) == 0:
+          self.round_trips += 1
+        self.missing.append((offset + len(data), length - len(data)))
+    elif t == CMD_STATUS and msg.get_int() == SFTP_EOF:
+      # The file was truncated since it was listed, stop reading at its current end
+      self.size = min(self.size, offset)
+      self.missing = deque((o, n) for o, n in self.missing if o < self.size)
+    else:
+      raise IOError('Unexpected response to read of %s' % self.remotepath)
+
+  def _complete(self):
+    self.local_fs.truncate(self.size)
+    self.local_fs.close()
+    self.local_fs = None
+    if self.times is not None:
+      os.utime(self.localpath, self.times)
+    if self.callback is not None:
+      self.callback()
+
+
+class PipelinedTransfer(object):
+  """
+  Transfers many files over a single SFTP session, keeping up to ``window`` requests in flight. Add the transfers using
+  `get` and `put`, then call `run` to transfer all files. The SFTP session should not be used by other threads
+  meanwhile.
+
+  :param sftp_client: paramiko.SFTPClient
+  :param window: Maximum number of requests waiting for a reply
+  """
+  def __init__(self, sftp_client, window=64):
+    self.sftp_client = sftp_client
+    self.window = max(1, window)
+    self.in_flight = 0
+    self.transfers = []
+
+  def get(self, remotepath, localpath, size, times=None, callback=None):
+    """
+    Add a download of ``remotepath`` to ``localpath``. The listed ``size`` of the remote file is used to request all
+    data without waiting for replies. If ``times`` is a tuple of (atime, mtime), these are set on the local file when
+    the download completes. If specified, ``callback()`` is called after a successful download.
+    """
+    self.transfers.append(_Get(self, localpath, remotepath, size, times, callback))
+
+  def put(self, localpath, remotepath, times=None, callback=None):
+    """
+    Add an upload of ``localpath`` to ``remotepath``. If ``times`` is a tuple of (atime, mtime), these are set on the
+    remote file as part of the upload. If specified, ``callback()`` is called after a successful upload.
+    """
+    self.transfers.append(_Put(self, localpath, remotepath, times, callback))
+
+  def run(self):
+    """
+    Transfer all files. Files that fail to transfer are logged and skipped.
+
+    :return: Tuple of the number of round trips waited for by the successful transfers, and the list of local paths of
+      the files that failed to transfer
+    """
+    pending = deque(self.transfers)
+    active = []
+    while len(pending) > 0 or len(active) > 0:
+      # Continue the active transfers first, so their files are completed before more files are opened
+      for transfer in active:
+        if self.in_flight >= self.window:
+          break
+        transfer.pump(self.window - self.in_flight)
+      while len(pending) > 0 and self.in_flight < self.window:
+        transfer = pending.popleft()
+        active.append(transfer)
+        try:
+          transfer.start()
+        except Exception as e:  # e.g. when the local file cannot be read
+          transfer._fail(e)
+
+      if self.in_flight > 0:
+        self.sftp_client._read_response()
+      active = [transfer for transfer in active if not transfer.done]
+      if self.in_flight == 0 and len(active) > 0 and all(transfer.pump(self.window) == 0 for transfer in active):
+        raise RuntimeError('Pipelined transfer stalled')
+
+    failed = [transfer.localpath for transfer in self.transfers if transfer.error is not None]
+    return sum(transfer.round_trips for transfer in self.transfers if transfer.error is None), failed
@@ -0,0 +1,141 @@
+"""
+Plans of synchronizations: the actions that synchronize the local and remote trees, decided before any file is
+transferred, so a synchronization can be inspected (and its duration estimated) without executing it.
+"""
+from collections import Counter, namedtuple
+
+from . import format_size
+
+ACTIONS = ('pull', 'push', 'mkdir', 'skip')
+
+# Transfer methods of pulled and pushed files, in order of display
+METHODS = ('batch', 'pipelined', 'delta', 'resume', 'sftp', 'dedup')
+
+
+class SyncAction(namedtuple('SyncAction', ('action', 'path', 'local_entry', 'remote_entry', 'method', 'reason'))):
+  """
+  Single action of a SyncPlan.
+
+  - ``action``: 'pull', 'push', 'mkdir' (create a remote folder) or 'skip'
+  - ``path``: Relative path of the file or folder
+  - ``local_entry``, ``remote_entry``: SyncEntry of the local and remote file, or None if it does not exist
+  - ``method``: Transfer method of pulled and pushed files, one of METHODS. Pushed files with method 'dedup' are linked
+    to their copy in the remote blob store, or uploaded using another method if they are not in the store yet.
+  - ``reason``: Reason a file is skipped: 'excluded', 'unchanged' (since the last synchronization), 'not newer',
+    'one-directional' (the local file is newer, but local changes are not pushed) or 'lazy' (the remote file is newer,
+    but is fetched on demand)
+  """
+  __slots__ = ()
+
+  @property
+  def entry(self):
+    """
+    SyncEntry of the source of the action.
+    """
+    return self.remote_entry if self.action == 'pull' else self.local_entry
+
+
+class SyncPlan(object):
+  """
+  Ordered list of SyncActions. Folders are ordered before their contents, so executing the actions in order creates
+  the remote folders before files are pushed into them.
+  """
+  def __init__(self):
+    self.actions = []
+
+  def __iter__(self):
+    return iter(self.actions)
+
+  def __len__(self):
+    return len(self.actions)
+
+  def add(self, action, path, local_entry=None, remote_entry=None, method=None, reason=None):
+    self.actions.append(SyncAction(action, path, local_entry, remote_entry, method, reason))
+
+  def get(self, action):
+    """
+    Returns the list of actions of type ``action``.
+    """
+    return [a for a in self.actions if a.action == action]
+
+  @property
+  def transfers(self):
+    return [a for a in self.actions if a.action in ('pull', 'push')]
+
+  @property
+  def transfer_bytes(self):
+    return sum(a.entry.st_size for a in self.transfers)
+
+  def estimate_duration(self, throughput):
+    """
+    Estimate the duration of the transfers in this plan, from the ``throughput`` of recent synchronizations as stored
+    in the SyncManifest. The time of a synchronization is modelled as a cost per file plus a cost per byte, fitted to
+    the recent synchronizations using least squares. If the costs cannot be separated (e.g. when all recent
+    synchronizations transferred similar files), the average throughput in files and bytes is used.
+
+    :param throughput: List of [files, bytes, seconds] of recent synchronizations
+    :return: Estimated duration in seconds, or None if there are no measurements
+    """
+    throughput = [record for record in throughput if record[2] > 0 and record[0] > 0]
+    if len(throughput) == 0:
+      return None
+    files = len(self.transfers)
+    size = self.transfer_bytes
+
+    sff = sum(f * f for f, b, t in throughput)
+    sfb = sum(f * b for f, b, t in throughput)
+    sbb = sum(b * b for f, b, t in throughput)
+    sft = sum(f * t for f, b, t in throughput)
+    sbt = sum(b * t for f, b, t in throughput)
+    det = sff * sbb - sfb * sfb
+    if det > 1e-6 * sff * sbb:
+      per_file = (sbb * sft - sfb * sbt) / det
+      per_byte = (sff * sbt - sfb * sft) / det
+      if per_file >= 0 and per_byte >= 0:
+        return per_file * files + per_byte * size
+
+    total_files = sum(f for f, b, t in throughput)
+    total_bytes = sum(b for f, b, t in throughput)
+    total_time = sum(t for f, b, t in throughput)
+    if total_bytes == 0:
+      return total_time * files / total_files
+    return total_time * (files / total_files + size / total_bytes) / 2
+
+  def format(self, throughput=(), verbose=True):
+    """
+    Returns a human readable description of the plan: one line per pull, push and mkdir action (if ``verbose``),
+    followed by a summary of the number of files and bytes of each action and the estimated duration.
+    """
+    lines = []
+    if verbose:
+      for a in self.actions:
+        if a.action == 'mkdir':
+          lines.append('mkdir  %s' % a.path)
+        elif a.action != 'skip':
+          lines.append('%-5s  %s (%s, %s)' % (a.action, a.path, format_size(a.entry.st_size), a.method))
+
+    for action in ACTIONS:
+      actions = self.get(action)
+      if action == 'mkdir':
+        lines.append('%-5s %7i folders' % (action, len(actions)))
+        continue
+      elif action == 'skip':
+        size = ''
+        counts = sorted(Counter(a.reason for a in actions).items())
+      else:
+        size = format_size(sum(a.entry.st_size for a in actions))
+        methods = Counter(a.method for a in actions)
+        counts = [(method, methods[method]) for method in METHODS if method in methods]
+      lines.append(('%-5s %7i files  %10s  %s' % (action, len(actions), size,
+                                                  ', '.join('%s %i' % count for count in counts))).rstrip())
+
+    duration = self.estimate_duration(throughput)
+    if len(self.transfers) == 0:
+      lines.append('Nothing to transfer')
+    elif duration is None:
+      lines.append('Transferring %s in %i files, no recent synchronizations to estimate the duration from' %
+                   (format_size(self.transfer_bytes), len(self.transfers)))
+    else:
+      lines.append('Transferring %s in %i files, estimated to take %.1f seconds (based on %i recent synchronizations)' %
+                   (format_size(self.transfer_bytes), len(self.transfers), duration, len(throughput)))
+    return '\n'.join(lines)
@@ -0,0 +1,246 @@
+"""
+Resumable transfers of large files over SFTP.
+
+The file is transferred in chunks to a temporary file. After each chunk, a checkpoint is saved in a sidecar file next
+to the local file, containing the state of the source file and the hash of each completed chunk. If the transfer is
+interrupted (e.g. when the connection drops), the next transfer of the same file verifies the completed chunks and
+continues after the last good chunk, provided the source file did not change. When all chunks are transferred, the
+temporary file atomically replaces the destination.
+
+The completed chunks are verified against both the temporary file and the source file. SFTP only reports the modified
+time of remote files in whole seconds, so a remote file rewritten within the same second (with the same size) would
+otherwise be resumed onto stale chunks. The chunks of remote files are hashed on the remote host.
+"""
+import json
+import logging
+import os
+
+from .hashing import remote_chunk_hashes
+from .helpers.delta import TMP_SUFFIX
+from .helpers.hasher import get_algorithms, get_hasher
+
+logger = logging.getLogger('remote_kernel.resume')
+
+CHUNK_SIZE = 8 << 20
+CHECKPOINT_SUFFIX = '.rkcheckpoint'
+
+
+class Checkpoint(object):
+  """
+  Progress of a resumable transfer, stored in ``fname``.
+
+  :param fname: File to store the checkpoint in
+  :param direction: 'get' or 'put'
+  :param source: State of the source file as a list of [size, mtime]
+  """
+  version = 1
+
+  def __init__(self, fname, direction, source, chunk_size=CHUNK_SIZE, algorithm=None):
+    self.fname = fname
+    self.direction = direction
+    self.source = source
+    self.chunk_size = chunk_size
+    self.algorithm = algorithm or get_algorithms()[0]
+    # Hashes of the completed chunks. Chunks are transferred in order, so these cover the start of the file
+    self.chunks = []
+
+  @property
+  def completed(self):
+    return len(self.chunks) * self.chunk_size
+
+  @classmethod
+  def load(cls, fname, direction, source):
+    """
+    Load the checkpoint stored in ``fname``, if it belongs to a transfer in the same ``direction`` of a source file
+    with the same state. Otherwise, a new checkpoint is returned.
+    """
+    checkpoint = cls(fname, direction, source)
+    if not os.path.isfile(fname):
+      return checkpoint
+
+    try:
+      with open(fname) as checkpoint_fs:
+        data = json.load(checkpoint_fs)
+      get_hasher(data['algorithm'])
+    except (KeyError, ValueError):
+      logger.debug('Ignoring invalid checkpoint %s', fname)
+      return checkpoint
+
+    if data.get('version', None) == cls.version and data['direction'] == direction and data['source'] == source:
+      checkpoint.chunk_size = data['chunk_size']
+      checkpoint.algorithm = data['algorithm']
+      checkpoint.chunks = data['chunks']
+    else:
+      logger.debug('Source of checkpoint %s changed, restarting the transfer', fname)
+    return checkpoint
+
+  def save(self):
+    data = dict(version=self.version, direction=self.direction, source=self.source, chunk_size=self.chunk_size,
+                algorithm=self.algorithm, chunks=self.chunks)
+    tmp_fname = self.fname + '.tmp'
+    with open(tmp_fname, mode='w') as checkpoint_fs:
+      json.dump(data, checkpoint_fs)
+    os.replace(tmp_fname, self.fname)
+
+  def remove(self):
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def hash_chunk(self, data):
+    chunk_hash = get_hasher(self.algorithm)()
+    chunk_hash.update(data)
+    return chunk_hash.hexdigest()
+
+  def verify(self, in_fs):
+    """
+    Verify the completed chunks against the data in ``in_fs`` (opened for binary reading), dropping all chunks from the
+    first chunk that does not match.
+
+    :return: Number of bytes verified, i.e. the offset to continue the transfer from
+    """
+    in_fs.seek(0)
+    for idx, chunk_hash in enumerate(self.chunks):
+      data = in_fs.read(self.chunk_size)
+      if len(data) < self.chunk_size or self.hash_chunk(data) != chunk_hash:
+        logger.debug('Chunk %i of %s does not match the checkpoint', idx, self.fname)
+        del self.chunks[idx:]
+        break
+    return self.completed
+
+  def verify_hashes(self, hashes):
+    """
+    Verify the completed chunks against ``hashes``, the hashes of the chunks of the source file, dropping all chunks
+    from the first chunk that does not match.
+
+    :return: Number of bytes verified, i.e. the offset to continue the transfer from
+    """
+    for idx, chunk_hash in enumerate(self.chunks):
+      if idx >= len(hashes) or hashes[idx] != chunk_hash:
+        logger.debug('Chunk %i of the source of %s changed', idx, self.fname)
+        del self.chunks[idx:]
+        break
+    return self.completed
+
+
+def get_resumable(sftp_client, remotepath, localpath, chunk_size=CHUNK_SIZE, ssh_client=None, remote_python='python'):
+  """
+  Download ``remotepath`` to ``localpath``, continuing a previously interrupted download if possible.
+
+  :param ssh_client: Connected paramiko.SSHClient, used to verify the completed chunks against the remote file. If
+    None, or if the chunks cannot be hashed on the remote host, an interrupted download is restarted.
+  :param remote_python: Python interpreter on the remote host, used to hash the chunks
+  :return: Number of bytes that were already downloaded by a previous attempt
+  """
+  remote_stat = sftp_client.stat(remotepath)
+  file_size = remote_stat.st_size
+  tmp_path = localpath + TMP_SUFFIX
+  checkpoint = Checkpoint.load(localpath + CHECKPOINT_SUFFIX, 'get', [file_size, remote_stat.st_mtime])
+  if checkpoint.chunk_size != chunk_size and len(checkpoint.chunks) == 0:
+    checkpoint.chunk_size = chunk_size
+
+  offset = 0
+  if len(checkpoint.chunks) > 0 and os.path.isfile(tmp_path):
+    with open(tmp_path, 'rb') as tmp_fs:
+      offset = checkpoint.verify(tmp_fs)
+  else:
+    checkpoint.chunks = []
+  if offset > 0:
+    try:
+      if ssh_client is None:
+        raise ValueError('No SSH client to hash the remote file')
+      hashes = remote_chunk_hashes(ssh_client, remotepath, checkpoint.algorithm, checkpoint.chunk_size,
+                                   len(checkpoint.chunks), remote_python)
+    except (ValueError, IOError) as e:
+      logger.debug('Cannot verify the completed chunks of %s, restarting the download (%s)', remotepath, e)
+      hashes = []
+    offset = checkpoint.verify_hashes(hashes)
+  resumed = offset
+  if resumed > 0:
+    logger.info('Resuming download of %s at %i of %i bytes', remotepath, offset, file_size)
+
+  with open(tmp_path, 'r+b' if offset > 0 else 'wb') as out_fs:
+    out_fs.seek(offset)
+    out_fs.truncate()
+    with sftp_client.open(remotepath, 'rb') as remote_fs:
+      remote_fs.seek(offset)
+      remote_fs.prefetch(file_size, max_concurrent_requests=64)
+      while offset < file_size:
+        data = remote_fs.read(min(checkpoint.chunk_size, file_size - offset))
+        if not data:
+          raise IOError('Unexpected end of remote file %s' % remotepath)
+        out_fs.write(data)
+        offset += len(data)
+        if len(data) == checkpoint.chunk_size:
+          # Ensure the chunk is stored before it is recorded as completed
+          out_fs.flush()
+          os.fsync(out_fs.fileno())
+          checkpoint.chunks.append(checkpoint.hash_chunk(data))
+          checkpoint.save()
+
+  os.replace(tmp_path, localpath)
+  checkpoint.remove()
+  return resumed
+
+
+def put_resumable(sftp_client, localpath, remotepath, chunk_size=CHUNK_SIZE):
+  """
+  Upload ``localpath`` to ``remotepath``, continuing a previously interrupted upload if possible. The checkpoint is
+  stored next to the local file.
+
+  :return: Number of bytes that were already uploaded by a previous attempt
+  """
+  local_stat = os.stat(localpath)
+  file_size = local_stat.st_size
+  tmp_path = remotepath + TMP_SUFFIX
+  checkpoint = Checkpoint.load(localpath + CHECKPOINT_SUFFIX, 'put', [file_size, local_stat.st_mtime_ns])
+  if checkpoint.chunk_size != chunk_size and len(checkpoint.chunks) == 0:
+    checkpoint.chunk_size = chunk_size
+
+  with open(localpath, 'rb') as in_fs:
+    offset = 0
+    remote_size = 0
+    if len(checkpoint.chunks) > 0:
+      # The chunks were hashed when they were sent, so verify the local file did not change since
+      offset = checkpoint.verify(in_fs)
+      try:
+        remote_size = sftp_client.stat(tmp_path).st_size
+      except IOError:
+        remote_size = 0
+      if remote_size < offset:
+        checkpoint.chunks = []
+        offset = 0
+    resumed = offset
+    if resumed > 0:
+      logger.info('Resuming upload of %s at %i of %i bytes', localpath, offset, file_size)
+
+    with sftp_client.open(tmp_path, 'r+b' if offset > 0 else 'wb') as remote_fs:
+      if remote_size > offset:
+        remote_fs.truncate(offset)  # Remove data of the chunk that was interrupted
+      remote_fs.seek(offset)
+      remote_fs.set_pipelined(True)
+      in_fs.seek(offset)
+      while offset < file_size:
+        data = in_fs.read(checkpoint.chunk_size)
+        if not data:
+          raise IOError('Unexpected end of local file %s' % localpath)
+        remote_fs.write(data)
+        offset += len(data)
+        if len(data) == checkpoint.chunk_size:
+          # The server handles requests in order, so the reply to this stat confirms all writes of this chunk
+          remote_fs.flush()
+          if remote_fs.stat().st_size < offset:
+            raise IOError('Remote file %s is incomplete' % tmp_path)
+          checkpoint.chunks.append(checkpoint.hash_chunk(data))
+          checkpoint.save()
+
+  try:
+    sftp_client.posix_rename(tmp_path, remotepath)
+  except IOError:
+    # posix-rename extension not supported, a regular rename fails if the destination exists
+    try:
+      sftp_client.remove(remotepath)
+    except IOError:
+      pass
+    sftp_client.rename(tmp_path, remotepath)
+  checkpoint.remove()
+  return resumed
@@ -0,0 +1,159 @@
+"""
+Scheduling of the transfers of a synchronization: the order in which they are submitted to the TransferPool, and the
+bandwidth they may use.
+
+Transfers are ordered by priority. Files matching the first priority pattern (gitignore-style, e.g. ``*.ipynb`` or
+``/notebooks``) are transferred first, followed by the files matching the next pattern, and so on, followed by all
+other files. Within each priority, files are transferred in order of size, smallest first, so a large file does not
+hold up many small files queued behind it. Alternatively, they are transferred in order of path.
+
+The bandwidth limit is a token bucket per direction, shared by all SFTP sessions and remote commands of the pool. Data
+is only throttled on the channels of the transfers, so other traffic on the same SSH connection (e.g. the forwarded
+ports of the kernel) is not delayed by the limit, only by the transfers sharing the link.
+"""
+import logging
+import threading
+import time
+
+from paramiko.channel import ChannelFile, ChannelStderrFile
+try:
+  from paramiko.channel import ChannelStdinFile
+except ImportError:  # paramiko < 2.10
+  ChannelStdinFile = ChannelFile
+
+from .ignore import SyncIgnore
+
+logger = logging.getLogger('remote_kernel.schedule')
+
+ORDERS = ('size', 'path')
+
+# Burst of data allowed by the bandwidth limit, in seconds at the limit, and the minimum burst in bytes
+BURST_SECONDS = 0.25
+MIN_BURST = 64 << 10
+
+
+class TransferScheduler(object):
+  """
+  Priorities of transfers, see the module documentation.
+
+  :param patterns: gitignore-style patterns of the files to transfer first, in order of decreasing priority
+  :param order: Order of the transfers within each priority, 'size' (smallest first) or 'path'
+  """
+  def __init__(self, patterns=(), order='size'):
+    if order not in ORDERS:
+      raise ValueError('Unknown transfer order %s, choose from %s' % (order, ', '.join(ORDERS)))
+    self.patterns = list(patterns or ())
+    self.order = order
+    self._rules = [SyncIgnore([pattern]) for pattern in self.patterns]
+
+  def get_rank(self, path):
+    """
+    Returns the index of the first pattern matching ``path``, or the number of patterns if none match.
+    """
+    for rank, rule in enumerate(self._rules):
+      if rule.is_excluded(path):
+        return rank
+    return len(self._rules)
+
+  def get_priority(self, rank, entries):
+    """
+    Returns the sort key of a transfer of the files described by SyncEntry instances ``entries``, all of rank ``rank``.
+    A group of files is scheduled by its largest file, as the files in a group are transferred together.
+    """
+    if self.order == 'size':
+      return rank, max(entry.st_size for entry in entries), entries[0].path
+    return rank, entries[0].path
+
+
+class TokenBucket(object):
+  """
+  Token bucket limiting data to ``rate`` bytes per second, allowing bursts of up to ``burst`` bytes. Threads consume
+  tokens for the data they have transferred, and wait while the bucket is in debt, so the bucket can be shared by any
+  number of threads.
+  """
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = burst if burst is not None else max(MIN_BURST, self.rate * BURST_SECONDS)
+    self.tokens = self.burst
+    self._updated = time.time()
+    self._lock = threading.Lock()
+
+  def consume(self, size):
+    """
+    Take ``size`` tokens from the bucket, and wait until the bucket is no longer in debt.
+
+    :return: Seconds waited
+    """
+    with self._lock:
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      self.tokens -= size
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+
+class BandwidthLimit(object):
+  """
+  Limit of ``rate`` bytes per second in each direction.
+  """
+  def __init__(self, rate):
+    self.rate = rate
+    self.upload = TokenBucket(rate)
+    self.download = TokenBucket(rate)
+
+
+class ThrottledChannel(object):
+  """
+  Wrapper of a paramiko Channel, throttling the data sent and received to ``limit``, a BandwidthLimit. Can be used as
+  the channel of an SFTPClient.
+  """
+  def __init__(self, channel, limit):
+    self.channel = channel
+    self.limit = limit
+
+  def __getattr__(self, item):
+    # Other channel methods (e.g. recv_exit_status) are passed on to the wrapped channel
+    return getattr(self.channel, item)
+
+  def send(self, data):
+    # Consume the tokens after sending, so the burst can be sent without waiting
+    sent = self.channel.send(data[:int(self.limit.upload.burst)])
+    self.limit.upload.consume(sent)
+    return sent
+
+  def sendall(self, data):
+    while len(data) > 0:
+      sent = self.send(data)
+      data = data[sent:]
+
+  def recv(self, size):
+    data = self.channel.recv(size)
+    self.limit.download.consume(len(data))
+    return data
+
+
+class ThrottledClient(object):
+  """
+  Wrapper of a connected paramiko.SSHClient, of which remote commands started by `exec_command` are throttled to
+  ``limit``, a BandwidthLimit. Other methods are passed on to the wrapped client.
+  """
+  def __init__(self, ssh_client, limit):
+    self.ssh_client = ssh_client
+    self.limit = limit
+
+  def __getattr__(self, item):
+    return getattr(self.ssh_client, item)
+
+  def exec_command(self, command):
+    """
+    Execute ``command`` on the remote host, like `paramiko.SSHClient.exec_command`.
+
+    :return: Tuple of the stdin, stdout and stderr of the command
+    """
+    channel = self.ssh_client.get_transport().open_session()
+    channel.exec_command(command)
+    channel = ThrottledChannel(channel, self.limit)
+    return ChannelStdinFile(channel, 'wb'), ChannelFile(channel, 'r'), ChannelStderrFile(channel, 'r')
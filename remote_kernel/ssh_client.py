@@ -1,9 +1,13 @@
 import logging
 import os
 import re
+import socket
 
 import paramiko
-from sshtunnel import SSHTunnelForwarder
+
+from .forward import PortForwarder
+from .mux import MuxForwarder
+from .wan import WANSocket
 
 logger = logging.getLogger('remote_kernel.ssh_client')
 try:
@@ -34,7 +38,7 @@ class ParamikoClient(paramiko.SSHClient):
   def __exit__(self, exc_type, exc_val, exc_tb):
     self.close()
 
-  def connect_override(self, host, pkey=None, jump_host=None, use_jump_pkey=True):
+  def connect_override(self, host, pkey=None, jump_host=None, use_jump_pkey=True, wan=None, control_persist=None):
     """
     Alternative function to connect to SSH client. provides an override to paramiko.SSHClient.connect, with
     fewer arguments.
@@ -45,8 +49,18 @@ class ParamikoClient(paramiko.SSHClient):
       to the jump server. When an item in the list is a ParmikoClient, all subsequent items are ignored.
     :param use_jump_pkey: If True and jump_host is not None, re-use the jump_host.private_key.
         If successful, pkey is ignored.
+    :param wan: Optional WANProfile of network conditions to emulate on the connection to ``host`` (for testing).
+    :param control_persist: If not None, connect through a connection broker (see `remote_kernel.broker`), which keeps
+      the connection open for this many seconds after the last client disconnected. Only used if all jump hosts are
+      strings, falls back to connecting directly if the broker fails.
     :return: None
     """
+    if control_persist is not None and all(isinstance(jump, str) for jump in (jump_host or ())):
+      try:
+        return self.connect_broker(host, pkey, jump_host, control_persist, wan)
+      except Exception as e:
+        logger.warning('Could not connect through the connection broker (%s), connecting directly', e)
+
     if jump_host is not None:
       # First check if jump host is a list/tuple or a single item
       if isinstance(jump_host, (tuple, list)):
@@ -121,7 +135,42 @@ class ParamikoClient(paramiko.SSHClient):
 
       self._jump_host = self._jump_host
 
+    if wan is not None:
+      if jump_channel is None:
+        jump_channel = socket.create_connection((self.host, self.port))
+        jump_channel.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      jump_channel = WANSocket(jump_channel, wan)
+
     self.connect(self.host, self.port, self.username, pwd, self.private_key, sock=jump_channel)
+    sock = self.get_transport().sock
+    if isinstance(sock, socket.socket) and sock.family in (socket.AF_INET, socket.AF_INET6):
+      # Kernel messages are small, do not delay them until the previous packet was acknowledged (Nagle's algorithm)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return self
+
+  def connect_broker(self, host, pkey=None, jump_host=None, control_persist=0., wan=None):
+    """
+    Connect to ``host`` through the connection broker, starting it if needed. Arguments are identical to those of
+    `connect_override`, the jump hosts must be strings.
+    """
+    from . import broker
+
+    if isinstance(jump_host, str):
+      jump_host = [jump_host]
+    sock, header = broker.connect(host, pkey, jump_host, control_persist, wan)
+    self.host = header['host']
+    self.port = header['port']
+    self.username = header['username']
+
+    transport = paramiko.Transport(sock)
+    try:
+      transport.start_client()
+      # The socket of the broker is only accessible by the user, so the broker does not require authentication
+      transport.auth_none(self.username)
+    except Exception:
+      transport.close()
+      raise
+    self._transport = transport
     return self
 
   def close(self):
@@ -136,19 +185,20 @@ class ParamikoClient(paramiko.SSHClient):
       self._jump_host = None
 
   def create_forwarding_tunnel(self, local_bind_addresses, remote_bind_addresses):
-    # Set up the tunnel. Though we pass the target host, port, user and dummy password, these are not used.
-    # This is done to make sure the initialization does not fail (does type checking on the connection args)
-    # Instead, we manually set the transport we get from the existing connection.
-    # This prevents the tunnel from trying to open up a new connection
-
-    # Suppress log output from sshtunnel
-    ssh_logger = logging.getLogger('ssh_tunnel')
-    ssh_logger.addHandler(logging.NullHandler())
-    tunnel = SSHTunnelForwarder((self.host, self.port),
-                                ssh_username=self.username, ssh_password='dummy',
-                                local_bind_addresses=local_bind_addresses,
-                                remote_bind_addresses=remote_bind_addresses,
-                                logger=ssh_logger)
-    tunnel._transport = self.get_transport()
+    """
+    Create a PortForwarder of local addresses ``local_bind_addresses`` to remote addresses ``remote_bind_addresses``
+    (lists of (host, port) tuples or paths of Unix sockets) over the existing connection. The forwarder is closed with
+    this client.
+    """
+    tunnel = PortForwarder(self.get_transport(), local_bind_addresses, remote_bind_addresses)
+    self.tunnels.append(tunnel)
+    return tunnel
+
+  def create_relay_tunnel(self, channel, local_bind_addresses):
+    """
+    Create a MuxForwarder of local addresses ``local_bind_addresses`` over the exec ``channel`` of a relay (see
+    `mux.get_relay_cmd`). The forwarder is closed with this client.
+    """
+    tunnel = MuxForwarder(channel, local_bind_addresses)
     self.tunnels.append(tunnel)
     return tunnel
@@ -1,25 +1,31 @@
 import json
 import logging
 import os
+import posixpath
+import shlex
 import threading
 import time
 
 from jupyter_core.paths import jupyter_runtime_dir
 
 from . import CMD_ARGS, get_parser
+from .helpers.relay import COMPRESS_THRESHOLD
+from .mux import get_relay_cmd
 from .ssh_client import ParamikoClient
-from .sync import ParamikoSync
+from .sync import ParamikoSync, SYNC_ARGS
+from .watch import SyncWorker
 
 
 logger = logging.getLogger('remote_kernel.start')
 
+PORT_NAMES = ('stdin_port', 'shell_port', 'iopub_port', 'hb_port', 'control_port')
 
-def generate_config():
+
+def generate_ports(transport='tcp'):
   """
-  Generate a new kernel connection config dictionary
-  :return: Kernel config dictionary
+  Generate the ports of a kernel connection config: free local ports for the 'tcp' transport, or the suffixes of the
+  socket paths for the 'ipc' transport.
   """
-  from jupyter_client.session import new_id
   import socket
   from contextlib import closing
 
@@ -29,18 +35,62 @@ def generate_config():
       s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
       return s.getsockname()[1]
 
-  return dict(
+  if transport == 'ipc':
+    return {name: i + 1 for i, name in enumerate(PORT_NAMES)}
+  return {name: find_free_port() for name in PORT_NAMES}
+
+
+def generate_config(transport='tcp'):
+  """
+  Generate a new kernel connection config dictionary
+  :param transport: 'tcp' for ports on 127.0.0.1, or 'ipc' for Unix sockets in the Jupyter runtime folder
+  :return: Kernel config dictionary
+  """
+  from jupyter_client.session import new_id
+
+  config = dict(
     ip='127.0.0.1',
     key=new_id(),
     signature_scheme='hmac-sha256',
     kernel_name='',
-    stdin_port=find_free_port(),
-    shell_port=find_free_port(),
-    iopub_port=find_free_port(),
-    hb_port=find_free_port(),
-    control_port=find_free_port(),
-    transport='tcp'
+    transport=transport
   )
+  config.update(generate_ports(transport))
+  if transport == 'ipc':
+    config['ip'] = os.path.join(jupyter_runtime_dir(), 'kernel-%s-ipc' % new_id())
+  return config
+
+
+def get_remote_config(ssh_client, connection_config, transport='tcp'):
+  """
+  Get the connection config of the remote kernel, using ``transport`` for its sockets. The sockets of the local
+  ``connection_config`` are forwarded to these sockets by `get_forwarded_addresses`.
+  """
+  from jupyter_client.session import new_id
+
+  if connection_config.get('transport', 'tcp') == transport == 'tcp':
+    return connection_config  # The same ports on both hosts
+  config = dict(connection_config, transport=transport)
+  if transport == 'ipc':
+    # Sockets with unique names in the home folder, relative paths would depend on the working directory of the kernel
+    sftp_client = ssh_client.open_sftp()
+    try:
+      config['ip'] = posixpath.join(sftp_client.normalize('.'), '.remote_kernel-%s' % new_id())
+    finally:
+      sftp_client.close()
+  elif connection_config.get('transport', 'tcp') == 'ipc':
+    config.update(generate_ports(transport), ip='127.0.0.1')
+  return config
+
+
+def get_forwarded_addresses(connection_config):
+  """
+  Get the addresses of the sockets of ``connection_config``: (host, port) tuples, or the socket paths for the 'ipc'
+  transport.
+  """
+  if connection_config.get('transport', 'tcp') == 'ipc':
+    return ['%s-%i' % (connection_config['ip'], connection_config[name]) for name in PORT_NAMES]
+  return [('localhost', connection_config[name]) for name in PORT_NAMES]
 
 
 def parse_args(argv=None):
@@ -60,7 +110,7 @@ def parse_args(argv=None):
       conn_config = json.load(file_fs)
   else:
     logger.debug('Generating new kernel config')
-    conn_config = generate_config()
+    conn_config = generate_config(arg_dict.get('transport', 'tcp'))
 
   return start_kernel(target, conn_config, **arg_dict)
 
@@ -70,28 +120,34 @@ def start_kernel(ssh_host, connection_config, **kwargs):
 
     ssh_key = kwargs.get('ssh_key', None)
     jump_server = kwargs.get('jump_server', None)
+    wan_emulation = kwargs.get('wan_emulation', None)
+    control_persist = kwargs.get('control_persist', None)
     command = kwargs.get('pre_command', None)
     kernel = kwargs.get('kernel', 'python -m ipykernel')
     no_remote_files = kwargs.get('no_remote_files', False)
-
-    fwd_ports = [('localhost', connection_config[port]) for port in connection_config if port.endswith('_port')]
+    compress = kwargs.get('compress', False)
+    multiplex = kwargs.get('multiplex', False) or compress
 
     kernel_fname = None
+    sync_worker = None
     try:
-      with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server) as ssh_client:
-        tunnel = ssh_client.create_forwarding_tunnel(fwd_ports, fwd_ports.copy())
+      with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server, wan=wan_emulation,
+                                             control_persist=control_persist) as ssh_client:
+        remote_config = get_remote_config(ssh_client, connection_config, kwargs.get('transport', 'tcp'))
+        if not multiplex:
+          tunnel = ssh_client.create_forwarding_tunnel(get_forwarded_addresses(connection_config),
+                                                       get_forwarded_addresses(remote_config))
 
         if no_remote_files:
-          arguments = ' '.join(['%s=%s' % (key, value) for key, value in CMD_ARGS.items()]) % connection_config
+          arguments = ' '.join(['%s=%s' % (key, value) for key, value in CMD_ARGS.items()]) % remote_config
         else:
-          config_str = json.dumps(connection_config, indent=2)
+          config_str = json.dumps(remote_config, indent=2)
           ssh_client.exec_command("echo '%s' > remote_kernel.json" % config_str)
           arguments = '-f ~/remote_kernel.json'
 
         # Setup synchronization if enabled
         if kwargs.get('synchronize', False):
-          synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in kwargs.items() if k in
-                                                     ('local_folder=', 'remote_folder', 'recursive', 'bi_directional')})
+          synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in kwargs.items() if k in SYNC_ARGS})
           synchronizer.set_subfolder(kwargs.get('kernel_name', 'N/A'))
           try:
             with synchronizer.connect() as sync:
@@ -110,9 +166,17 @@ def start_kernel(ssh_host, connection_config, **kwargs):
           ssh_cmd = '%s && %s' % (command, ssh_cmd)
 
         chan = ssh_client.get_transport().open_session()
-        chan.get_pty()
         logger.debug('Excecuting cmd %s', ssh_cmd)
-        chan.exec_command(ssh_cmd)
+        if multiplex:
+          # The relay runs the kernel, the output of the kernel is received on stderr
+          compressed = [PORT_NAMES.index('shell_port'), PORT_NAMES.index('iopub_port')] if compress else ()
+          chan.exec_command(get_relay_cmd(get_forwarded_addresses(remote_config), ssh_cmd,
+                                          kwargs.get('remote_python', 'python'), compressed,
+                                          kwargs.get('compress_threshold', COMPRESS_THRESHOLD)))
+          tunnel = ssh_client.create_relay_tunnel(chan, get_forwarded_addresses(connection_config))
+        else:
+          chan.get_pty()
+          chan.exec_command(ssh_cmd)
 
         try:
           time.sleep(0.5)  # Wait just a bit to allow the IPyKernel to start up
@@ -126,18 +190,24 @@ def start_kernel(ssh_host, connection_config, **kwargs):
           logger.info('Remote Kernel started. To connect another client to this kernel, use:\n\t--existing %s' %
                       os.path.basename(kernel_fname))
 
-          def writeall(sock):
+          def writeall(recv):
             while True:
-              data = sock.recv(4096)
+              data = recv(4096)
               if not data:
                 logger.info("\r\n*** SSH Channel Closed ***\r\n\r\n")
                 break
               logger.info("REMOTE >>> " + data.decode('utf-8').replace('\n', '\nREMOTE >>> '))
 
-          writer = threading.Thread(target=writeall, args=(chan,))
+          writer = threading.Thread(target=writeall, args=(chan.recv_stderr if multiplex else chan.recv,))
           writer.setDaemon(True)
           writer.start()
 
+          if synchronizer is not None and (kwargs.get('sync_interval', None) is not None or
+                                           kwargs.get('remote_watch', False)):
+            sync_worker = SyncWorker(synchronizer, kwargs.get('sync_interval', None), kwargs.get('sync_debounce', 1.),
+                                     kwargs.get('remote_watch', False))
+            sync_worker.start()
+
           while not chan.exit_status_ready():
             time.sleep(1)
 
@@ -146,6 +216,12 @@ def start_kernel(ssh_host, connection_config, **kwargs):
 
         if not no_remote_files:
           ssh_client.exec_command('rm ~/remote_kernel.json')
+        if remote_config['transport'] == 'ipc':
+          # Sockets of the kernel, in case it did not exit cleanly
+          ssh_client.exec_command('rm -f %s-*' % shlex.quote(remote_config['ip']))
+
+        if sync_worker is not None:
+          sync_worker.stop()
 
         if synchronizer is not None:
           try:
@@ -1,10 +1,37 @@
+from contextlib import contextmanager
+import functools
 import json
 import logging
 import os
+import posixpath
+import stat
 import time
 
 from paramiko import SFTP
 
+from . import format_size
+from .batch import get_compressions, split_batches
+from .dedup import BLOB_FOLDER, BlobStore
+from .hashing import HashCache, remote_hashes
+from .helpers.delta import TMP_SUFFIX
+from .helpers.hasher import get_algorithms
+from .ignore import IGNORE_FILE, SyncIgnore
+from .lazy import LazyCache
+from .listing import entry_from_stat, find_listing, find_paths_listing, local_listing, sftp_listing, SyncEntry
+from .manifest import SyncManifest
+from .metrics import SyncMetrics, write_prometheus
+from .pipeline import split_groups
+from .plan import SyncPlan
+from .resume import CHECKPOINT_SUFFIX
+from .schedule import TransferScheduler
+from .transfer import TransferPool
+
+# Keyword arguments parsed by `get_parser` that are passed on to ParamikoSync
+SYNC_ARGS = ('local_folder', 'remote_folder', 'recursive', 'bi_directional', 'channels', 'delta_threshold',
+             'remote_python', 'batch_threshold', 'batch_compression', 'content_hash', 'resume_threshold',
+             'sync_ignore', 'sftp_window', 'sync_metrics', 'sync_metrics_textfile', 'dedup_threshold',
+             'lazy_threshold', 'lazy_cache_size', 'sync_priority', 'sync_order', 'bwlimit')
+
 
 def parse_args(argv=None):
   """
@@ -12,36 +39,83 @@ def parse_args(argv=None):
   starting a remote kernel with synchronization enabled. Argument ``-f`` (connection file) is not allowed.
   Other kernel-specific arguments are ignored. This function does not start a kernel on the remote host.
   Synchronization behaviour is identical to that of the automatic synchronization if added to the kernel definition.
+  With ``--dry-run``, the planned actions and the estimated duration are printed instead. With ``--fetch``, only the
+  given lazily fetched files are fetched, and with ``--list-lazy`` these files are listed.
 
   :param argv: Arguments defining the connection to the remote host and synchronization settings.
   :return: exit code for the process, 0 if successful, 1 otherwise.
   """
   from . import get_parser
-  from .ssh_client import ParamikoClient
 
   logger = logging.getLogger('remote_kernel.manual_sync')
   parser = get_parser(connection_file_arg=False)
+  parser.add_argument('--dry-run', action='store_true',
+                      help='If specified, only print the files that would be transferred and the estimated duration')
+  parser.add_argument('--fetch', action='append', default=None, metavar='PATH',
+                      help='Fetch file (or folder) PATH, relative to the sync folder, instead of synchronizing. Used '
+                           'to fetch remote files that are not synchronized because of --lazy-threshold. Can be '
+                           'specified multiple times.')
+  parser.add_argument('--list-lazy', action='store_true',
+                      help='If specified, list the remote files that are fetched on demand instead of synchronizing')
 
   logger.debug('parsing arguments')
   args = parser.parse_args(argv)
-  arg_dict = args.__dict__.copy()
+
+  try:
+    with connect_from_args(args.__dict__, dry_run=args.dry_run) as sync:
+      if args.list_lazy:
+        for path, size, fetched in sync.list_lazy():
+          print('%-10s %10s  %s' % ('fetched' if fetched else 'remote', format_size(size), path))
+      elif args.fetch is not None:
+        for local_file in sync.fetch(args.fetch):
+          print(local_file)
+      elif args.dry_run:
+        print(sync.sync(dry_run=True).format(sync.manifest.throughput))
+      else:
+        sync.sync()
+  except Exception:
+    logger.error('Error synchronizing files!', exc_info=True)
+    return 1
+
+  return 0
+
+
+@contextmanager
+def connect_from_args(arg_dict, dry_run=False):
+  """
+  Context manager connecting to the remote host and yielding a connected ParamikoSync, using the arguments parsed by
+  `get_parser` in dictionary ``arg_dict``.
+
+  :param dry_run: If True, the sync folders and the sub-folder of the kernel are not created (see `set_subfolder`)
+  """
+  from .ssh_client import ParamikoClient
 
   ssh_host = arg_dict['target']
   ssh_key = arg_dict.get('ssh_key', None)
   jump_server = arg_dict.get('jump_server', None)
+  wan_emulation = arg_dict.get('wan_emulation', None)
+  control_persist = arg_dict.get('control_persist', None)
 
-  with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server) as ssh_client:
-    synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in arg_dict.items() if k in
-                                               ('local_folder=', 'remote_folder', 'recursive', 'bi_directional')})
-    synchronizer.set_subfolder(arg_dict.get('kernel_name', 'N/A'))
-    try:
-      with synchronizer.connect() as sync:
-        sync.sync()
-    except Exception:
-      logger.error('Error synchronizing files!', exc_info=True)
-      return 1
+  with ParamikoClient().connect_override(ssh_host, ssh_key, jump_server, wan=wan_emulation,
+                                         control_persist=control_persist) as ssh_client:
+    synchronizer = ParamikoSync(ssh_client, **{k: v for k, v in arg_dict.items() if k in SYNC_ARGS})
+    synchronizer.set_subfolder(arg_dict.get('kernel_name', 'N/A'), dry_run)
+    with synchronizer.connect(dry_run=dry_run) as sync:
+      yield sync
 
-  return 0
+
+def fetch(kernel_name, paths):
+  """
+  Fetch remote files ``paths`` (relative to the sync folder) of installed kernel ``kernel_name``, e.g. files that are
+  not synchronized because of ``--lazy-threshold``. Folders are fetched including all their files.
+
+  :return: List of the local paths of the fetched files
+  """
+  from . import get_parser, get_spec
+
+  args = get_parser(connection_file_arg=False).parse_args(get_spec([kernel_name]))
+  with connect_from_args(args.__dict__) as sync:
+    return sync.fetch(paths)
 
 
 class ParamikoSync(object):
@@ -49,12 +123,73 @@ class ParamikoSync(object):
                local_folder='./remote_kernel_sync',
                remote_folder='./remote_kernel_sync',
                recursive=True,
-               bi_directional=False):
+               bi_directional=False,
+               channels=4,
+               delta_threshold=None,
+               remote_python='python',
+               batch_threshold=None,
+               batch_compression='gzip',
+               content_hash=False,
+               resume_threshold=64 << 20,
+               sync_ignore=None,
+               sftp_window=64,
+               sync_metrics=None,
+               sync_metrics_textfile=None,
+               dedup_threshold=None,
+               lazy_threshold=None,
+               lazy_cache_size=10 << 30,
+               sync_priority=None,
+               sync_order='size',
+               bwlimit=None):
     self.logger = logging.getLogger('remote_kernel.sync')
 
     self.ssh_client = ssh_client
     self.sftp_client = None
 
+    # Pool of SFTP sessions on the same transport, used to transfer files in parallel
+    self.channels = channels
+    self.transfers = None
+    # Maximum number of SFTP requests in flight per session. Other files are transferred in groups, pipelining the
+    # requests of all files in a group (0 to transfer files one at a time)
+    self.sftp_window = sftp_window
+    # Order in which the transfers are submitted to the pool, and the bandwidth they may use (None for unlimited)
+    self.scheduler = TransferScheduler(sync_priority, sync_order)
+    self.bwlimit = bwlimit
+
+    # Files of at least this size that exist on both sides are updated using delta transfers (None to disable)
+    self.delta_threshold = delta_threshold
+    self.remote_python = remote_python
+
+    # Files smaller than this size are transferred in batches, as a single tar stream (None to disable)
+    self.batch_threshold = batch_threshold
+    if batch_compression == 'none':
+      batch_compression = None
+    if batch_compression not in get_compressions():
+      self.logger.warning('Compression %s is not available, using gzip instead', batch_compression)
+      batch_compression = 'gzip'
+    self.batch_compression = batch_compression
+
+    # Files of at least this size are transferred in chunks, so interrupted transfers can be resumed (None to disable)
+    self.resume_threshold = resume_threshold
+
+    # Pushed files of at least this size are deduplicated between the sync subfolders of different kernels, using a
+    # content-addressed store in the remote root sync folder (None to disable). Requires a subfolder to be set.
+    self.dedup_threshold = dedup_threshold
+    self.blob_store = None
+    # Remote path -> (SyncEntry, blob) of pushed files to add to the blob store, and those that were uploaded
+    self._blob_uploads = {}
+    self._uploaded_blobs = []
+
+    # Remote files of at least this size are not pulled, but fetched on demand using `fetch` (None to pull all files).
+    # Fetched files are kept up to a total size of lazy_cache_size.
+    self.lazy_threshold = lazy_threshold
+    self.lazy_cache = LazyCache(max_size=lazy_cache_size)
+
+    # If True, files of the same size are compared by their content hashes instead of only their modified times
+    self.content_hash = content_hash
+    self.hash_algorithm = get_algorithms()[0]
+    self.hash_cache = HashCache()
+
     self.local_folder = os.path.abspath(local_folder)
     self.logger.debug('Normalized local path to %s', self.local_folder)
     self.remote_folder = remote_folder
@@ -69,9 +204,28 @@ class ParamikoSync(object):
     # Files that should be excluded during synchronization
     self.excluded_files = {'.remote_kernel_sync'}  # config file to allow separate subfolders
 
+    # gitignore-style rules from IGNORE_FILE in the local sync folder, followed by the patterns passed as arguments
+    self.sync_ignore = list(sync_ignore or ())
+    self.ignore = None
+    self.load_ignore()
+
+    # Remote trees are listed using a single find command, unless the remote shell does not support it
+    self._use_find = True
+
+    # State of the synchronized files after the last synchronization. Only persisted if a subfolder is set.
+    self.manifest = SyncManifest()
+
     # Epoch time of last synchronization
     self._last_sync = 0
 
+    # Files to which the metrics of each synchronization are appended as JSON lines, and written in the Prometheus
+    # text format (None to disable)
+    self.sync_metrics = sync_metrics
+    self.sync_metrics_textfile = sync_metrics_textfile
+    # SyncMetrics of the running synchronization, and of the last synchronization of each trigger
+    self.metrics = None
+    self.last_metrics = {}
+
   def __del__(self):
     self.logger.debug('Finalizing ParamikoSync instance')
     self.close()  # Ensure the connection is closed
@@ -84,50 +238,87 @@ class ParamikoSync(object):
   def __exit__(self, exc_type, exc_val, exc_tb):
     self.close()
 
-  def connect(self, skip_check=False):
+  def connect(self, skip_check=False, dry_run=False):
+    """
+    Open the SFTP client and check that the sync folders exist, creating them if needed.
+
+    :param skip_check: If True, the sync folders are not checked
+    :param dry_run: If True, missing sync folders are not created
+    """
     if self.sftp_client is None:
       self.logger.debug('Starting SFTP client')
       self.sftp_client = SFTP.from_transport(self.ssh_client.get_transport())
+      self.transfers = TransferPool(self.ssh_client, self.channels, remote_python=self.remote_python,
+                                    window=self.sftp_window or 64, bwlimit=self.bwlimit)
 
       if not self._is_folder_checked and not skip_check:
-        self.check_local_sync_folders()
-        self.check_remote_sync_folder()
-        self._is_folder_checked = True
+        local_exists = self.check_local_sync_folders(create=not dry_run)
+        remote_exists = self.check_remote_sync_folder(create=not dry_run)
+        self._is_folder_checked = local_exists and remote_exists
 
     return self
 
   def close(self):
+    if self.transfers is not None:
+      self.transfers.close()
+      self.transfers = None
     if self.sftp_client:
       self.logger.debug('Closing SFTP Client')
       self.sftp_client.close()
       self.sftp_client = None
 
-  def check_local_sync_folders(self):
+  def check_local_sync_folders(self, create=True):
+    """
+    Returns True if the local sync folder exists. If ``create`` is True, a missing folder is created.
+    """
     if not os.path.isdir(self.local_folder):
+      if not create:
+        return False
       self.logger.info('Creating local sync directory %s', self.local_folder)
       os.makedirs(self.local_folder)
+    return True
 
-  def check_remote_sync_folder(self):
+  def check_remote_sync_folder(self, create=True):
+    """
+    Returns True if the remote sync folder exists. If ``create`` is True, a missing folder is created.
+    """
     if self.sftp_client is None:
       self.logger.warning('This ParamikoSync instance has been closed')
-      return
+      return False
 
-    self.remote_folder = self.sftp_client.normalize(self.remote_folder)
-    self.logger.debug('Normalized remote path to %s', self.remote_folder)
+    try:
+      self.remote_folder = self.sftp_client.normalize(self.remote_folder)
+      self.logger.debug('Normalized remote path to %s', self.remote_folder)
+    except IOError:
+      if not create:
+        return False  # Some servers cannot normalize paths that do not exist
+      raise
 
-    remote_dirname = os.path.dirname(self.remote_folder)
-    remote_basename = os.path.basename(self.remote_folder)
-    remote_dirs = {entry.filename: entry for entry in self.sftp_client.listdir_attr(remote_dirname)}
+    # Stat the folder itself, rather than listing its parent folder, which may contain many entries
+    try:
+      is_dir = self._isdir(self.sftp_client.stat(self.remote_folder))
+    except IOError:
+      is_dir = False
 
     # Ensure the folder structure in the sync folder is copied
-    if remote_basename not in remote_dirs.keys() or not self._isdir(remote_dirs[remote_basename]):
+    if not is_dir:
+      if not create:
+        return False
       self.logger.info('Creating remote sync directory %s', self.remote_folder)
       self.sftp_client.mkdir(self.remote_folder)
+    return True
 
   def get_chdir_cmd(self):
     return 'cd "%s"' % self.remote_folder
 
-  def set_subfolder(self, kernel_name):
+  def set_subfolder(self, kernel_name, dry_run=False):
+    """
+    Use the remote sub-folder of the sync folder of kernel ``kernel_name``, which is stored in the config file in the
+    local sync folder. New kernels are assigned the first unused number as sub-folder, which is created.
+
+    :param dry_run: If True, nothing is created on either host, and the config file is not written. The sub-folder
+      of a new kernel is only determined.
+    """
     local_config = os.path.join(self.local_folder, '.remote_kernel_sync')
     if os.path.isfile(local_config):
       with open(local_config) as conf_fs:
@@ -137,112 +328,838 @@ class ParamikoSync(object):
 
     kernel_config = config.get(kernel_name, None)
     if kernel_config is None:
-      with self.connect():  # This connection ensures local and remote root folders are created
-        remote_folders = self._get_remote_dirs()
+      with self.connect(dry_run=dry_run):  # This connection ensures local and remote root folders are created
+        try:
+          remote_folders = self._get_remote_dirs()
+        except IOError:
+          if not dry_run:
+            raise
+          remote_folders = []  # The remote sync folder does not exist yet
         i = 1
         while str(i) in remote_folders:
           i += 1
         self.remote_folder = self._unix_join(self.remote_folder, str(i))
-        self.logger.info('Creating synchronization sub-folder %s', self.remote_folder)
-        self.sftp_client.mkdir(self.remote_folder)
-      config[kernel_name] = {'remote_kernel_id': str(i)}
-      with open(local_config, mode='w') as out_fs:
-        json.dump(config, out_fs)
+        if dry_run:
+          self.logger.info('Synchronization sub-folder %s does not exist yet', self.remote_folder)
+        else:
+          self.logger.info('Creating synchronization sub-folder %s', self.remote_folder)
+          self.sftp_client.mkdir(self.remote_folder)
+      kernel_config = {'remote_kernel_id': str(i)}
+      if not dry_run:
+        config[kernel_name] = kernel_config
+        with open(local_config, mode='w') as out_fs:
+          json.dump(config, out_fs)
     else:
       self.remote_folder = self._unix_join(self.remote_folder, kernel_config['remote_kernel_id'])
 
+    if self.dedup_threshold is not None:
+      # The store is shared by the subfolders of all kernels, and is not synchronized itself
+      self.blob_store = BlobStore(self.ssh_client, self._unix_join(posixpath.dirname(self.remote_folder), BLOB_FOLDER),
+                                  self.remote_python)
+
+    # Load the manifest of the previous synchronization of this subfolder
+    manifest_name = '.remote_kernel_manifest-%s.json' % kernel_config['remote_kernel_id']
+    self.excluded_files.update((manifest_name, manifest_name + '.tmp'))
+    self.manifest = SyncManifest.load(os.path.join(self.local_folder, manifest_name))
+
+    if self.lazy_threshold is not None:
+      cache_name = '.remote_kernel_cache-%s.json' % kernel_config['remote_kernel_id']
+      self.excluded_files.update((cache_name, cache_name + '.tmp'))
+      self.lazy_cache = LazyCache.load(os.path.join(self.local_folder, cache_name), self.lazy_cache.max_size)
+
+    if self.content_hash or self.blob_store is not None:
+      cache_name = '.remote_kernel_hashes-%s.json' % kernel_config['remote_kernel_id']
+      self.excluded_files.update((cache_name, cache_name + '.tmp'))
+      self.hash_cache = HashCache.load(os.path.join(self.local_folder, cache_name))
+
+  def load_ignore(self):
+    """
+    (Re)load the rules that exclude files and folders from synchronization. Excluded folders are not listed at all, on
+    either side.
+    """
+    self.ignore = SyncIgnore.load(os.path.join(self.local_folder, IGNORE_FILE), self.sync_ignore)
+
+  def _remote_isdir(self, path):
+    try:
+      return self._isdir(self.sftp_client.stat(path))
+    except IOError:
+      return False
+
   def _get_remote_dirs(self, folder='.'):
     return [
       entry.filename
-      for entry in self.sftp_client.listdir_attr(self._unix_join(self.remote_folder, folder))
+      for entry in self.sftp_client.listdir_iter(self._unix_join(self.remote_folder, folder))
       if self._isdir(entry)
     ]
 
-  def sync(self):
+  def sync(self, dry_run=False):
+    """
+    Synchronize the local and remote sync folders: list both trees, plan the actions that synchronize them (see
+    `plan`) and execute the plan.
+
+    :param dry_run: If True, only the plan is made. Nothing is transferred and the manifest is not saved.
+    :return: The executed SyncPlan
+    """
     if self.sftp_client is None:
       self.logger.warning('This ParamikoSync instance has been closed')
       return
 
-    self._sync_remote_folder()
-    if self.bi_directional:
-      self._sync_local_folder()
+    self.load_ignore()
+    metrics = SyncMetrics('sync')
+    with metrics.time('list_remote'):
+      if dry_run and not self._remote_isdir(self.remote_folder):
+        remote_entries, remote_time = {}, None  # Not created by a dry run, see `set_subfolder`
+      else:
+        remote_entries, remote_time = self._list_remote()
+    with metrics.time('list_local'):
+      if dry_run and not os.path.isdir(self.local_folder):
+        local_entries = {}
+      else:
+        local_entries = local_listing(self.local_folder, self.recursive, self.ignore)
+    if dry_run:
+      self._compare_hashes(remote_entries, local_entries)
+      return self.plan(remote_entries, local_entries)
+
+    self.transfers.start()
+    self._start_metrics(metrics)
+    completed = False
+    try:
+      with metrics.time('compare_hashes'):
+        self._compare_hashes(remote_entries, local_entries)
+      with metrics.time('plan'):
+        plan = self.plan(remote_entries, local_entries)
+      self.logger.info('Synchronizing remote folder %s to local folder %s', self.remote_folder, self.local_folder)
+      if self.bi_directional:
+        self.logger.info('Synchronizing local folder %s to remote folder %s', self.local_folder, self.remote_folder)
+      self.execute(plan)
+
+      # Store the state of files that are not transferred, so they do not need to be compared in the next sync
+      for action in plan.get('skip'):
+        if action.reason in ('not newer', 'one-directional'):
+          self.manifest.update(action.path, action.local_entry, action.remote_entry)
+
+      # Only advance the listing time when all files were synchronized successfully
+      self.manifest.remote_time = remote_time
+      self.manifest.prune(set(local_entries.keys()) | set(remote_entries.keys()))
+      self.hash_cache.prune(local_entries.keys())
+      completed = True
+    finally:
+      self.manifest.save()
+      self.hash_cache.save()
+      self._finish_metrics(completed)
+      self._log_stats()
     self._last_sync = time.time()
+    return plan
+
+  def push_files(self, paths):
+    """
+    Push local files ``paths`` (relative to the local sync folder, using '/' as separator) to the remote, if they
+    changed since the last synchronization and are newer than the remote version. Only the given files (and their
+    parent folders) are compared, so the local and remote trees need not be listed.
+    Used to push local changes as they occur, regardless of the direction of the synchronization.
+    """
+    if self.sftp_client is None:
+      self.logger.warning('This ParamikoSync instance has been closed')
+      return
+
+    # Skip excluded files (e.g. the manifest, which is written by the synchronization itself)
+    paths = [path for path in paths
+             if (self.recursive or '/' not in path) and self._is_synced_file(path, {}, {}) and
+             not self.ignore.is_excluded(path)]
+    if len(paths) == 0:
+      return
+
+    self.transfers.start()
+    metrics = self._start_metrics(SyncMetrics('push'))
+    completed = False
+    local_entries = {}
+    remote_entries = {}
+    for path in paths:
+      # Include the parent folders, so they are created on the remote if needed
+      parts = path.split('/')
+      for i in range(1, len(parts) + 1):
+        entry_path = '/'.join(parts[:i])
+        if entry_path in local_entries:
+          continue
+        try:
+          local_entries[entry_path] = entry_from_stat(entry_path, os.stat(os.path.join(self.local_folder, entry_path)))
+        except OSError:
+          break  # Removed since the change was detected
+        try:
+          attr = self.sftp_client.stat(self._unix_join(self.remote_folder, entry_path))
+        except IOError:
+          continue  # Does not exist on the remote
+        remote_entries[entry_path] = SyncEntry(entry_path, attr.st_size, attr.st_mode, attr.st_mtime, attr.st_atime)
+
+    metrics.timings['list_remote'] = time.time() - metrics.started
+    try:
+      with metrics.time('compare_hashes'):
+        self._compare_hashes(remote_entries, local_entries)
+      with metrics.time('plan'):
+        plan = self.plan(remote_entries, local_entries, pull=False, push=True)
+      self.execute(plan)
+      completed = True
+    finally:
+      self.manifest.save()
+      self.hash_cache.save()
+      self._finish_metrics(completed)
+      self._log_stats()
+
+  def pull_files(self, paths, folders=()):
+    """
+    Retrieve remote files ``paths`` (relative to the remote sync folder) and all files in remote folders ``folders``,
+    if they changed since the last synchronization and are newer than the local version. Only the given paths are
+    listed on the remote, so the remote tree need not be listed completely.
+    Used to retrieve remote changes reported by a `RemoteWatcher`.
+    """
+    if self.sftp_client is None:
+      self.logger.warning('This ParamikoSync instance has been closed')
+      return
+
+    paths = [path for path in paths if self._is_synced_file(path, {}, {}) and not self.ignore.is_excluded(path)]
+    folders = [fldr for fldr in folders if not self.ignore.is_excluded(fldr, True)]
+    if len(paths) == 0 and len(folders) == 0:
+      return
+
+    self.transfers.start()
+    metrics = self._start_metrics(SyncMetrics('pull'))
+    completed = False
+    if self._use_find:
+      remote_entries = self.ignore.filter_entries(
+        find_paths_listing(self.ssh_client, self.remote_folder, paths, folders))
+    else:
+      # New folders are listed in the next complete synchronization
+      remote_entries = {}
+      for path in paths:
+        try:
+          attr = self.sftp_client.stat(self._unix_join(self.remote_folder, path))
+        except IOError:
+          continue  # Removed since the change was reported
+        remote_entries[path] = SyncEntry(path, attr.st_size, attr.st_mode, attr.st_mtime, attr.st_atime)
 
-  def _sync_local_folder(self, folder='.'):
-    self.logger.info('Synchronizing local folder %s to remote folder %s',
-                     self._unix_join(self.local_folder, folder), self.remote_folder)
-    folder_stack = [folder]
-
-    while len(folder_stack) > 0:
-      fldr = folder_stack.pop()
-
-      entries = os.listdir(os.path.join(self.local_folder, fldr))
-      remote_entries = {entry.filename: entry for entry in
-                        self.sftp_client.listdir_attr(self._unix_join(self.remote_folder, fldr))}
-
-      for entry in entries:
-        entry_path = self._unix_join(fldr, entry)
-        entry_stat = os.stat(os.path.join(self.local_folder, entry_path))
-
-        if self._isdir(entry_stat):
-          if self.recursive:
-            # Ensure the folder structure in the sync folder is copied
-            if entry not in remote_entries.keys() or not self._isdir(remote_entries[entry]):
-              self.sftp_client.mkdir(self._unix_join(self.remote_folder, entry_path))
-
-            folder_stack.append(entry_path)
-        elif entry in self.excluded_files or entry_stat.st_mtime < self._last_sync:
-          continue  # Excluded or unchanged since last sync, skip
-        else:  # This file should be synced!
-          # Compare to the local version if it exists
-          remote_file = remote_entries.get(entry, None)
-          remote_mtime = 0
-          if remote_file is not None:
-            remote_mtime = remote_file.st_mtime
-
-          if int(entry_stat.st_mtime) > int(remote_mtime):
-            dest_file = self._unix_join(self.remote_folder, entry_path)
-            self.logger.debug('local mtime %s, remote mtime %s', int(entry_stat.st_mtime), int(remote_mtime))
-            self.logger.info('Pushing file %s to the remote', entry_path)
-            self.sftp_client.put(os.path.join(self.local_folder, entry_path), dest_file)
-            self.sftp_client.utime(dest_file, (entry_stat.st_atime, entry_stat.st_mtime))
-
-  def _sync_remote_folder(self, folder='.'):
-    self.logger.info('Synchronizing remote folder %s to local folder %s',
-                     self._unix_join(self.remote_folder, folder), self.local_folder)
-    folder_stack = [folder]
-
-    while len(folder_stack) > 0:
-      fldr = folder_stack.pop()
-      entries = self.sftp_client.listdir_attr(self._unix_join(self.remote_folder, fldr))
-
-      for entry in entries:
-        entry_path = self._unix_join(fldr, entry.filename)
+    local_entries = {}
+    for path in list(remote_entries.keys()):
+      if not self.recursive and '/' in path:
+        del remote_entries[path]
+        continue
+      local_file = os.path.join(self.local_folder, path)
+      if os.path.exists(local_file):
+        local_entries[path] = entry_from_stat(path, os.stat(local_file))
+    metrics.timings['list_remote'] = time.time() - metrics.started
+
+    try:
+      with metrics.time('compare_hashes'):
+        self._compare_hashes(remote_entries, local_entries)
+      with metrics.time('plan'):
+        plan = self.plan(remote_entries, local_entries, pull=True, push=False)
+      self.execute(plan)
+      completed = True
+    finally:
+      self.manifest.save()
+      self.hash_cache.save()
+      self._finish_metrics(completed)
+      self._log_stats()
+
+  def fetch(self, paths):
+    """
+    Fetch remote files ``paths`` (relative to the sync folders, using '/' as separator) on demand, e.g. files that are
+    not pulled by synchronizations because they are larger than the lazy threshold. A path of a folder fetches all
+    lazily fetched files in that folder. Files are only transferred if the local copy is outdated (and not modified
+    since it was fetched).
+
+    Fetched files are added to the lazy cache. If the cache exceeds its maximum size, the least recently fetched files
+    that were not modified locally are removed and become placeholders again.
+
+    :return: List of the local paths of the fetched files
+    """
+    if self.sftp_client is None:
+      self.logger.warning('This ParamikoSync instance has been closed')
+      return []
+
+    lazy_paths = [path for path, size, fetched in self.list_lazy()]
+    fetch_paths = set()
+    for path in paths:
+      path = path.replace(os.sep, '/').strip('/')
+      in_folder = [p for p in lazy_paths if p.startswith(path + '/')]
+      if len(in_folder) > 0:
+        fetch_paths.update(in_folder)
+      elif self._is_synced_file(path, {}, {}):
+        fetch_paths.add(path)
+
+    self.transfers.start()
+    metrics = self._start_metrics(SyncMetrics('fetch'))
+    completed = False
+    plan = SyncPlan()
+    fetched = []
+    for path in sorted(fetch_paths):
+      try:
+        attr = self.sftp_client.stat(self._unix_join(self.remote_folder, path))
+      except IOError:
+        self.logger.warning('Remote file %s does not exist', path)
+        continue
+      remote_entry = SyncEntry(path, attr.st_size, attr.st_mode, attr.st_mtime, attr.st_atime)
+      if self._isdir(remote_entry):
+        self.logger.warning('Remote path %s is a folder without files to fetch', path)
+        continue
+      local_file = os.path.join(self.local_folder, path)
+      local_entry = entry_from_stat(path, os.stat(local_file)) if os.path.isfile(local_file) else None
+      if local_entry is not None and self.manifest.is_unchanged(path, local_entry, remote_entry):
+        self.logger.debug('File %s is up to date', path)
+      elif local_entry is not None and not self._is_newer(remote_entry.st_mtime, local_entry.st_mtime):
+        self.logger.warning('Not fetching file %s, the local file is newer', path)
+      else:
+        plan.add('pull', path, local_entry, remote_entry, self._get_method(remote_entry, local_entry))
+      fetched.append(path)
+      if self.lazy_threshold is not None:
+        self.lazy_cache.touch(path, remote_entry.st_size)
+    metrics.timings['list_remote'] = time.time() - metrics.started
+
+    try:
+      self.execute(plan)
+      completed = True
+    finally:
+      self.manifest.save()
+      self._finish_metrics(completed)
+      self._log_stats()
+      if self.lazy_threshold is not None:
+        self._evict_lazy(keep=fetched)
+        self.lazy_cache.save()
+        self.manifest.save()
+    return [os.path.join(self.local_folder, path) for path in fetched]
+
+  def list_lazy(self):
+    """
+    Returns a sorted list of (path, size, fetched) of the files that are fetched on demand, where ``fetched`` is True
+    if the file is in the lazy cache.
+    """
+    files = {path: (size, False) for path, size, mtime in self.manifest.placeholders()}
+    for path, (size, fetched) in self.lazy_cache.files.items():
+      if path not in files:
+        files[path] = (size, True)
+    return [(path, size, fetched) for path, (size, fetched) in sorted(files.items())]
+
+  def _evict_lazy(self, keep=()):
+    """
+    Remove the least recently fetched files from the lazy cache until it is within its maximum size. Files that were
+    modified locally are kept (and no longer managed by the cache), as removing them would lose the changes.
+    """
+    for path in self.lazy_cache.get_evictions(keep):
+      self.lazy_cache.remove(path)
+      local_file = os.path.join(self.local_folder, path)
+      try:
+        local_entry = entry_from_stat(path, os.stat(local_file))
+      except OSError:
+        self.manifest.set_placeholder(path)
+        continue  # Already removed
+      if not self.manifest.is_local_unchanged(path, local_entry):
+        self.logger.info('Keeping file %s in the lazy cache, it was modified locally', path)
+        continue
+      self.logger.info('Removing file %s from the lazy cache', path)
+      os.remove(local_file)
+      self.manifest.set_placeholder(path)
+
+  def _list_remote(self):
+    """
+    List all files and folders in the remote sync folder. Uses a single remote ``find`` command if possible, falling
+    back to a folder-by-folder SFTP listing if the remote shell cannot run it.
+
+    If the manifest contains the remote time of a previous synchronization, the find command only lists folders and
+    files that changed since then. The state of unchanged files is then taken from the manifest.
+
+    :return: Tuple of a dictionary mapping relative paths to SyncEntry, and the remote epoch time of the listing (None
+      if the listing was done using SFTP, or some folders could not be listed)
+    """
+    if self._use_find:
+      try:
+        since = self.manifest.remote_time
+        if since is not None:
+          since -= 2  # Allow for file systems with a coarse timestamp resolution
+        entries, remote_time = find_listing(self.ssh_client, self.remote_folder, self.recursive, since, self.ignore)
+        if since is not None:
+          self._add_unchanged_remote_files(entries, since)
+        return entries, remote_time
+      except Exception as e:
+        self.logger.info('Remote find listing not available, falling back to SFTP listing (%s)', e)
+        self._use_find = False
+    return sftp_listing(self.sftp_client, self.remote_folder, self.recursive, self.ignore), None
+
+  def _add_unchanged_remote_files(self, entries, since):
+    """
+    Add the files of the manifest that were not listed by an incremental listing (of the changes after remote time
+    ``since``) to ``entries``, if they still exist.
+    """
+    candidates = []
+    for path, size, mtime in self.manifest.remote_states():
+      if path in entries:
+        continue
+      # Folders are always listed, so if the parent folder is not listed, the file has been removed along with it
+      parent = posixpath.dirname(path)
+      if parent != '' and parent not in entries:
+        continue
+      if self.ignore.matches(path):
+        continue  # Excluded since the previous synchronization
+      candidates.append((path, size, mtime))
+
+    # Removing or renaming a file modifies its folder, so only the files in folders modified since the previous
+    # listing may be gone. These are listed in a single batch, as are the files in the root folder, which is not listed.
+    check = [path for path, size, mtime in candidates
+             if posixpath.dirname(path) == '' or entries[posixpath.dirname(path)].st_mtime >= since]
+    existing = find_paths_listing(self.ssh_client, self.remote_folder, check) if check else {}
+    check = set(check)
+
+    added = 0
+    for path, size, mtime in candidates:
+      if path not in check:
+        entries[path] = SyncEntry(path, size, stat.S_IFREG, mtime, mtime)
+      elif path in existing:
+        entries[path] = existing[path]
+      else:
+        continue  # Removed or renamed since the previous synchronization
+      added += 1
+    self.logger.debug('Remote listing returned %i entries, added %i unchanged files from the manifest',
+                      len(entries) - added, added)
+
+  def _is_synced_file(self, entry_path, local_entries, remote_entries):
+    fname = posixpath.basename(entry_path)
+    if fname in self.excluded_files or fname.endswith(TMP_SUFFIX):  # Excluded, or an incomplete transfer
+      return False
+    if fname.endswith(CHECKPOINT_SUFFIX) or fname.endswith(CHECKPOINT_SUFFIX + '.tmp'):  # Progress of a transfer
+      return False
+    for entry in (local_entries.get(entry_path, None), remote_entries.get(entry_path, None)):
+      if entry is not None and self._isdir(entry):
+        return False
+    return True
+
+  def plan(self, remote_entries, local_entries, pull=True, push=None):
+    """
+    Plan the actions that synchronize the trees listed in ``local_entries`` and ``remote_entries``. Files that changed
+    since the last synchronization are pulled if the remote file is newer and (if ``push``) pushed if the local file is
+    newer. Remote folders are created for pushed files. All other files are skipped, with the reason why.
+
+    :param pull: If True, newer remote files are pulled
+    :param push: If True, newer local files are pushed. Defaults to the direction of the synchronization.
+    :return: SyncPlan
+    """
+    if push is None:
+      push = self.bi_directional
+    plan = SyncPlan()
+    planned = set()
+
+    if pull:
+      for entry_path, entry in sorted(remote_entries.items()):
+        local_entry = local_entries.get(entry_path, None)
+        if self._isdir(entry) or not self._is_synced_file(entry_path, local_entries, remote_entries):
+          continue  # Folder or excluded
+        elif local_entry is not None and self.manifest.is_unchanged(entry_path, local_entry, entry):
+          continue  # Unchanged since last sync
+        elif self._is_newer(entry.st_mtime, 0 if local_entry is None else local_entry.st_mtime):
+          if self._use_lazy(entry):
+            plan.add('skip', entry_path, local_entry, entry, reason='lazy')
+          else:
+            plan.add('pull', entry_path, local_entry, entry, self._get_method(entry, local_entry))
+          planned.add(entry_path)
+
+    if push:
+      # Entries are sorted, so parent folders are created before their contents
+      for entry_path, entry in sorted(local_entries.items()):
+        remote_entry = remote_entries.get(entry_path, None)
         if self._isdir(entry):
-          if self.recursive:
-            folder_stack.append(entry_path)
-        elif entry in self.excluded_files or entry.st_mtime < self._last_sync:
-          continue  # Excluded or unchanged since last sync, skip
-        else:  # This file should be synced!
-          # Compare to the local version if it exists
-          local_file = os.path.join(self.local_folder, entry_path)
-          local_mtime = 0
-          if os.path.isfile(local_file):
-            local_mtime = os.stat(local_file).st_mtime
-
-          if int(entry.st_mtime) > int(local_mtime):
-            # Ensure the destination directory exists
-            dest_dir = os.path.join(self.local_folder, fldr)
-            if not os.path.isdir(dest_dir):
-              os.makedirs(dest_dir)
-
-            # Get the file
-            self.logger.debug('local mtime %s, remote mtime %s', int(local_mtime), int(entry.st_mtime))
-            self.logger.info('Getting file %s from the remote', entry_path)
-            self.sftp_client.get(self._unix_join(self.remote_folder, entry_path), local_file)
-
-            # Set the local file's modified time to the modified time on the server
-            os.utime(local_file, (entry.st_atime, entry.st_mtime))
+          # Ensure the folder structure in the sync folder is copied
+          if remote_entry is None or not self._isdir(remote_entry):
+            plan.add('mkdir', entry_path, entry, remote_entry)
+        elif entry_path in planned or not self._is_synced_file(entry_path, local_entries, remote_entries):
+          continue  # Excluded or pulled from the remote
+        elif self.manifest.is_unchanged(entry_path, entry, remote_entry):
+          continue  # Unchanged since last sync
+        elif self._is_newer(entry.st_mtime, 0 if remote_entry is None else remote_entry.st_mtime):
+          method = 'dedup' if self._use_dedup(entry) else self._get_method(entry, remote_entry)
+          plan.add('push', entry_path, entry, remote_entry, method)
+          planned.add(entry_path)
+
+    for entry_path in sorted(set(remote_entries.keys()) | set(local_entries.keys())):
+      local_entry = local_entries.get(entry_path, None)
+      remote_entry = remote_entries.get(entry_path, None)
+      if entry_path in planned or any(e is not None and self._isdir(e) for e in (local_entry, remote_entry)):
+        continue
+      if not self._is_synced_file(entry_path, local_entries, remote_entries):
+        reason = 'excluded'
+      elif self.manifest.is_unchanged(entry_path, local_entry, remote_entry):
+        reason = 'unchanged'
+      elif (not push and local_entry is not None and
+            self._is_newer(local_entry.st_mtime, 0 if remote_entry is None else remote_entry.st_mtime)):
+        reason = 'one-directional'
+      else:
+        reason = 'not newer'
+      plan.add('skip', entry_path, local_entry, remote_entry, reason=reason)
+    return plan
+
+  def execute(self, plan):
+    """
+    Execute the pull, push and mkdir actions of ``plan``, and wait until all transfers have completed. Transfers are
+    submitted to the pool in order of their priority (see `TransferScheduler`). The manifest is updated as files are
+    transferred. The throughput is stored in the manifest, to estimate the duration of future
+    synchronizations, and the actions and timings are added to the metrics of the running synchronization.
+    """
+    started = time.time()
+    if self.metrics is not None:
+      self.metrics.add_plan(plan)
+    # (action, method, rank) -> SyncEntry instances of the files transferred in batches or pipelined groups
+    grouped = {}
+    # Tuples of (priority, transfer function, arguments, keyword arguments), submitted in order of priority
+    jobs = []
+    # Create the remote folders first, so deduplicated files can be linked into them
+    for action in plan.get('mkdir'):
+      self.sftp_client.mkdir(self._unix_join(self.remote_folder, action.path))
+    # Remote paths of deduplicated files that were linked to a blob, and need not be uploaded
+    linked = self._link_blobs(plan)
+
+    for action in plan:
+      entry_path = action.path
+      local_file = os.path.join(self.local_folder, entry_path)
+      remote_file = self._unix_join(self.remote_folder, entry_path)
+      if action.action == 'pull':
+        entry = action.remote_entry
+        # Ensure the destination directory exists
+        dest_dir = os.path.dirname(local_file)
+        if not os.path.isdir(dest_dir):
+          os.makedirs(dest_dir)
+
+        # Get the file, the local file's modified time is set to the modified time on the server
+        self.logger.debug('local mtime %s, remote mtime %s',
+                          int(action.local_entry.st_mtime) if action.local_entry else 0, int(entry.st_mtime))
+        self.logger.info('Getting file %s from the remote', entry_path)
+        rank = self.scheduler.get_rank(entry_path)
+        if action.method in ('batch', 'pipelined'):
+          grouped.setdefault(('pull', action.method, rank), []).append(entry)
+          continue
+        transfer = {
+          'delta': self.transfers.get_delta,
+          'resume': self.transfers.get_resumable,
+          'sftp': self.transfers.get,
+        }[action.method]
+        jobs.append((self.scheduler.get_priority(rank, [entry]), transfer, (remote_file, local_file),
+                     dict(times=(entry.st_atime, entry.st_mtime),
+                          callback=functools.partial(self._on_retrieved, entry))))
+      elif action.action == 'skip' and action.reason == 'lazy':
+        self.logger.debug('Not pulling file %s, it is fetched on demand', entry_path)
+        self.manifest.update(entry_path, action.local_entry, action.remote_entry, placeholder=True)
+      elif action.action == 'push':
+        entry = action.local_entry
+        self.logger.debug('local mtime %s, remote mtime %s',
+                          int(entry.st_mtime), int(action.remote_entry.st_mtime) if action.remote_entry else 0)
+        if remote_file in linked:
+          continue
+        self.logger.info('Pushing file %s to the remote', entry_path)
+        method = action.method
+        if method == 'dedup':
+          # Not in the blob store yet, upload the file and add it to the store afterwards
+          method = self._get_method(entry, action.remote_entry)
+        rank = self.scheduler.get_rank(entry_path)
+        if method in ('batch', 'pipelined'):
+          grouped.setdefault(('push', method, rank), []).append(entry)
+          continue
+        transfer = {
+          'delta': self.transfers.put_delta,
+          'resume': self.transfers.put_resumable,
+          'sftp': self.transfers.put,
+        }[method]
+        jobs.append((self.scheduler.get_priority(rank, [entry]), transfer, (local_file, remote_file),
+                     dict(times=(entry.st_atime, entry.st_mtime),
+                          callback=functools.partial(self._on_pushed, entry))))
+
+    for (direction, method, rank), group in grouped.items():
+      # Files are transferred in the order of the group, and split into groups in that order
+      group.sort(key=lambda entry: self.scheduler.get_priority(rank, [entry]))
+      if direction == 'pull':
+        roots, callback = (self.remote_folder, self.local_folder), self._on_retrieved
+      else:
+        roots, callback = (self.local_folder, self.remote_folder), self._on_pushed
+      if method == 'batch':
+        transfer = self.transfers.get_batch if direction == 'pull' else self.transfers.put_batch
+        for compression, entries in split_batches(group, self.batch_compression):
+          jobs.append((self.scheduler.get_priority(rank, entries), transfer, roots + (entries, compression, callback),
+                       {}))
+      else:
+        transfer = self.transfers.get_pipelined if direction == 'pull' else self.transfers.put_pipelined
+        for entries in split_groups(group):
+          jobs.append((self.scheduler.get_priority(rank, entries), transfer, roots + (entries, callback), {}))
+
+    # Sorted by priority only, transfers of equal priority are submitted in the order of the plan
+    for priority, transfer, args, kwargs in sorted(jobs, key=lambda job: job[0]):
+      transfer(*args, **kwargs)
+
+    try:
+      self.transfers.join()
+    finally:
+      self._store_blobs()
+    duration = time.time() - started
+    if self.metrics is not None:
+      self.metrics.timings['transfer'] = self.metrics.timings.get('transfer', 0.) + duration
+    if len(plan.transfers) > 0:
+      self.manifest.add_throughput(len(plan.transfers), plan.transfer_bytes, duration)
+
+  def _get_method(self, entry, dest_entry):
+    """
+    Returns the method used to transfer the file of ``entry`` to the destination, of which ``dest_entry`` is the
+    current state (None if it does not exist).
+    """
+    if self._use_batch(entry):
+      return 'batch'
+    elif self._use_delta(entry, dest_entry):
+      return 'delta'
+    elif self._use_resume(entry):
+      return 'resume'
+    elif self.sftp_window:
+      return 'pipelined'
+    return 'sftp'
+
+  def _link_blobs(self, plan):
+    """
+    Prepare the deduplicated pushes of ``plan``: files whose content is in the blob store are linked to their blob
+    instead of being uploaded, the others are uploaded and added to the store by `_store_blobs`. Remote files that are
+    linked to a blob are removed before they are replaced by an upload, so the blob is not modified.
+
+    :return: Set of the remote paths of the files that were linked
+    """
+    self._blob_uploads = {}
+    self._uploaded_blobs = []
+    if self.blob_store is None:
+      return set()
+
+    requests = []
+    entries = {}
+    for action in plan.get('push'):
+      remote_file = self._unix_join(self.remote_folder, action.path)
+      if action.method == 'dedup':
+        file_hash = self.hash_cache.get_hash(self.local_folder, action.path, self.hash_algorithm)
+        if file_hash is None:
+          continue  # Removed since it was listed, the upload fails as well
+        blob = self.blob_store.get_blob(self.hash_algorithm, file_hash)
+        entries[remote_file] = (action.local_entry, blob)
+        requests.append(('link', blob, remote_file))
+      elif action.remote_entry is not None and action.method in ('batch', 'pipelined', 'sftp'):
+        # Delta and resumable transfers replace the remote file instead of writing to it
+        requests.append(('unshare', '-', remote_file))
+    if len(requests) == 0:
+      return set()
+
+    try:
+      results = self.blob_store.run(requests)
+    except Exception as e:
+      self.logger.warning('Blob store not available (%s), uploading all files', e)
+      self.blob_store = None
+      return set()
+
+    linked = set()
+    linked_bytes = 0
+    for remote_file, (entry, blob) in entries.items():
+      status, size, mtime = results.get(remote_file, ('error', 0, 0))
+      if status == 'linked':
+        self.logger.info('Linking file %s to its copy in the remote blob store', entry.path)
+        self.manifest.update(entry.path, entry, SyncEntry(entry.path, size, stat.S_IFREG, mtime, mtime),
+                             '%s:%s' % (self.hash_algorithm, blob.rsplit('/', 1)[1]))
+        linked.add(remote_file)
+        linked_bytes += size
+      elif status == 'missing':
+        self._blob_uploads[remote_file] = (entry, blob)
+    self.transfers.count(dedup_files=len(linked), dedup_bytes=linked_bytes)
+    return linked
+
+  def _store_blobs(self):
+    """
+    Add the deduplicated files that were uploaded by `execute` to the blob store.
+    """
+    uploaded = [(remote_file, self._blob_uploads[remote_file]) for remote_file in self._uploaded_blobs]
+    self._blob_uploads = {}
+    self._uploaded_blobs = []
+    if self.blob_store is None or len(uploaded) == 0:
+      return
+
+    try:
+      results = self.blob_store.run([('store', blob, remote_file) for remote_file, (entry, blob) in uploaded])
+    except Exception as e:
+      self.logger.warning('Failed to add the uploaded files to the blob store (%s)', e)
+      return
+    for remote_file, (entry, blob) in uploaded:
+      status, size, mtime = results.get(remote_file, ('error', 0, 0))
+      if status == 'stored':
+        self.manifest.update(entry.path, entry, SyncEntry(entry.path, size, stat.S_IFREG, mtime, mtime),
+                             '%s:%s' % (self.hash_algorithm, blob.rsplit('/', 1)[1]))
+
+  def _compare_hashes(self, remote_entries, local_entries):
+    """
+    In content hash mode, compare the hashes of files that exist on both sides with the same size and that changed
+    since the last synchronization. Files with identical contents are stored in the manifest as unchanged, so they are
+    not transferred, regardless of their modified times.
+
+    Local hashes are cached, remote hashes are computed on the remote host with one command per batch of files. If only
+    the local file changed, it is compared to the hash stored in the manifest instead.
+    """
+    if not self.content_hash:
+      return
+
+    candidates = []
+    for entry_path, local_entry in local_entries.items():
+      remote_entry = remote_entries.get(entry_path, None)
+      if (remote_entry is not None and
+          stat.S_ISREG(local_entry.st_mode) and stat.S_ISREG(remote_entry.st_mode) and
+          local_entry.st_size == remote_entry.st_size and
+          self._is_synced_file(entry_path, local_entries, remote_entries) and
+          not self.manifest.is_unchanged(entry_path, local_entry, remote_entry)):
+        candidates.append(entry_path)
+    if len(candidates) == 0:
+      return
+
+    while True:
+      prefix = self.hash_algorithm + ':'
+      hashes = {}
+      for entry_path in candidates:
+        known_hash = self.manifest.get_hash(entry_path, remote_entries[entry_path])
+        if known_hash is not None and known_hash.startswith(prefix):
+          hashes[entry_path] = known_hash[len(prefix):]
+      try:
+        hashes.update(remote_hashes(self.ssh_client, self.remote_folder,
+                                    [entry_path for entry_path in candidates if entry_path not in hashes],
+                                    self.hash_algorithm, self.remote_python))
+        break
+      except ValueError as e:
+        if self.hash_algorithm == 'blake2b':
+          raise
+        self.logger.info('%s, using blake2b instead', e)
+        self.hash_algorithm = 'blake2b'
+      except Exception as e:
+        self.logger.warning('Remote hashing failed (%s), comparing modified times only', e)
+        self.content_hash = False
+        return
+
+    identical = 0
+    for entry_path in candidates:
+      remote_hash = hashes.get(entry_path, None)
+      if remote_hash is None:
+        continue  # Removed on the remote
+      if self.hash_cache.get_hash(self.local_folder, entry_path, self.hash_algorithm) == remote_hash:
+        self.manifest.update(entry_path, local_entries[entry_path], remote_entries[entry_path], prefix + remote_hash)
+        identical += 1
+    self.logger.debug('Compared hashes of %i changed files, %i have identical contents', len(candidates), identical)
+
+  def _is_newer(self, source_mtime, dest_mtime):
+    """
+    Returns True if the source file is newer than the destination file. Normally, modified times are compared with a
+    resolution of seconds. In content hash mode, files with identical contents have already been skipped, so the exact
+    times are compared, allowing changes within the same second to be detected.
+    """
+    if self.content_hash:
+      return source_mtime > dest_mtime
+    return int(source_mtime) > int(dest_mtime)
+
+  def _use_delta(self, source_entry, dest_entry):
+    """
+    Returns True if the destination should be updated using a delta transfer, i.e. when delta transfers are enabled,
+    the source is large enough and an existing, non-empty file is present at the destination.
+    """
+    return (self.delta_threshold is not None and
+            self.transfers.delta_available and
+            source_entry.st_size >= self.delta_threshold and
+            dest_entry is not None and
+            stat.S_ISREG(dest_entry.st_mode) and
+            dest_entry.st_size > 0)
+
+  def _use_dedup(self, entry):
+    """
+    Returns True if the pushed file should be deduplicated using the blob store, i.e. when deduplication is enabled and
+    the file is at least as large as the dedup threshold.
+    """
+    return self.blob_store is not None and entry.st_size >= self.dedup_threshold
+
+  def _use_lazy(self, entry):
+    """
+    Returns True if the remote file should be fetched on demand instead of pulled, i.e. when lazy fetching is enabled
+    and the file is at least as large as the lazy threshold. Files in the lazy cache are kept up to date.
+    """
+    return (self.lazy_threshold is not None and entry.st_size >= self.lazy_threshold and
+            entry.path not in self.lazy_cache)
+
+  def _use_resume(self, entry):
+    """
+    Returns True if the file should be transferred using a resumable transfer, i.e. when resumable transfers are
+    enabled and the file is at least as large as the resume threshold.
+    """
+    return self.resume_threshold is not None and entry.st_size >= self.resume_threshold
+
+  def _use_batch(self, entry):
+    """
+    Returns True if the file should be transferred as part of a batch, i.e. when batch transfers are enabled and the
+    file is smaller than the batch threshold.
+    """
+    return (self.batch_threshold is not None and
+            self.transfers.batch_available and
+            entry.st_size < self.batch_threshold)
+
+  def _start_metrics(self, metrics):
+    self.metrics = metrics
+    self.transfers.metrics = metrics
+    return metrics
+
+  def _finish_metrics(self, completed):
+    """
+    Complete the metrics of the running synchronization (before the transfer statistics are cleared by `_log_stats`),
+    log a summary and write them to the metrics files.
+    """
+    metrics = self.metrics
+    if metrics is None:
+      return
+    self.metrics = None
+    self.transfers.metrics = None
+    metrics.finish(self.transfers.stats, failed=not completed)
+    self.last_metrics[metrics.trigger] = metrics
+
+    if metrics.files > 0:
+      listing = metrics.timings.get('list_remote', 0.) + metrics.timings.get('list_local', 0.)
+      rates = metrics.get_rates()
+      self.logger.info('Transferred %i files (%s) in %.1f seconds: %.1f seconds listing, %.1f seconds transferring at '
+                       '%s/s', metrics.files, format_size(metrics.bytes), metrics.duration, listing,
+                       metrics.timings.get('transfer', 0.), format_size(rates['bytes_per_second']))
+    self.logger.debug('Sync metrics: %s', json.dumps(metrics.to_dict()))
+
+    labels = dict(local_folder=self.local_folder, remote_folder=self.remote_folder)
+    try:
+      if self.sync_metrics is not None:
+        metrics.append_json(self.sync_metrics, **labels)
+      if self.sync_metrics_textfile is not None:
+        write_prometheus(self.sync_metrics_textfile, self.last_metrics.values(), **labels)
+    except (IOError, OSError) as e:
+      self.logger.warning('Failed to write the sync metrics (%s)', e)
+
+  def _log_stats(self):
+    stats = self.transfers.stats
+    if stats['delta_files'] > 0:
+      self.logger.info('Delta transfers updated %i files (%s) by sending %s, saving %s',
+                       stats['delta_files'], format_size(stats['delta_bytes']), format_size(stats['delta_sent']),
+                       format_size(stats['delta_bytes'] - stats['delta_sent']))
+    if stats['resumed_files'] > 0:
+      self.logger.info('Resumed %i interrupted transfers, skipping %s that was already transferred',
+                       stats['resumed_files'], format_size(stats['resumed_bytes']))
+    if stats['batch_files'] > 0:
+      self.logger.info('Transferred %i small files in tar batches', stats['batch_files'])
+    if stats['dedup_files'] > 0:
+      self.logger.info('Linked %i files (%s) to their copies in the remote blob store instead of uploading them',
+                       stats['dedup_files'], format_size(stats['dedup_bytes']))
+    if stats['sftp_files'] > 0:
+      self.logger.info('Transferred %i files over SFTP (%i pipelined), waiting for %.1f round trips per file',
+                       stats['sftp_files'], stats['pipelined_files'], stats['sftp_round_trips'] / stats['sftp_files'])
+    stats.clear()
+
+  def _on_retrieved(self, remote_entry):
+    local_stat = os.stat(os.path.join(self.local_folder, remote_entry.path))
+    self.manifest.update(remote_entry.path, entry_from_stat(remote_entry.path, local_stat), remote_entry)
+
+  def _on_pushed(self, local_entry):
+    # SFTP only stores the modified time with a resolution of seconds
+    remote_entry = local_entry._replace(st_atime=int(local_entry.st_atime), st_mtime=int(local_entry.st_mtime))
+    self.manifest.update(local_entry.path, local_entry, remote_entry)
+    remote_file = self._unix_join(self.remote_folder, local_entry.path)
+    if remote_file in self._blob_uploads:
+      self._uploaded_blobs.append(remote_file)
 
   @staticmethod
   def _isdir(attr):
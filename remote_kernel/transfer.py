@@ -0,0 +1,432 @@
+from collections import Counter
+import logging
+import os
+import queue
+import threading
+import time
+
+from paramiko import SFTP
+
+from . import batch, resume
+from .pipeline import PipelinedTransfer
+from .helpers import delta, get_remote_cmd
+from .schedule import BandwidthLimit, ThrottledChannel, ThrottledClient
+
+
+class TransferPool(object):
+  """
+  Pool of SFTP sessions opened on the transport of an existing SSH connection. Transfers submitted to the pool are
+  queued in a bounded queue and executed by one worker thread per SFTP session, so that many (small) files can be
+  transferred concurrently instead of waiting for the round trips of each file in turn.
+
+  :param ssh_client: Connected paramiko.SSHClient (or ParamikoClient) providing the transport.
+  :param channels: Number of SFTP sessions (and worker threads) to open.
+  :param queue_size: Maximum number of pending transfers, defaults to 4 times the number of channels. Submitting a
+    transfer blocks while the queue is full.
+  :param remote_python: Python interpreter on the remote host, used to run the delta transfer helper.
+  :param window: Maximum number of SFTP requests in flight per session, for pipelined transfers and the prefetching
+    of downloads.
+  :param bwlimit: Maximum bytes per second transferred by the pool in each direction, None for unlimited.
+  """
+  def __init__(self, ssh_client, channels=4, queue_size=None, remote_python='python', window=64, bwlimit=None):
+    self.logger = logging.getLogger('remote_kernel.transfer')
+
+    self.ssh_client = ssh_client
+    # Bandwidth limit shared by all sessions and remote commands of the pool (None for unlimited)
+    self.bwlimit = None if bwlimit is None else BandwidthLimit(bwlimit)
+    # Client used to run the remote commands of batch and delta transfers
+    self._exec_client = ssh_client if self.bwlimit is None else ThrottledClient(ssh_client, self.bwlimit)
+    self.channels = max(1, channels)
+    self._queue = queue.Queue(maxsize=queue_size or self.channels * 4)
+
+    self.remote_python = remote_python
+    self.window = window
+    # Set to False when the delta helper cannot be run on the remote host
+    self.delta_available = True
+    # Set to False when the remote host has no tar command
+    self.batch_available = True
+    # Compressions of tar streams that the remote host does not support
+    self.failed_compressions = set()
+
+    # Counters of transferred files and bytes
+    self.stats = Counter()
+    # SyncMetrics of the current synchronization, to which the duration of each transfer is added (None to disable)
+    self.metrics = None
+
+    self._workers = []
+    self._lock = threading.Lock()
+    self._errors = []
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  @property
+  def is_running(self):
+    return len(self._workers) > 0
+
+  def start(self):
+    if self.is_running:
+      return self
+
+    self.logger.debug('Starting %i SFTP transfer channels', self.channels)
+    if self.bwlimit is not None:
+      self.logger.debug('Limiting transfers to %i bytes per second', self.bwlimit.rate)
+    transport = self.ssh_client.get_transport()
+    try:
+      for i in range(self.channels):
+        # Open the session in the calling thread, so connection errors are raised here
+        sftp_client = self._open_sftp(transport)
+        worker = threading.Thread(target=self._work, args=(sftp_client,), name='remote_kernel-transfer-%i' % i)
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+    except Exception:
+      self.close()
+      raise
+    return self
+
+  def close(self):
+    if not self.is_running:
+      return
+
+    self.logger.debug('Closing SFTP transfer channels')
+    for _ in self._workers:
+      self._queue.put(None)
+    for worker in self._workers:
+      worker.join()
+    self._workers = []
+
+  def submit(self, func, *args):
+    """
+    Queue ``func(sftp_client, *args)`` to be executed on one of the SFTP sessions of this pool.
+    Blocks while the queue is full.
+    """
+    if not self.is_running:
+      raise ValueError('Transfer pool is not running')
+    self._queue.put((func, args))
+
+  def get(self, remotepath, localpath, times=None, callback=None):
+    """
+    Queue a download of ``remotepath`` to ``localpath``. If ``times`` is a tuple of (atime, mtime), these are set on
+    the local file when the download completes. If specified, ``callback()`` is called from the worker thread after a
+    successful download.
+    """
+    self.submit(self._get, remotepath, localpath, times, callback)
+
+  def put(self, localpath, remotepath, times=None, callback=None):
+    """
+    Queue an upload of ``localpath`` to ``remotepath``. If ``times`` is a tuple of (atime, mtime), these are set on
+    the remote file when the upload completes. If specified, ``callback()`` is called from the worker thread after a
+    successful upload.
+    """
+    self.submit(self._put, localpath, remotepath, times, callback)
+
+  def get_delta(self, remotepath, localpath, times=None, callback=None):
+    """
+    Queue a delta transfer, updating the existing ``localpath`` to match ``remotepath``. Arguments are identical to
+    ``get``. Falls back to a full download if the delta helper cannot be run on the remote host.
+    """
+    self.submit(self._get_delta, remotepath, localpath, times, callback)
+
+  def put_delta(self, localpath, remotepath, times=None, callback=None):
+    """
+    Queue a delta transfer, updating the existing ``remotepath`` to match ``localpath``. Arguments are identical to
+    ``put``. Falls back to a full upload if the delta helper cannot be run on the remote host.
+    """
+    self.submit(self._put_delta, localpath, remotepath, times, callback)
+
+  def get_resumable(self, remotepath, localpath, times=None, callback=None):
+    """
+    Queue a resumable download of a large file, which continues a previously interrupted download of the same file.
+    Arguments are identical to ``get``.
+    """
+    self.submit(self._get_resumable, remotepath, localpath, times, callback)
+
+  def put_resumable(self, localpath, remotepath, times=None, callback=None):
+    """
+    Queue a resumable upload of a large file, which continues a previously interrupted upload of the same file.
+    Arguments are identical to ``put``.
+    """
+    self.submit(self._put_resumable, localpath, remotepath, times, callback)
+
+  def get_batch(self, remote_root, local_root, entries, compression=None, callback=None):
+    """
+    Queue the download of a batch of (small) files as a single tar stream. Files missing from the stream (e.g. when
+    the remote host cannot run tar) are downloaded separately.
+
+    :param remote_root: Absolute remote folder to which the entry paths are relative
+    :param local_root: Local folder to which the entry paths are relative
+    :param entries: List of SyncEntry instances of the files to download. Times are set from these entries.
+    :param compression: Compression of the tar stream
+    :param callback: Optional function, called with the SyncEntry of each downloaded file from the worker thread
+    """
+    self.submit(self._get_batch, remote_root, local_root, entries, compression, callback)
+
+  def put_batch(self, local_root, remote_root, entries, compression=None, callback=None):
+    """
+    Queue the upload of a batch of (small) files as a single tar stream. If the remote host fails to extract the stream,
+    the files are uploaded separately. Arguments are identical to ``get_batch``.
+    """
+    self.submit(self._put_batch, local_root, remote_root, entries, compression, callback)
+
+  def get_pipelined(self, remote_root, local_root, entries, callback=None):
+    """
+    Queue the download of a group of files over a single SFTP session, pipelining the requests of all files instead of
+    waiting for the replies to each file in turn. Files that fail are retried separately. Arguments are identical to
+    ``get_batch``.
+    """
+    self.submit(self._get_pipelined, remote_root, local_root, entries, callback)
+
+  def put_pipelined(self, local_root, remote_root, entries, callback=None):
+    """
+    Queue the upload of a group of files over a single SFTP session, pipelining the requests of all files. Arguments
+    are identical to ``get_batch``.
+    """
+    self.submit(self._put_pipelined, local_root, remote_root, entries, callback)
+
+  def join(self):
+    """
+    Wait until all queued transfers have finished. If any of the transfers failed, the first error is raised after all
+    other transfers have completed.
+    """
+    self._queue.join()
+
+    with self._lock:
+      errors = self._errors
+      self._errors = []
+    if len(errors) > 0:
+      if len(errors) > 1:
+        self.logger.error('%i transfers failed', len(errors))
+      raise errors[0]
+
+  def _work(self, sftp_client):
+    try:
+      while True:
+        task = self._queue.get()
+        try:
+          if task is None:
+            return
+          func, args = task
+          started = time.time()
+          try:
+            func(sftp_client, *args)
+            metrics = self.metrics
+            if metrics is not None:
+              metrics.transfer_seconds.observe(time.time() - started)
+          except Exception as e:
+            self.logger.error('Transfer failed (%s)', e, exc_info=self.logger.isEnabledFor(logging.DEBUG))
+            with self._lock:
+              self._errors.append(e)
+        finally:
+          self._queue.task_done()
+    finally:
+      sftp_client.close()
+
+  def _open_sftp(self, transport):
+    if self.bwlimit is None:
+      return SFTP.from_transport(transport)
+    channel = transport.open_session()
+    channel.invoke_subsystem('sftp')
+    return SFTP(ThrottledChannel(channel, self.bwlimit))
+
+  def count(self, **counts):
+    """
+    Add ``counts`` to the statistics of the pool, e.g. of files transferred without the pool.
+    """
+    with self._lock:
+      self.stats.update(counts)
+
+  def _get_delta(self, sftp_client, remotepath, localpath, times, callback):
+    if self.delta_available:
+      tmp_path = localpath + delta.TMP_SUFFIX
+      stdin, stdout, stderr = self._exec_client.exec_command(
+        get_remote_cmd('delta', ('delta', remotepath), self.remote_python))
+      try:
+        with open(localpath, 'rb') as basis_fs:
+          file_size = os.fstat(basis_fs.fileno()).st_size
+          block_size, sig_bytes = delta.write_signature(basis_fs, stdin, file_size)
+          stdin.flush()
+          stdin.channel.shutdown_write()
+          with open(tmp_path, 'wb') as out_fs:
+            literal_bytes = delta.apply_delta(stdout, basis_fs, block_size, out_fs)
+        os.chmod(tmp_path, os.stat(localpath).st_mode & 0o7777)
+        os.replace(tmp_path, localpath)
+      except Exception as e:
+        self._delta_failed(e, stderr)
+      else:
+        self.count(delta_files=1, delta_bytes=os.path.getsize(localpath), delta_sent=sig_bytes + literal_bytes)
+        if times is not None:
+          os.utime(localpath, times)
+        if callback is not None:
+          callback()
+        return
+      finally:
+        stdin.channel.close()
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+    self._get(sftp_client, remotepath, localpath, times, callback)
+
+  def _put_delta(self, sftp_client, localpath, remotepath, times, callback):
+    if self.delta_available:
+      args = ('patch', remotepath)
+      if times is not None:
+        # SFTP stores times with a resolution of seconds, do the same here for consistency
+        args += (int(times[0]), int(times[1]))
+      stdin, stdout, stderr = self._exec_client.exec_command(get_remote_cmd('delta', args, self.remote_python))
+      try:
+        signature = delta.read_signature(stdout)
+        with open(localpath, 'rb') as new_fs:
+          literal_bytes, delta_bytes = delta.write_delta(new_fs, signature, stdin)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        if stdout.read() != b'OK' or stdout.channel.recv_exit_status() != 0:
+          raise IOError('Remote failed to apply the delta')
+      except Exception as e:
+        self._delta_failed(e, stderr)
+      else:
+        sig_bytes = len(delta.SIGNATURE_MAGIC) + delta.SIGNATURE_HEADER.size + \
+          len(signature.strong) * delta.BLOCK_SIGNATURE.size
+        self.count(delta_files=1, delta_bytes=os.path.getsize(localpath), delta_sent=sig_bytes + delta_bytes)
+        if callback is not None:
+          callback()
+        return
+      finally:
+        stdin.channel.close()
+    self._put(sftp_client, localpath, remotepath, times, callback)
+
+  def _get_resumable(self, sftp_client, remotepath, localpath, times, callback):
+    resumed = resume.get_resumable(sftp_client, remotepath, localpath, ssh_client=self._exec_client,
+                                   remote_python=self.remote_python)
+    if resumed > 0:
+      self.count(resumed_files=1, resumed_bytes=resumed)
+    if times is not None:
+      os.utime(localpath, times)
+    if callback is not None:
+      callback()
+
+  def _put_resumable(self, sftp_client, localpath, remotepath, times, callback):
+    resumed = resume.put_resumable(sftp_client, localpath, remotepath)
+    if resumed > 0:
+      self.count(resumed_files=1, resumed_bytes=resumed)
+    if times is not None:
+      sftp_client.utime(remotepath, times)
+    if callback is not None:
+      callback()
+
+  def _get_batch(self, sftp_client, remote_root, local_root, entries, compression, callback):
+    retrieved = set()
+    if self.batch_available:
+      retrieved = self._batch(batch.get_batch, remote_root, local_root, entries, compression, callback)
+      self.count(batch_files=len(retrieved))
+
+    for entry in entries:
+      if entry.path not in retrieved:
+        self._get(sftp_client, '/'.join((remote_root, entry.path)), os.path.join(local_root, entry.path),
+                  (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+
+  def _put_batch(self, sftp_client, local_root, remote_root, entries, compression, callback):
+    if self.batch_available and self._batch(batch.put_batch, local_root, remote_root, entries, compression, callback):
+      self.count(batch_files=len(entries))
+      return
+
+    for entry in entries:
+      self._put(sftp_client, os.path.join(local_root, entry.path), '/'.join((remote_root, entry.path)),
+                (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+
+  def _get_pipelined(self, sftp_client, remote_root, local_root, entries, callback):
+    pipeline = PipelinedTransfer(sftp_client, self.window)
+    for entry in entries:
+      pipeline.get('/'.join((remote_root, entry.path)), os.path.join(local_root, entry.path), entry.st_size,
+                   (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+    failed = self._run_pipeline(pipeline, [os.path.join(local_root, entry.path) for entry in entries])
+
+    for entry in entries:
+      if os.path.join(local_root, entry.path) in failed:
+        self._get(sftp_client, '/'.join((remote_root, entry.path)), os.path.join(local_root, entry.path),
+                  (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+
+  def _put_pipelined(self, sftp_client, local_root, remote_root, entries, callback):
+    pipeline = PipelinedTransfer(sftp_client, self.window)
+    for entry in entries:
+      pipeline.put(os.path.join(local_root, entry.path), '/'.join((remote_root, entry.path)),
+                   (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+    failed = self._run_pipeline(pipeline, [os.path.join(local_root, entry.path) for entry in entries])
+
+    for entry in entries:
+      if os.path.join(local_root, entry.path) in failed:
+        self._put(sftp_client, os.path.join(local_root, entry.path), '/'.join((remote_root, entry.path)),
+                  (entry.st_atime, entry.st_mtime), None if callback is None else lambda e=entry: callback(e))
+
+  def _run_pipeline(self, pipeline, local_paths):
+    """
+    Run ``pipeline``, returning the set of local paths of the files that were not transferred.
+    """
+    try:
+      round_trips, failed = pipeline.run()
+    except Exception as e:
+      self.logger.warning('Pipelined transfer failed (%s), transferring the remaining files separately', e)
+      completed = [transfer for transfer in pipeline.transfers if transfer.done and transfer.error is None]
+      round_trips = sum(transfer.round_trips for transfer in completed)
+      failed = set(local_paths) - {transfer.localpath for transfer in completed}
+    transferred = len(local_paths) - len(failed)
+    self.count(sftp_files=transferred, sftp_round_trips=round_trips, pipelined_files=transferred)
+    return set(failed)
+
+  def _batch(self, transfer, src_root, dst_root, entries, compression, callback):
+    """
+    Transfer a batch using ``transfer`` (`batch.get_batch` or `batch.put_batch`). If the remote host does not support
+    the compression, the batch is retried with gzip, which is used for all later batches. Batch transfers are only
+    disabled if the remote host has no tar command, other errors only fail this batch.
+
+    :return: Set of paths of the transferred files, empty if the batch failed
+    """
+    if compression in self.failed_compressions:
+      compression = 'gzip'
+    try:
+      return transfer(self._exec_client, src_root, dst_root, entries, compression, callback)
+    except batch.RemoteTarError as e:
+      if e.exit_status == batch.COMMAND_NOT_FOUND:
+        if self.batch_available:
+          self.logger.warning('Batch transfers not available (%s), falling back to separate transfers', e)
+        self.batch_available = False
+        return set()
+      if compression == 'zstd' and 'zstd' in str(e):
+        self.logger.warning('Batch compression zstd not available (%s), using gzip instead', e)
+        self.failed_compressions.add('zstd')
+        return self._batch(transfer, src_root, dst_root, entries, 'gzip', callback)
+      self.logger.warning('Batch transfer failed (%s), transferring its files separately', e)
+    except Exception as e:
+      self.logger.warning('Batch transfer failed (%s), transferring its files separately', e)
+    return set()
+
+  def _delta_failed(self, error, stderr):
+    # Only read stderr output that has already been received, the remote helper may still be waiting for input
+    message = ''
+    if stderr.channel.recv_stderr_ready():
+      message = stderr.channel.recv_stderr(65536).decode('utf-8', errors='replace').strip()
+    if self.delta_available:
+      self.logger.warning('Delta transfer failed (%s), falling back to full transfers. %s', error, message)
+    self.delta_available = False
+
+  def _get(self, sftp_client, remotepath, localpath, times, callback):
+    # Read ahead at most a window of requests, instead of requesting the complete file at once
+    sftp_client.get(remotepath, localpath, max_concurrent_prefetch_requests=self.window)
+    # Round trips waited for: open, stat, read and close
+    self.count(sftp_files=1, sftp_round_trips=4)
+    if times is not None:
+      os.utime(localpath, times)
+    if callback is not None:
+      callback()
+
+  def _put(self, sftp_client, localpath, remotepath, times, callback):
+    sftp_client.put(localpath, remotepath)
+    if times is not None:
+      sftp_client.utime(remotepath, times)
+    # Round trips waited for: open, close (waiting for the pipelined writes), stat and utime
+    self.count(sftp_files=1, sftp_round_trips=3 if times is None else 4)
+    if callback is not None:
+      callback()
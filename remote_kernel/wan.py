@@ -0,0 +1,260 @@
+"""
+Emulation of wide area network conditions, to measure remote_kernel on a local connection (e.g. to the stand-in server
+of the benchmarks) as if the remote host were far away.
+
+A WANSocket wraps the socket of an SSH connection and delays the data in both directions: data is sent at no more
+than the bandwidth, and delivered after the latency (plus a random jitter). Stalls emulate the retransmission timeouts
+caused by packet loss: each chunk of data stalls the link with probability ``loss``, delaying it and all data after it.
+The order of the data is always preserved, as on a TCP connection.
+
+The emulation is specified as a comma-separated list of settings, e.g. ``latency=80ms,jitter=5ms,bandwidth=2M``:
+
+- ``latency``: Added round-trip time, half of which is added in each direction (default 0)
+- ``jitter``: Maximum random variation of the delay in each direction (default 0)
+- ``bandwidth``: Maximum bytes per second in each direction, e.g. ``2M`` (default unlimited)
+- ``loss``: Probability that a chunk of data stalls the link (default 0)
+- ``stall``: Duration of a stall (default 200ms)
+- ``seed``: Seed of the random jitter and stalls, for reproducible measurements
+"""
+import argparse
+from collections import deque
+import logging
+import random
+import socket
+import threading
+import time
+
+logger = logging.getLogger('remote_kernel.wan')
+
+# Maximum number of bytes buffered in each direction before `send` blocks
+MAX_BUFFER = 4 << 20
+
+RECV_SIZE = 65536
+
+
+def parse_duration(duration):
+  """
+  Parse a duration in seconds, optionally followed by a unit suffix ms or s, e.g. "80ms".
+  """
+  duration = duration.strip().lower()
+  try:
+    if duration.endswith('ms'):
+      return float(duration[:-2]) / 1000.
+    return float(duration.rstrip('s'))
+  except ValueError:
+    raise argparse.ArgumentTypeError('Invalid duration "%s"' % duration)
+
+
+class WANProfile(object):
+  """
+  Network conditions to emulate, see the module documentation.
+
+  :param latency: Added round-trip time in seconds
+  :param jitter: Maximum random variation of the delay in each direction in seconds
+  :param bandwidth: Maximum bytes per second in each direction, None for unlimited
+  :param loss: Probability that a chunk of data stalls the link
+  :param stall: Duration of a stall in seconds
+  :param seed: Seed of the random jitter and stalls
+  """
+  def __init__(self, latency=0., jitter=0., bandwidth=None, loss=0., stall=0.2, seed=None):
+    self.latency = latency
+    self.jitter = jitter
+    self.bandwidth = bandwidth
+    self.loss = loss
+    self.stall = stall
+    self.seed = seed
+
+  @classmethod
+  def parse(cls, spec):
+    """
+    Parse a specification like ``latency=80ms,jitter=5ms,bandwidth=2M``. Used as argument type in `get_parser`.
+    """
+    from . import parse_size
+
+    parsers = dict(latency=parse_duration, jitter=parse_duration, bandwidth=parse_size, loss=float,
+                   stall=parse_duration, seed=int)
+    kwargs = {}
+    for setting in spec.split(','):
+      if setting.strip() == '':
+        continue
+      key, _, value = setting.partition('=')
+      key = key.strip().lower()
+      if key not in parsers:
+        raise argparse.ArgumentTypeError('Unknown WAN emulation setting "%s", choose from %s' %
+                                         (key, ', '.join(parsers)))
+      try:
+        kwargs[key] = parsers[key](value)
+      except ValueError:
+        raise argparse.ArgumentTypeError('Invalid value of WAN emulation setting %s: "%s"' % (key, value))
+    return cls(**kwargs)
+
+  def __str__(self):
+    settings = ['latency=%gms' % (self.latency * 1000), 'jitter=%gms' % (self.jitter * 1000)]
+    if self.bandwidth is not None:
+      settings.append('bandwidth=%i' % self.bandwidth)
+    settings += ['loss=%g' % self.loss, 'stall=%gms' % (self.stall * 1000)]
+    if self.seed is not None:
+      settings.append('seed=%i' % self.seed)
+    return ','.join(settings)
+
+
+class _Link(object):
+  """
+  One direction of an emulated link: a queue of chunks of data, each with the time it is delivered.
+  """
+  def __init__(self, profile, rng):
+    self.profile = profile
+    self.rng = rng
+    self.chunks = deque()  # (deliver time, data)
+    self.buffered = 0
+    self.closed = False
+    self.condition = threading.Condition()
+    # Time the link has sent all data queued so far, and the delivery time of the last chunk
+    self._free_at = 0.
+    self._last_delivery = 0.
+
+  def put(self, data, block=True):
+    """
+    Queue ``data`` (b'' when the connection is closed), computing the time it is delivered.
+    """
+    profile = self.profile
+    with self.condition:
+      while block and self.buffered > MAX_BUFFER and not self.closed:
+        self.condition.wait()
+      if self.closed:
+        raise socket.error('Socket is closed')
+
+      now = time.time()
+      departure = max(now, self._free_at)
+      if profile.loss > 0 and self.rng.random() < profile.loss:
+        departure += profile.stall
+      if profile.bandwidth:
+        departure += len(data) / float(profile.bandwidth)
+      self._free_at = departure
+      delay = profile.latency / 2.
+      if profile.jitter > 0:
+        delay = max(0., delay + self.rng.uniform(-profile.jitter, profile.jitter))
+      # Data is delivered in order, regardless of the jitter
+      self._last_delivery = max(self._last_delivery, departure + delay)
+      self.chunks.append((self._last_delivery, data))
+      self.buffered += len(data)
+      self.condition.notify_all()
+
+  def get(self, size, timeout=None):
+    """
+    Returns at most ``size`` bytes of the data that has been delivered, waiting at most ``timeout`` seconds (None to
+    wait indefinitely).
+
+    :return: Data, b'' when the connection was closed, or None if no data was delivered within the timeout
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with self.condition:
+      while True:
+        now = time.time()
+        if len(self.chunks) > 0 and self.chunks[0][0] <= now:
+          deliver_time, data = self.chunks[0]
+          if len(data) == 0:
+            return b''  # Closed, leave the marker for subsequent calls
+          if len(data) > size:
+            self.chunks[0] = (deliver_time, data[size:])
+            data = data[:size]
+          else:
+            self.chunks.popleft()
+          self.buffered -= len(data)
+          self.condition.notify_all()
+          return data
+        if self.closed and len(self.chunks) == 0:
+          return b''
+
+        wait = None if deadline is None else deadline - now
+        if len(self.chunks) > 0:
+          wait = self.chunks[0][0] - now if wait is None else min(wait, self.chunks[0][0] - now)
+        if wait is not None and wait <= 0:
+          return None
+        self.condition.wait(wait)
+
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+
+class WANSocket(object):
+  """
+  Socket-like wrapper of ``sock`` (a connected socket or paramiko Channel) emulating the network conditions of
+  ``profile``. Can be passed as ``sock`` to `paramiko.SSHClient.connect`.
+
+  Two threads move the data between the wrapped socket and the emulated links: one sends the outgoing data when it is
+  due, the other receives the incoming data as soon as it arrives and queues it for delivery.
+  """
+  def __init__(self, sock, profile):
+    self.sock = sock
+    self.profile = profile
+    rng = random.Random(profile.seed)
+    self._outgoing = _Link(profile, rng)
+    self._incoming = _Link(profile, rng)
+    self._timeout = None
+    self._closed = False
+
+    self._sender = threading.Thread(target=self._send_loop, name='remote_kernel-wan-send')
+    self._sender.daemon = True
+    self._receiver = threading.Thread(target=self._recv_loop, name='remote_kernel-wan-recv')
+    self._receiver.daemon = True
+    self._sender.start()
+    self._receiver.start()
+    logger.info('Emulating WAN conditions: %s', profile)
+
+  def __getattr__(self, item):
+    # Other socket methods (e.g. getpeername) are passed on to the wrapped socket
+    return getattr(self.sock, item)
+
+  def settimeout(self, timeout):
+    self._timeout = timeout
+
+  def gettimeout(self):
+    return self._timeout
+
+  def send(self, data):
+    self._outgoing.put(bytes(data))
+    return len(data)
+
+  def sendall(self, data):
+    self.send(data)
+
+  def recv(self, size):
+    data = self._incoming.get(size, self._timeout)
+    if data is None:
+      raise socket.timeout()
+    return data
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    self._outgoing.close()
+    self._incoming.close()
+    self.sock.close()
+
+  def _send_loop(self):
+    try:
+      while True:
+        data = self._outgoing.get(RECV_SIZE)
+        if not data:
+          break
+        self.sock.sendall(data)
+    except (socket.error, EOFError) as e:
+      if not self._closed:
+        logger.debug('Emulated link failed to send (%s)', e)
+      self._incoming.close()
+
+  def _recv_loop(self):
+    try:
+      while True:
+        data = self.sock.recv(RECV_SIZE)
+        self._incoming.put(data, block=False)
+        if len(data) == 0:
+          break
+    except (socket.error, EOFError) as e:
+      if not self._closed:
+        logger.debug('Emulated link failed to receive (%s)', e)
+      self._incoming.close()
@@ -0,0 +1,429 @@
+"""
+Live synchronization while a kernel is running. Local changes are detected as they occur (using inotify if available)
+and pushed to the remote, remote changes are pulled periodically using the incremental sync, or as they occur when
+watched by a `RemoteWatcher`.
+"""
+import logging
+import os
+import posixpath
+import shlex
+import threading
+import time
+
+from .helpers import get_remote_cmd
+from .listing import local_listing
+
+logger = logging.getLogger('remote_kernel.watch')
+
+try:
+  import inotify_simple
+except ImportError:
+  inotify_simple = None
+
+
+class LocalWatcher(object):
+  """
+  Watches the local tree at ``root`` for files that are written, created or moved into the tree. Uses inotify (via the
+  optional ``inotify_simple`` package) if available, otherwise the tree is listed every ``poll_interval`` seconds and
+  compared to the previous listing.
+
+  :param root: Local folder to watch
+  :param recursive: If False, only files directly in ``root`` are watched
+  :param poll_interval: Interval in seconds between listings of the tree when inotify is not available
+  :param ignore: Optional SyncIgnore, excluded folders are not watched
+  """
+  def __init__(self, root, recursive=True, poll_interval=2.0, ignore=None):
+    self.root = root
+    self.recursive = recursive
+    self.poll_interval = poll_interval
+    self.ignore = ignore
+
+    self._inotify = None
+    self._watches = {}  # watch descriptor -> relative folder path
+    self._states = None  # relative path -> (size, mtime), when polling
+    self._next_poll = 0
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  @property
+  def uses_inotify(self):
+    return self._inotify is not None
+
+  def start(self):
+    if inotify_simple is not None:
+      try:
+        self._inotify = inotify_simple.INotify()
+        self._add_watches('')
+        logger.debug('Watching %i local folders using inotify', len(self._watches))
+        return self
+      except OSError as e:  # e.g. when the maximum number of watches is exceeded
+        logger.warning('Could not watch local folder using inotify (%s), falling back to polling', e)
+        self.close()
+
+    logger.debug('Watching local folder by polling every %.1f seconds', self.poll_interval)
+    self._states = self._list_states()
+    self._next_poll = time.time() + self.poll_interval
+    return self
+
+  def close(self):
+    if self._inotify is not None:
+      self._inotify.close()
+      self._inotify = None
+    self._watches = {}
+
+  def read(self, timeout):
+    """
+    Wait at most ``timeout`` seconds for changes.
+
+    :return: Set of relative paths (using '/' as separator) of the changed files, which may be empty. None if changes
+      may have been missed (e.g. when the inotify event queue overflowed), in which case the complete tree should be
+      synchronized.
+    """
+    if self._inotify is not None:
+      return self._read_inotify(timeout)
+    return self._read_poll(timeout)
+
+  def _add_watches(self, fldr):
+    """
+    Watch folder ``fldr`` and (if recursive) its sub-folders. Returns the relative paths of the files already present,
+    which may have been created before the watch was added.
+    """
+    flags = inotify_simple.flags
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.ATTRIB
+    paths = set()
+    folder_stack = [fldr]
+    while len(folder_stack) > 0:
+      fldr = folder_stack.pop()
+      wd = self._inotify.add_watch(os.path.join(self.root, fldr), mask)
+      self._watches[wd] = fldr
+      with os.scandir(os.path.join(self.root, fldr)) as dir_iter:
+        for dir_entry in dir_iter:
+          path = posixpath.join(fldr, dir_entry.name)
+          is_dir = dir_entry.is_dir(follow_symlinks=False)
+          if self.ignore is not None and self.ignore.matches(path, is_dir):
+            continue
+          if is_dir:
+            if self.recursive:
+              folder_stack.append(path)
+          else:
+            paths.add(path)
+    return paths
+
+  def _read_inotify(self, timeout):
+    flags = inotify_simple.flags
+    changed = set()
+    for event in self._inotify.read(timeout=int(timeout * 1000)):
+      if event.mask & flags.Q_OVERFLOW:
+        return None
+      fldr = self._watches.get(event.wd, None)
+      if fldr is None or event.name == '':
+        continue  # Event on a removed folder, or on the watched folder itself
+
+      path = posixpath.join(fldr, event.name)
+      if event.mask & flags.ISDIR:
+        if (self.recursive and event.mask & (flags.CREATE | flags.MOVED_TO) and
+            (self.ignore is None or not self.ignore.is_excluded(path, True))):
+          try:
+            changed.update(self._add_watches(path))
+          except OSError:
+            pass  # Removed again before it could be watched
+      elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO | flags.ATTRIB):
+        changed.add(path)
+    return changed
+
+  def _read_poll(self, timeout):
+    wait = self._next_poll - time.time()
+    if wait > timeout:
+      time.sleep(timeout)
+      return set()
+    time.sleep(max(wait, 0))
+    self._next_poll = time.time() + self.poll_interval
+    states = self._list_states()
+    changed = {path for path, state in states.items() if self._states.get(path, None) != state}
+    self._states = states
+    return changed
+
+  def _list_states(self):
+    return {
+      path: (entry.st_size, entry.st_mtime)
+      for path, entry in local_listing(self.root, self.recursive, self.ignore).items()
+      if (entry.st_mode & 0o40000) != 0o40000
+    }
+
+
+class RemoteWatcher(object):
+  """
+  Watches the remote tree at ``root`` for changed files, using a command that streams change events over an exec
+  channel of the SSH connection: ``inotifywait`` if it is installed on the remote host, otherwise a python watcher
+  (see `helpers.watcher`), which is uploaded along with the command.
+
+  Events are read by a background thread and collected until they are retrieved by `read`.
+
+  :param ssh_client: Connected paramiko.SSHClient (or ParamikoClient)
+  :param root: Absolute path of the remote folder to watch
+  :param recursive: If False, only files directly in ``root`` are watched
+  :param remote_python: Python interpreter on the remote host, used if inotifywait is not available
+  """
+  def __init__(self, ssh_client, root, recursive=True, remote_python='python'):
+    self.ssh_client = ssh_client
+    self.root = root.rstrip('/')
+    self.recursive = recursive
+    self.remote_python = remote_python
+
+    self._stdin = None
+    self._channel = None
+    self._reader = None
+    self._lock = threading.Lock()
+    self._paths = set()
+    self._folders = set()
+    self._overflow = False
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  @property
+  def is_running(self):
+    return self._reader is not None and self._reader.is_alive()
+
+  def get_watch_cmd(self):
+    inotify_cmd = 'inotifywait -m -q%s -e close_write,moved_to,create,attrib --format %s %s' % (
+      ' -r' if self.recursive else '', shlex.quote('%e %w%f'), shlex.quote(self.root))
+    helper_cmd = get_remote_cmd('watcher', (self.root, int(self.recursive)), self.remote_python)
+    return 'if command -v inotifywait >/dev/null 2>&1; then exec %s; else exec %s; fi' % (inotify_cmd, helper_cmd)
+
+  def start(self):
+    if self.is_running:
+      return self
+
+    cmd = self.get_watch_cmd()
+    logger.debug('Watching remote folder %s', self.root)
+    stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
+    # Keep a reference to stdin, as closing it (also when it is garbage collected) causes the watcher to exit
+    self._stdin = stdin
+    self._channel = stdout.channel
+    self._reader = threading.Thread(target=self._read_events, args=(stdout, stderr),
+                                    name='remote_kernel-remote-watcher')
+    self._reader.daemon = True
+    self._reader.start()
+    return self
+
+  def close(self):
+    if self._channel is not None:
+      # Closing the channel closes stdin of the watcher, causing it to exit
+      channel, self._channel = self._channel, None
+      channel.close()
+      self._stdin = None
+    if self._reader is not None:
+      self._reader.join()
+      self._reader = None
+
+  def read(self):
+    """
+    Retrieve the changes received since the previous call, without waiting.
+
+    :return: Tuple of the set of relative paths of the changed files and the set of relative paths of new folders (of
+      which the contents should be listed), which may be empty. None if changes may have been missed (e.g. when the
+      event queue on the remote host overflowed), in which case the complete tree should be synchronized.
+    """
+    with self._lock:
+      paths, folders, overflow = self._paths, self._folders, self._overflow
+      self._paths, self._folders, self._overflow = set(), set(), False
+    if overflow:
+      return None
+    return paths, folders
+
+  def _read_events(self, stdout, stderr):
+    prefix = self.root + '/'
+    for line in stdout:
+      line = line.rstrip('\n')
+      events, _, path = line.partition(' ')
+      events = events.split(',')
+      with self._lock:
+        if 'Q_OVERFLOW' in events:
+          self._overflow = True
+        elif path.startswith(prefix):
+          path = path[len(prefix):]
+          if 'ISDIR' not in events:
+            self._paths.add(path)
+          elif 'CREATE' in events or 'MOVED_TO' in events:
+            self._folders.add(path)
+
+    if self._channel is not None:  # Not closed by this watcher
+      logger.warning('Remote watcher stopped (exit status %i): %s', stdout.channel.recv_exit_status(),
+                     stderr.read().decode('utf-8', errors='replace').strip())
+
+
+class _Debouncer(object):
+  """
+  Collects changes until no new changes are added for ``debounce`` seconds, or until the first change is at least
+  ``max_delay`` seconds old.
+  """
+  def __init__(self, debounce, max_delay):
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.pending = set()
+    self.first_change = self.last_change = None
+
+  def add(self, changes):
+    if len(changes) == 0:
+      return
+    self.pending.update(changes)
+    self.last_change = time.time()
+    if self.first_change is None:
+      self.first_change = self.last_change
+
+  def timeout(self, now):
+    if self.first_change is None:
+      return float('inf')
+    return min(self.last_change + self.debounce - now, self.first_change + self.max_delay - now)
+
+  def is_due(self, now):
+    return self.first_change is not None and self.timeout(now) <= 0
+
+  def pop(self):
+    pending = self.pending
+    self.pending = set()
+    self.first_change = self.last_change = None
+    return pending
+
+
+class SyncWorker(threading.Thread):
+  """
+  Background thread that keeps the local and remote sync folders synchronized while a kernel is running.
+
+  Remote changes are pulled every ``interval`` seconds, using the incremental sync of ``synchronizer``. If
+  ``remote_watch`` is True, remote changes are also streamed by a `RemoteWatcher` and pulled as they occur. If
+  synchronization is bi-directional, local changes are pushed as they occur.
+
+  Changes are collected until no new changes are detected for ``debounce`` seconds (or for at most 10 times that
+  period during a continuous stream of changes), so a burst of writes to the same files results in a single transfer.
+
+  :param synchronizer: ParamikoSync instance. It should not be used by other threads while the worker is running.
+  :param interval: Interval in seconds between complete synchronizations, None to only synchronize changes reported
+    by the watchers.
+  :param debounce: Period in seconds without changes before changes are transferred.
+  :param remote_watch: If True, remote changes are streamed from the remote host.
+  """
+  def __init__(self, synchronizer, interval=60., debounce=1., remote_watch=False):
+    super(SyncWorker, self).__init__(name='remote_kernel-sync-worker')
+    self.daemon = True
+    self.logger = logging.getLogger('remote_kernel.watch')
+
+    self.synchronizer = synchronizer
+    self.interval = interval
+    self.debounce = debounce
+    self.max_delay = 10 * debounce
+    self.remote_watch = remote_watch
+
+    self._stop_event = threading.Event()
+
+  def stop(self):
+    """
+    Stop the worker and wait for the current synchronization (if any) to finish.
+    """
+    self._stop_event.set()
+    if self.is_alive():
+      self.join()
+
+  def run(self):
+    local_watcher = None
+    remote_watcher = None
+    try:
+      with self.synchronizer.connect():
+        if self.synchronizer.bi_directional:
+          local_watcher = LocalWatcher(self.synchronizer.local_folder, self.synchronizer.recursive,
+                                       poll_interval=max(self.debounce, 1.), ignore=self.synchronizer.ignore).start()
+        if self.remote_watch:
+          remote_watcher = RemoteWatcher(self.synchronizer.ssh_client, self.synchronizer.remote_folder,
+                                         self.synchronizer.recursive, self.synchronizer.remote_python).start()
+        self._loop(local_watcher, remote_watcher)
+    except Exception:
+      self.logger.error('Background synchronization stopped due to an error', exc_info=True)
+    finally:
+      if local_watcher is not None:
+        local_watcher.close()
+      if remote_watcher is not None:
+        remote_watcher.close()
+
+  def _next_sync(self):
+    if self.interval is None:
+      return float('inf')
+    return time.time() + self.interval
+
+  def _loop(self, local_watcher, remote_watcher):
+    next_sync = self._next_sync()
+    local_changes = _Debouncer(self.debounce, self.max_delay)
+    remote_changes = _Debouncer(self.debounce, self.max_delay)
+    remote_folders = set()
+
+    while not self._stop_event.is_set():
+      now = time.time()
+      timeout = min(next_sync - now, local_changes.timeout(now), remote_changes.timeout(now))
+      if remote_watcher is not None:
+        timeout = min(timeout, self.debounce)  # Remote changes are not signalled, check them regularly
+      # Wake up at least every second to check whether the worker should stop
+      timeout = min(max(timeout, 0.05), 1.)
+
+      missed = False
+      if local_watcher is None:
+        self._stop_event.wait(timeout)
+      else:
+        changed = local_watcher.read(timeout)
+        if changed is None:
+          missed = True
+        else:
+          local_changes.add(changed)
+
+      if remote_watcher is not None:
+        if not remote_watcher.is_running:
+          self.logger.warning('Remote changes are no longer watched, only synchronizing every %s seconds',
+                              self.interval)
+          remote_watcher = None
+        else:
+          changed = remote_watcher.read()
+          if changed is None:
+            missed = True
+          else:
+            paths, folders = changed
+            remote_changes.add(paths | folders)
+            remote_folders.update(folders)
+
+      if self._stop_event.is_set():
+        break
+
+      now = time.time()
+      if missed:
+        self.logger.info('Changes may have been missed, synchronizing all files')
+        next_sync = now
+
+      if now >= next_sync:
+        # A complete sync also transfers all pending changes
+        local_changes.pop()
+        remote_changes.pop()
+        remote_folders.clear()
+        self._run(self.synchronizer.sync)
+        next_sync = self._next_sync()
+        continue
+
+      if remote_changes.is_due(now):
+        paths = remote_changes.pop() - remote_folders
+        self._run(self.synchronizer.pull_files, sorted(paths), sorted(remote_folders))
+        remote_folders.clear()
+      if local_changes.is_due(now):
+        self._run(self.synchronizer.push_files, sorted(local_changes.pop()))
+
+  def _run(self, func, *args):
+    # Errors (e.g. files removed during the transfer) should not stop the worker, they are retried in the next sync
+    try:
+      func(*args)
+    except Exception:
+      self.logger.error('Error synchronizing files!', exc_info=True)
@@ -16,7 +16,7 @@ setup(
 
   version=versioneer.get_version(),
 
-  packages=['remote_kernel'],
+  packages=['remote_kernel', 'remote_kernel.helpers'],
   package_data={'remote_kernel': ['resources/*.png']},
   zip_safe=False,
 
@@ -33,10 +33,11 @@ setup(
     'License :: OSI Approved :: BSD License',
     'Operating System :: Microsoft :: Windows',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.5',
+    'Programming Language :: Python :: 3.6',
     'Topic :: Utilities'
   ],
 
+  python_requires='>=3.6',
   install_requires=requirements,
 
   keywords='remote-kernel,ipykernel,ssh'
@@ -0,0 +1,62 @@
+import socket
+import threading
+
+import paramiko
+import pytest
+
+from benchmarks.server import StandInServer
+
+
+@pytest.fixture(scope='session')
+def ssh_server(tmp_path_factory):
+  """
+  In-process SSH server on localhost, standing in for the remote host. Its home directory is a temporary folder, but
+  absolute paths anywhere on the local filesystem are served as well.
+  """
+  with StandInServer(str(tmp_path_factory.mktemp('home'))) as server:
+    yield server
+
+
+@pytest.fixture
+def ssh_client(ssh_server):
+  client = paramiko.SSHClient()
+  client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+  client.connect('127.0.0.1', ssh_server.port, 'user', 'password', look_for_keys=False, allow_agent=False)
+  yield client
+  client.close()
+
+
+def echo(sock):
+  with sock:
+    for data in iter(lambda: sock.recv(1 << 16), b''):
+      sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def serve(listener):
+  listener.listen(16)
+
+  def accept():
+    while True:
+      try:
+        sock, _ = listener.accept()
+      except OSError:
+        return
+      threading.Thread(target=echo, args=(sock,), daemon=True).start()
+
+  threading.Thread(target=accept, daemon=True).start()
+  return listener
+
+
+@pytest.fixture
+def echo_servers(tmp_path):
+  """
+  Echo servers standing in for the sockets of a kernel on the remote host: on a TCP port and on a Unix socket.
+  """
+  tcp = socket.socket()
+  tcp.bind(('127.0.0.1', 0))
+  unix = socket.socket(socket.AF_UNIX)
+  unix.bind(str(tmp_path / 'remote.sock'))
+  yield [serve(tcp).getsockname(), serve(unix).getsockname()]
+  tcp.close()
+  unix.close()
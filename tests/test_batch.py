@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from remote_kernel import batch
+from remote_kernel.listing import SyncEntry
+from remote_kernel.transfer import TransferPool
+
+MTIME = 1600000000
+
+
+def write(path, data):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as out_fs:
+    out_fs.write(data)
+
+
+def read(path):
+  with open(path, 'rb') as in_fs:
+    return in_fs.read()
+
+
+def entry(path, size=1):
+  return SyncEntry(path, size, 0o100644, MTIME, MTIME)
+
+
+@pytest.fixture
+def files(tmp_path):
+  """
+  Local and remote folder, and the entries of the files in the local folder.
+  """
+  local, remote = str(tmp_path / 'local'), str(tmp_path / 'remote')
+  os.makedirs(remote)
+  entries = []
+  for path in ('a.txt', 'sub/b.txt', 'sub/with space.png', 'empty'):
+    data = path.encode('utf-8') * 100 if path != 'empty' else b''
+    write(os.path.join(local, path), data)
+    entries.append(entry(path, len(data)))
+  os.makedirs(os.path.join(remote, 'sub'))
+  return local, remote, entries
+
+
+def test_split_batches(monkeypatch):
+  monkeypatch.setattr(batch, 'MAX_BATCH_FILES', 2)
+  monkeypatch.setattr(batch, 'MAX_BATCH_BYTES', 100)
+  entries = [entry('a.txt', 10), entry('b.txt', 10), entry('c.txt', 10), entry('d.txt', 95), entry('e.jpg', 10)]
+  batches = [(compression, [e.path for e in group]) for compression, group in batch.split_batches(entries, 'gzip')]
+  # Files that are already compressed are batched without compression
+  assert batches == [('gzip', ['a.txt', 'b.txt']), ('gzip', ['c.txt']), ('gzip', ['d.txt']), (None, ['e.jpg'])]
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_put_and_get_batch(ssh_client, files, compression):
+  local, remote, entries = files
+  for e in entries:
+    os.utime(os.path.join(local, e.path), (MTIME, MTIME))
+  sent = []
+  assert batch.put_batch(ssh_client, local, remote, entries, compression, sent.append) == {e.path for e in entries}
+  assert sent == entries
+  for e in entries:
+    assert read(os.path.join(remote, e.path)) == read(os.path.join(local, e.path))
+    assert os.stat(os.path.join(remote, e.path)).st_mtime == MTIME
+
+  os.rename(local, local + '.sent')
+  os.makedirs(os.path.join(local, 'sub'))
+  # Only the requested files are retrieved
+  retrieved = batch.get_batch(ssh_client, remote, local, entries[1:], compression)
+  assert retrieved == {e.path for e in entries[1:]}
+  assert not os.path.exists(os.path.join(local, 'a.txt'))
+  for e in entries[1:]:
+    assert read(os.path.join(local, e.path)) == read(os.path.join(local + '.sent', e.path))
+    assert os.stat(os.path.join(local, e.path)).st_mtime == MTIME
+
+
+def test_get_batch_missing_file(ssh_client, files):
+  local, remote, entries = files
+  batch.put_batch(ssh_client, local, remote, entries)
+  os.remove(os.path.join(remote, 'a.txt'))
+  # tar fails on the missing file, but all other files are retrieved
+  assert batch.get_batch(ssh_client, remote, local, entries) == {e.path for e in entries[1:]}
+
+
+def test_batches_fall_back_without_tar(ssh_client, files, tmp_path, monkeypatch):
+  local, remote, entries = files
+  # The remote shell only searches an empty folder for commands
+  os.makedirs(str(tmp_path / 'bin'))
+  monkeypatch.setenv('PATH', str(tmp_path / 'bin'))
+  with pytest.raises(batch.RemoteTarError) as exc_info:
+    batch.put_batch(ssh_client, local, remote, entries)
+  assert exc_info.value.exit_status == batch.COMMAND_NOT_FOUND
+
+  sent = []
+  with TransferPool(ssh_client, channels=1) as pool:
+    pool.put_batch(local, remote, entries, 'gzip', sent.append)
+    pool.join()
+    assert not pool.batch_available
+  assert sorted(e.path for e in sent) == sorted(e.path for e in entries)
+  for e in entries:
+    assert read(os.path.join(remote, e.path)) == read(os.path.join(local, e.path))
+    assert os.stat(os.path.join(remote, e.path)).st_mtime == MTIME
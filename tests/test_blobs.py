@@ -0,0 +1,81 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from remote_kernel.dedup import BlobStore
+
+
+def write(path, data):
+  with open(path, 'wb') as out_fs:
+    out_fs.write(data)
+
+
+def read(path):
+  with open(path, 'rb') as in_fs:
+    return in_fs.read()
+
+
+@pytest.fixture
+def store(ssh_client, tmp_path):
+  return BlobStore(ssh_client, str(tmp_path / 'blobs'), sys.executable)
+
+
+def test_store_and_link(store, tmp_path):
+  first, second = str(tmp_path / 'first.txt'), str(tmp_path / 'second.txt')
+  write(first, b'shared')
+  blob = BlobStore.get_blob('sha256', 'abcdef')
+  assert blob == 'sha256/ab/abcdef'
+
+  # The blob is not stored yet, so the file is left as is to be uploaded
+  write(second, b'old')
+  assert store.run([('link', blob, second)]) == {second: ('missing', 0, 0.)}
+  assert read(second) == b'old'
+
+  results = store.run([('store', blob, first)])
+  assert results[first][:2] == ('stored', len(b'shared'))
+  assert os.path.samefile(first, os.path.join(store.folder, blob))
+  assert not os.stat(first).st_mode & 0o222
+
+  results = store.run([('link', blob, second)])
+  assert results[second] == ('linked', len(b'shared'), os.stat(first).st_mtime)
+  assert os.path.samefile(first, second)
+  assert read(second) == b'shared'
+  assert sorted(os.listdir(str(tmp_path))) == ['blobs', 'first.txt', 'second.txt']
+
+
+def test_store_existing_blob(store, tmp_path):
+  first, second = str(tmp_path / 'first.txt'), str(tmp_path / 'second.txt')
+  write(first, b'shared')
+  write(second, b'shared')
+  blob = BlobStore.get_blob('sha256', 'abcdef')
+  # The second file was uploaded concurrently, and is linked to the blob of the first one
+  store.run([('store', blob, first), ('store', blob, second)])
+  assert os.path.samefile(first, second)
+
+
+def test_unshare(store, tmp_path):
+  linked, stored, private = str(tmp_path / 'linked.txt'), str(tmp_path / 'stored.txt'), str(tmp_path / 'private.txt')
+  write(stored, b'shared')
+  write(private, b'private')
+  blob = BlobStore.get_blob('sha256', 'abcdef')
+  store.run([('store', blob, stored), ('link', blob, linked)])
+  os.remove(os.path.join(store.folder, blob))
+
+  # Files that are or were linked to a blob are removed, so uploads do not modify the files of other kernels
+  results = store.run([('unshare', '', path) for path in (linked, stored, private)])
+  assert {path: result[0] for path, result in results.items()} == {linked: 'ok', stored: 'ok', private: 'ok'}
+  assert not os.path.exists(linked) and not os.path.exists(stored)
+  assert read(private) == b'private'
+  assert stat.S_IMODE(os.stat(private).st_mode) & stat.S_IWUSR
+
+
+def test_failed_request(store, tmp_path, caplog):
+  missing, other = str(tmp_path / 'missing.txt'), str(tmp_path / 'other.txt')
+  write(other, b'other')
+  results = store.run([('store', BlobStore.get_blob('sha256', 'abcdef'), missing),
+                       ('store', BlobStore.get_blob('sha256', '012345'), other)])
+  assert results[missing][0] == 'error'
+  assert results[other][0] == 'stored'
+  assert 'missing.txt' in caplog.text
@@ -0,0 +1,87 @@
+import socket
+import threading
+
+import paramiko
+import pytest
+
+from remote_kernel import broker
+from remote_kernel.forward import open_streamlocal_channel
+
+
+@pytest.fixture
+def broker_transport(ssh_client, tmp_path, monkeypatch):
+  """
+  Client transport connected to a ConnectionBroker, which relays its channels over ``ssh_client``.
+  """
+  monkeypatch.setattr(broker, 'get_socket_path', lambda *args: str(tmp_path / 'broker.sock'))
+  connection_broker = broker.ConnectionBroker('user@127.0.0.1')
+  ssh_client.username, ssh_client.host, ssh_client.port = 'user', '127.0.0.1', 22
+  connection_broker.ssh_client = ssh_client
+  connection_broker._host_key = paramiko.ECDSAKey.generate()
+  connection_broker._clients = 1
+
+  sock, broker_sock = socket.socketpair()
+  handler = threading.Thread(target=connection_broker._handle, args=(broker_sock,), daemon=True)
+  handler.start()
+  # Same as ParamikoClient.connect_broker
+  assert broker._read_header(sock) == dict(username='user', host='127.0.0.1', port=22, pid=broker.os.getpid())
+  transport = paramiko.Transport(sock)
+  transport.start_client()
+  transport.auth_none('user')
+  yield transport
+
+  transport.close()
+  handler.join(10.)
+  # The broker is idle once its last client disconnected
+  assert connection_broker._clients == 0
+
+
+def read_all(channel, recv):
+  data = b''
+  for chunk in iter(lambda: recv(65536), b''):
+    data += chunk
+  return data
+
+
+def test_exec(broker_transport):
+  channel = broker_transport.open_session()
+  channel.exec_command('cat; echo error >&2; exit 3')
+  channel.sendall(b'input')
+  channel.shutdown_write()
+  assert read_all(channel, channel.recv) == b'input'
+  assert read_all(channel, channel.recv_stderr) == b'error\n'
+  assert channel.recv_exit_status() == 3
+
+
+def test_sftp(broker_transport, tmp_path):
+  (tmp_path / 'file.txt').write_text('data')
+  sftp_client = paramiko.SFTPClient.from_transport(broker_transport)
+  with sftp_client.open(str(tmp_path / 'file.txt')) as remote_fs:
+    assert remote_fs.read() == b'data'
+  sftp_client.close()
+
+
+def test_forwarded_connections(broker_transport, echo_servers):
+  tcp_address, unix_address = echo_servers
+  channels = [broker_transport.open_channel('direct-tcpip', tcp_address, ('127.0.0.1', 0)),
+              open_streamlocal_channel(broker_transport, unix_address)]
+  for channel in channels:
+    channel.sendall(b'ping' * 100000)
+    channel.shutdown_write()
+    assert read_all(channel, channel.recv) == b'ping' * 100000
+    channel.close()
+
+
+def test_forward_unavailable(broker_transport, tmp_path):
+  # The stand-in server accepts the channel and then closes it, which fails the open if it is closed before the reply
+  # reaches the client
+  try:
+    channel = open_streamlocal_channel(broker_transport, str(tmp_path / 'missing.sock'))
+  except paramiko.SSHException:
+    pass
+  else:
+    assert channel.recv(1) == b''
+  # The connection is still usable
+  channel = broker_transport.open_session()
+  channel.exec_command('echo ok')
+  assert read_all(channel, channel.recv) == b'ok\n'
@@ -0,0 +1,91 @@
+import io
+import random
+import zlib
+
+import pytest
+
+from remote_kernel.helpers.delta import apply_delta, get_block_size, read_signature, write_delta, write_signature
+
+
+def transfer(basis, new):
+  """
+  Run the delta transfer of ``new`` against ``basis``, returning the number of literal bytes and the rebuilt file.
+  """
+  sig_fs = io.BytesIO()
+  write_signature(io.BytesIO(basis), sig_fs, len(basis))
+  sig_fs.seek(0)
+  signature = read_signature(sig_fs)
+  delta_fs = io.BytesIO()
+  literal_bytes, _ = write_delta(io.BytesIO(new), signature, delta_fs)
+  delta_fs.seek(0)
+  out_fs = io.BytesIO()
+  assert apply_delta(delta_fs, io.BytesIO(basis), signature.block_size, out_fs) == literal_bytes
+  return literal_bytes, out_fs.getvalue()
+
+
+@pytest.fixture
+def basis():
+  # Not a multiple of the block size, so the last block is shorter
+  random_state = random.Random(0)
+  return bytes(random_state.getrandbits(8) for _ in range(20 * 2048 + 123))
+
+
+def test_identical(basis):
+  assert transfer(basis, basis) == (0, basis)
+
+
+def test_shifted_blocks_found_by_rolling_checksum(basis):
+  block_size = get_block_size(len(basis))
+  new = basis[:5000] + b'inserted' + basis[5000:]
+  literal_bytes, rebuilt = transfer(basis, new)
+  assert rebuilt == new
+  # Only the block containing the insertion, and the inserted bytes
+  assert literal_bytes <= block_size + len(b'inserted')
+
+
+def test_rolling_checksum_matches_adler32(basis):
+  # A block at an offset that is not aligned with the blocks of the new file is found by the rolling checksum only
+  block_size = get_block_size(len(basis))
+  new = b'x' * 3 + basis[block_size:2 * block_size] + b'y' * (block_size - 3)
+  literal_bytes, rebuilt = transfer(basis, new)
+  assert rebuilt == new
+  assert literal_bytes == len(new) - block_size
+
+
+def test_modified_tail_block(basis):
+  new = basis[:-50] + b'z' * 50
+  literal_bytes, rebuilt = transfer(basis, new)
+  assert rebuilt == new
+  assert 50 <= literal_bytes <= 123
+
+
+def test_appended(basis):
+  new = basis + b'appended'
+  assert transfer(basis, new)[1] == new
+
+
+def test_empty_target(basis):
+  assert transfer(basis, b'') == (0, b'')
+
+
+def test_empty_basis():
+  assert transfer(b'', b'new data') == (len(b'new data'), b'new data')
+
+
+def test_corrupt_basis(basis):
+  sig_fs = io.BytesIO()
+  write_signature(io.BytesIO(basis), sig_fs, len(basis))
+  sig_fs.seek(0)
+  signature = read_signature(sig_fs)
+  delta_fs = io.BytesIO()
+  write_delta(io.BytesIO(basis), signature, delta_fs)
+  delta_fs.seek(0)
+  with pytest.raises(ValueError):
+    apply_delta(delta_fs, io.BytesIO(b'\0' * len(basis)), signature.block_size, io.BytesIO())
+
+
+def test_weak_checksum_is_adler32():
+  sig_fs = io.BytesIO()
+  write_signature(io.BytesIO(b'abc'), sig_fs, 3)
+  sig_fs.seek(0)
+  assert read_signature(sig_fs).lookup == {zlib.adler32(b'abc'): [0]}
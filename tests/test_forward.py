@@ -0,0 +1,70 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from remote_kernel.forward import PortForwarder
+
+
+@pytest.fixture
+def forwarder(ssh_client, echo_servers, tmp_path):
+  forwarder = PortForwarder(ssh_client.get_transport(), [('127.0.0.1', 0), str(tmp_path / 'local.sock')],
+                            echo_servers).start()
+  yield forwarder
+  forwarder.close()
+
+
+def connect(forwarder, index):
+  address = forwarder.local_bind_addresses[index]
+  if isinstance(address, str):
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(address)
+  else:
+    sock = socket.create_connection(('127.0.0.1', forwarder.local_bind_ports[0]))
+  sock.settimeout(10.)
+  return sock
+
+
+def round_trip(sock, data):
+  sender = threading.Thread(target=lambda: (sock.sendall(data), sock.shutdown(socket.SHUT_WR)), daemon=True)
+  sender.start()
+  received = bytearray()
+  for chunk in iter(lambda: sock.recv(1 << 16), b''):
+    received += chunk
+  sender.join()
+  return bytes(received)
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_round_trip(forwarder, index):
+  with connect(forwarder, index) as sock:
+    sock.sendall(b'ping')
+    assert sock.recv(4) == b'ping'
+    # More data than the SSH window and the buffer of the forwarder, followed by EOF in both directions
+    data = os.urandom(3 << 20)
+    assert round_trip(sock, b'ping' + data) == b'ping' + data
+
+
+def test_concurrent_connections(forwarder):
+  socks = [connect(forwarder, i % 2) for i in range(8)]
+  for i, sock in enumerate(socks):
+    sock.sendall(b'%i' % i)
+  for i, sock in enumerate(socks):
+    assert sock.recv(16) == b'%i' % i
+    sock.close()
+
+
+def test_local_unix_socket_is_private(forwarder, tmp_path):
+  assert os.stat(str(tmp_path / 'local.sock')).st_mode & 0o777 == 0o600
+  forwarder.close()
+  assert not os.path.exists(str(tmp_path / 'local.sock'))
+
+
+def test_remote_address_unavailable(ssh_client, tmp_path):
+  forwarder = PortForwarder(ssh_client.get_transport(), [('127.0.0.1', 0)], [str(tmp_path / 'missing.sock')]).start()
+  try:
+    with connect(forwarder, 0) as sock:
+      assert sock.recv(1) == b''
+  finally:
+    forwarder.close()
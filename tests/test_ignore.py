@@ -0,0 +1,105 @@
+import os
+import shlex
+import subprocess
+import sys
+
+import pytest
+
+from remote_kernel import get_parser
+from remote_kernel.ignore import SyncIgnore
+from remote_kernel.listing import SyncEntry
+
+
+def test_comments_and_blank_lines():
+  assert len(SyncIgnore(['# comment', '', '  ', '*.pyc\n'])) == 1
+
+
+def test_unanchored_matches_at_any_level():
+  ignore = SyncIgnore(['*.ckpt', '__pycache__'])
+  assert ignore.matches('model.ckpt')
+  assert ignore.matches('runs/1/model.ckpt')
+  assert ignore.matches('src/__pycache__', is_dir=True)
+  assert not ignore.matches('model.ckpt.txt')
+
+
+def test_anchored():
+  ignore = SyncIgnore(['/data', 'logs/*.txt'])
+  assert ignore.matches('data', is_dir=True)
+  assert not ignore.matches('src/data', is_dir=True)
+  assert ignore.matches('logs/run.txt')
+  assert not ignore.matches('logs/sub/run.txt')
+  assert not ignore.matches('src/logs/run.txt')
+
+
+def test_directory_only():
+  ignore = SyncIgnore(['wandb/'])
+  assert ignore.matches('wandb', is_dir=True)
+  assert ignore.matches('src/wandb', is_dir=True)
+  assert not ignore.matches('wandb')
+
+
+@pytest.mark.parametrize('path, excluded', [
+  ('out', False),
+  ('out/a.bin', True),
+  ('out/sub/a.bin', True),
+  ('a/b/c/cache', True),
+  ('cache', True),
+  ('src/cache.py', False),
+])
+def test_double_star(path, excluded):
+  ignore = SyncIgnore(['out/**', '**/cache'])
+  assert ignore.matches(path) == excluded
+
+
+def test_negation():
+  ignore = SyncIgnore(['*.log', '!keep.log', 'logs/'])
+  assert ignore.matches('run.log')
+  assert not ignore.matches('keep.log')
+  assert not ignore.matches('sub/keep.log')
+  # The last matching rule wins
+  assert not SyncIgnore(['!keep.log', '*.log']).matches('other.txt')
+  assert SyncIgnore(['!keep.log', '*.log']).matches('keep.log')
+
+
+def test_command_line():
+  args = get_parser().parse_args(['-t', 'host', '--exclude', '*.ckpt', '--include', 'best.ckpt', '--exclude', 'logs/',
+                                  '--include', '!last.ckpt', '--include', '\\!bang.ckpt'])
+  assert args.sync_ignore == ['*.ckpt', '!best.ckpt', 'logs/', '!last.ckpt', '!\\!bang.ckpt']
+  ignore = SyncIgnore(args.sync_ignore)
+  assert ignore.matches('model.ckpt')
+  assert not ignore.matches('best.ckpt')
+  assert not ignore.matches('last.ckpt')
+  assert not ignore.matches('!bang.ckpt')
+  assert ignore.matches('logs', is_dir=True)
+  with pytest.raises(SystemExit):
+    get_parser().parse_args(['-t', 'host', '--include', '!'])
+
+
+def test_files_in_excluded_folders_are_not_included_again():
+  ignore = SyncIgnore(['logs/', '!logs/keep.log'])
+  assert not ignore.matches('logs/keep.log')
+  assert ignore.is_excluded('logs/keep.log')
+  entries = {path: SyncEntry(path, 0, 0o40755 if is_dir else 0o100644, 0, 0)
+             for path, is_dir in (('logs', True), ('logs/keep.log', False), ('src', True), ('src/a.py', False))}
+  assert sorted(ignore.filter_entries(entries)) == ['src', 'src/a.py']
+
+
+def test_find_prune():
+  ignore = SyncIgnore(['.git', 'wandb/', '/data/raw', 'logs/*.txt'])
+  # The rule with a wildcard in a path cannot be expressed in find syntax, it is applied by filter_entries
+  assert ignore.get_find_prune('/root dir') == (
+    r"\( \( -name .git \) -o \( -type d -name wandb \) -o \( -path '/root dir/data/raw' \) \) -prune -o")
+  assert SyncIgnore(['*.log', '!keep.log']).get_find_prune('/root') == ''
+  assert SyncIgnore([]).get_find_prune('/root') == ''
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='Requires GNU find')
+def test_find_prune_with_find(tmpdir):
+  root = str(tmpdir)
+  for path in ('.git/config', 'wandb/run', 'src/wandb', 'data/raw/a', 'data/b', 'src/a.py'):
+    os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+    open(os.path.join(root, path), 'w').close()
+  ignore = SyncIgnore(['.git', 'wandb/', '/data/raw'])
+  cmd = "find %s -mindepth 1 %s -printf '%%P\\n'" % (shlex.quote(root), ignore.get_find_prune(root))
+  output = subprocess.check_output(cmd, shell=True)
+  assert sorted(output.decode().split()) == ['data', 'data/b', 'src', 'src/a.py', 'src/wandb']
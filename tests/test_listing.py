@@ -0,0 +1,65 @@
+import io
+import logging
+
+import pytest
+
+from remote_kernel.listing import find_listing
+
+
+class FakeChannel(object):
+  def __init__(self, exit_status):
+    self.exit_status = exit_status
+
+  def recv_exit_status(self):
+    return self.exit_status
+
+
+class FakeSSHClient(object):
+  """
+  Runs every command by returning ``stdout``, ``stderr`` and ``exit_status``.
+  """
+  def __init__(self, stdout, stderr=b'', exit_status=0):
+    self.result = (stdout, stderr, exit_status)
+    self.commands = []
+
+  def exec_command(self, cmd):
+    self.commands.append(cmd)
+    stdout, stderr, exit_status = self.result
+    stdout = io.BytesIO(stdout)
+    stdout.channel = FakeChannel(exit_status)
+    return io.BytesIO(), stdout, io.BytesIO(stderr)
+
+
+FIND_OUTPUT = (b'1700000000\n'
+               b'd 4096 755 1690000000.0 1690000000.0 data\0'
+               b'f 12 644 1690000001.5 1690000001.5 data/a file.txt\0'
+               b'd 4096 700 1690000000.0 1690000000.0 private\0')
+
+
+def test_find_listing():
+  entries, remote_time = find_listing(FakeSSHClient(FIND_OUTPUT), '/remote')
+  assert remote_time == 1700000000
+  assert sorted(entries) == ['data', 'data/a file.txt', 'private']
+  assert entries['data/a file.txt'].st_size == 12
+  assert entries['data/a file.txt'].st_mtime == 1690000001.5
+
+
+def test_find_listing_incomplete(caplog):
+  # find fails if a folder cannot be read, but still lists all other entries
+  ssh_client = FakeSSHClient(FIND_OUTPUT, b"find: '/remote/private': Permission denied\n", 1)
+  with caplog.at_level(logging.WARNING, 'remote_kernel.listing'):
+    entries, remote_time = find_listing(ssh_client, '/remote')
+  assert sorted(entries) == ['data', 'data/a file.txt', 'private']
+  # The next listing should be complete, rather than only listing the changes since this listing
+  assert remote_time is None
+  assert 'Permission denied' in caplog.text
+
+
+@pytest.mark.parametrize('stdout, stderr, exit_status', [
+  (b'1700000000\n', b'find: -printf: unknown primary or operator\n', 1),
+  (b'1700000000\n' + FIND_OUTPUT.split(b'\n', 1)[1], b'find: unrecognized: -printf\n', 1),
+  (b'', b'sh: find: not found\n', 127),
+])
+def test_find_listing_not_available(stdout, stderr, exit_status):
+  with pytest.raises(IOError):
+    find_listing(FakeSSHClient(stdout, stderr, exit_status), '/remote')
@@ -0,0 +1,82 @@
+import os
+import time
+
+from remote_kernel import sync as sync_module
+from remote_kernel.listing import SyncEntry
+from remote_kernel.manifest import SyncManifest
+
+from test_sync import make_sync, write
+
+
+def entry(path, size, mtime):
+  return SyncEntry(path, size, 0o100644, mtime, mtime)
+
+
+def test_save_and_load(tmp_path):
+  fname = str(tmp_path / 'manifest.json')
+  manifest = SyncManifest(fname)
+  manifest.update('a.txt', entry('a.txt', 1, 10.), entry('a.txt', 1, 10.), 'hash')
+  manifest.remote_time = 1700000000
+  manifest.save()
+
+  loaded = SyncManifest.load(fname)
+  assert loaded.remote_time == 1700000000
+  assert loaded.is_unchanged('a.txt', entry('a.txt', 1, 10.), entry('a.txt', 1, 10.))
+  assert not loaded.is_unchanged('a.txt', entry('a.txt', 1, 10.), entry('a.txt', 2, 11.))
+  assert not loaded.is_unchanged('b.txt', entry('b.txt', 1, 10.), entry('b.txt', 1, 10.))
+  assert loaded.get_hash('a.txt', entry('a.txt', 1, 10.)) == 'hash'
+  assert os.listdir(str(tmp_path)) == ['manifest.json']
+
+
+def test_load_corrupt(tmp_path):
+  fname = str(tmp_path / 'manifest.json')
+  with open(fname, 'w') as manifest_fs:
+    manifest_fs.write('{"version": 1, "files": {')
+  manifest = SyncManifest.load(fname)
+  assert manifest.files == {} and manifest.remote_time is None
+
+
+def test_prune():
+  manifest = SyncManifest()
+  for path in ('a.txt', 'b.txt'):
+    manifest.update(path, entry(path, 1, 10.), entry(path, 1, 10.))
+  manifest.prune(['a.txt'])
+  assert list(manifest.files) == ['a.txt']
+
+
+def test_incremental_listing(ssh_client, tmp_path, monkeypatch):
+  # Record the arguments of the remote listings
+  listings, checked = [], []
+  find_listing, find_paths_listing = sync_module.find_listing, sync_module.find_paths_listing
+
+  def record_listing(ssh_client, root, recursive, since, ignore):
+    listings.append(since)
+    return find_listing(ssh_client, root, recursive, since, ignore)
+
+  def record_paths_listing(ssh_client, root, paths):
+    checked.extend(paths)
+    return find_paths_listing(ssh_client, root, paths)
+
+  monkeypatch.setattr(sync_module, 'find_listing', record_listing)
+  monkeypatch.setattr(sync_module, 'find_paths_listing', record_paths_listing)
+
+  with make_sync(ssh_client, tmp_path) as sync:
+    remote = sync.remote_folder
+    for path in ('root.txt', 'data/a.txt', 'data/b.txt', 'other/c.txt'):
+      write(os.path.join(remote, path), path)
+    sync.sync()
+    assert listings == [None]
+    assert sync.manifest.remote_time is not None
+
+    # Pretend the files were synchronized long before they changed, so the next listing only returns the folders
+    since = time.time() + 1000
+    sync.manifest.remote_time = since
+    os.remove(os.path.join(remote, 'data', 'b.txt'))
+    os.utime(os.path.join(remote, 'data'), (since + 10, since + 10))
+    entries, remote_time = sync._list_remote()
+
+  assert listings[1] == since - 2
+  # Only the files in the root folder and in the modified folder are checked
+  assert sorted(checked) == ['data/a.txt', 'data/b.txt', 'root.txt']
+  assert sorted(entries) == ['data', 'data/a.txt', 'other', 'other/c.txt', 'root.txt']
+  assert entries['other/c.txt'].st_size == len('other/c.txt')
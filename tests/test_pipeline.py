@@ -0,0 +1,101 @@
+import os
+import random
+
+import pytest
+
+from remote_kernel import pipeline
+from remote_kernel.listing import SyncEntry
+from remote_kernel.pipeline import PipelinedTransfer, split_groups
+
+TIMES = (1500000000, 1600000000)
+
+
+def write(path, data):
+  with open(path, 'wb') as out_fs:
+    out_fs.write(data)
+
+
+def read(path):
+  with open(path, 'rb') as in_fs:
+    return in_fs.read()
+
+
+@pytest.fixture
+def sftp_client(ssh_client):
+  sftp_client = ssh_client.open_sftp()
+  yield sftp_client
+  sftp_client.close()
+
+
+@pytest.fixture
+def files(tmp_path):
+  """
+  Local and remote folder, and the contents of the files in the local folder, which span zero to several requests.
+  """
+  local, remote = tmp_path / 'local', tmp_path / 'remote'
+  local.mkdir()
+  remote.mkdir()
+  random_state = random.Random(0)
+  contents = {}
+  for i, size in enumerate((0, 1, pipeline.REQUEST_SIZE, 3 * pipeline.REQUEST_SIZE + 5, 1000)):
+    contents['file%i' % i] = bytes(random_state.getrandbits(8) for _ in range(size))
+    write(str(local / ('file%i' % i)), contents['file%i' % i])
+  return str(local), str(remote), contents
+
+
+def test_split_groups(monkeypatch):
+  monkeypatch.setattr(pipeline, 'MAX_GROUP_FILES', 2)
+  monkeypatch.setattr(pipeline, 'MAX_GROUP_BYTES', 100)
+  entries = [SyncEntry(path, size, 0o100644, 0., 0.) for path, size in (('a', 10), ('b', 10), ('c', 95), ('d', 1))]
+  assert [[entry.path for entry in group] for group in split_groups(entries)] == [['a', 'b'], ['c', 'd']]
+
+
+@pytest.mark.parametrize('window', [1, 3, 64])
+def test_put_and_get(sftp_client, files, window):
+  local, remote, contents = files
+  transfer = PipelinedTransfer(sftp_client, window)
+  uploaded = []
+  for fname in contents:
+    transfer.put(os.path.join(local, fname), '/'.join((remote, fname)), TIMES, lambda f=fname: uploaded.append(f))
+  round_trips, failed = transfer.run()
+  assert failed == [] and sorted(uploaded) == sorted(contents)
+  # Two round trips per file: open, then the pipelined writes, times and close
+  assert round_trips == 2 * len(contents)
+  for fname, data in contents.items():
+    assert read(os.path.join(remote, fname)) == data
+    assert os.stat(os.path.join(remote, fname)).st_mtime == TIMES[1]
+
+  transfer = PipelinedTransfer(sftp_client, window)
+  for fname, data in contents.items():
+    transfer.get('/'.join((remote, fname)), os.path.join(local, fname + '.copy'), len(data), TIMES)
+  round_trips, failed = transfer.run()
+  assert failed == []
+  for fname, data in contents.items():
+    assert read(os.path.join(local, fname + '.copy')) == data
+    assert os.stat(os.path.join(local, fname + '.copy')).st_mtime == TIMES[1]
+
+
+def test_get_changed_size(sftp_client, files):
+  local, remote, contents = files
+  for fname, data in contents.items():
+    write(os.path.join(remote, fname), data)
+  transfer = PipelinedTransfer(sftp_client, 8)
+  # The remote files were truncated or extended since they were listed
+  transfer.get('/'.join((remote, 'file3')), os.path.join(local, 'truncated'), len(contents['file3']) + 100)
+  transfer.get('/'.join((remote, 'file3')), os.path.join(local, 'extended'), 10)
+  assert transfer.run()[1] == []
+  assert read(os.path.join(local, 'truncated')) == contents['file3']
+  assert read(os.path.join(local, 'extended')) == contents['file3'][:10]
+
+
+def test_failed_files_are_skipped(sftp_client, files):
+  local, remote, contents = files
+  transfer = PipelinedTransfer(sftp_client, 4)
+  transfer.put(os.path.join(local, 'missing'), '/'.join((remote, 'missing')))
+  transfer.put(os.path.join(local, 'file1'), '/'.join((remote, 'missing', 'file1')))
+  transfer.get('/'.join((remote, 'missing')), os.path.join(local, 'missing.copy'), 10)
+  transfer.put(os.path.join(local, 'file3'), '/'.join((remote, 'file3')))
+  round_trips, failed = transfer.run()
+  assert failed == [os.path.join(local, 'missing'), os.path.join(local, 'file1'), os.path.join(local, 'missing.copy')]
+  assert round_trips == 2
+  assert read(os.path.join(remote, 'file3')) == contents['file3']
@@ -0,0 +1,55 @@
+import pytest
+
+from remote_kernel.listing import SyncEntry
+from remote_kernel.plan import SyncPlan
+
+
+def make_plan(files, size):
+  """
+  Plan pulling ``files`` files of ``size`` bytes each, along with actions that transfer nothing.
+  """
+  plan = SyncPlan()
+  plan.add('mkdir', 'folder', SyncEntry('folder', 0, 0o40755, 0, 0))
+  for i in range(files):
+    plan.add('pull', 'folder/%i' % i, remote_entry=SyncEntry('folder/%i' % i, size, 0o100644, 0, 0), method='sftp')
+  plan.add('skip', 'other', reason='unchanged')
+  return plan
+
+
+def test_no_samples():
+  assert make_plan(10, 100).estimate_duration([]) is None
+  # Synchronizations that did not transfer anything are not measurements
+  assert make_plan(10, 100).estimate_duration([[0, 0, 1.], [5, 100, 0.]]) is None
+
+
+def test_one_sample():
+  # The costs per file and per byte cannot be separated, so the average throughput is used
+  assert make_plan(5, 100).estimate_duration([[10, 1000, 2.]]) == pytest.approx(1.)
+  assert make_plan(20, 100).estimate_duration([[10, 1000, 2.]]) == pytest.approx(4.)
+  assert make_plan(5, 0).estimate_duration([[10, 0, 2.]]) == pytest.approx(1.)
+
+
+def test_samples_fitted():
+  per_file, per_byte = 0.05, 1e-6
+  throughput = [[files, size, per_file * files + per_byte * size]
+                for files, size in ((10, 10 << 20), (1000, 1 << 20), (100, 100 << 20))]
+  plan = make_plan(50, 1 << 20)
+  assert len(plan.transfers) == 50
+  assert plan.estimate_duration(throughput) == pytest.approx(per_file * 50 + per_byte * 50 * (1 << 20))
+
+
+def test_samples_not_separable():
+  # All synchronizations transferred files of the same size
+  throughput = [[10, 1000, 1.], [20, 2000, 2.], [40, 4000, 4.]]
+  assert make_plan(7, 100).estimate_duration(throughput) == pytest.approx(0.7)
+
+
+def test_negative_costs_fall_back_to_average():
+  # The fit has a negative cost per byte, which is not physical
+  throughput = [[10, 1000, 2.], [10, 100000, 1.]]
+  estimate = make_plan(10, 1000).estimate_duration(throughput)
+  assert estimate == pytest.approx(3. * (10 / 20 + 10000 / 101000) / 2)
+
+
+def test_empty_plan():
+  assert SyncPlan().estimate_duration([[10, 1000, 2.]]) == 0
@@ -0,0 +1,263 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from remote_kernel.helpers import relay as relay_module
+from remote_kernel.helpers.relay import ACK, DATA, EOF, HEADER, OPEN, WINDOW, ZDATA, Relay, get_codecs
+
+
+class SocketLink(object):
+  """
+  Link over a socket, receiving at most ``chunk`` bytes at once. Like the link over an SSH channel, sending is polled.
+  """
+  def __init__(self, sock, chunk=None):
+    sock.setblocking(False)
+    self.sock = sock
+    self.chunk = chunk
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def send_fileno(self):
+    return None
+
+  def recv(self, size):
+    try:
+      return self.sock.recv(min(size, self.chunk or size))
+    except BlockingIOError:
+      return None
+
+  def send(self, data):
+    try:
+      return self.sock.send(data)
+    except BlockingIOError:
+      return 0
+
+
+class Peer(object):
+  """
+  Other side of the link of a relay, which sends and receives raw frames.
+  """
+  def __init__(self, sock):
+    sock.setblocking(False)
+    self.sock = sock
+    self.received = bytearray()
+    self.frames = []
+
+  def read(self):
+    while True:
+      try:
+        data = self.sock.recv(1 << 16)
+      except BlockingIOError:
+        break
+      if not data:
+        break
+      self.received += data
+    while len(self.received) >= HEADER.size:
+      kind, stream_id, length = HEADER.unpack_from(self.received)
+      size = HEADER.size + (length if kind in (DATA, ZDATA) else 0)
+      if len(self.received) < size:
+        break
+      self.frames.append((kind, stream_id, length, bytes(self.received[HEADER.size:size])))
+      del self.received[:size]
+
+  def data_size(self):
+    return sum(length for kind, _, length, _ in self.frames if kind == DATA)
+
+
+def run(relays, condition, peer=None, timeout=5.):
+  """
+  Run the relays until ``condition()`` is true, failing after ``timeout`` seconds.
+  """
+  deadline = time.time() + timeout
+  while not condition():
+    assert time.time() < deadline, 'Timed out'
+    for relay in relays:
+      relay.run_once(0.005)
+    if peer is not None:
+      peer.read()
+
+
+def settle(relays, peer, iterations=20):
+  for _ in range(iterations):
+    for relay in relays:
+      relay.run_once(0.005)
+    peer.read()
+
+
+@pytest.fixture
+def server():
+  server = socket.socket()
+  server.bind(('127.0.0.1', 0))
+  server.listen(1)
+  yield server
+  server.close()
+
+
+def test_frames_split_across_reads(server):
+  link, peer_sock = socket.socketpair()
+  peer = Peer(peer_sock)
+  # Frames arrive one byte at a time, so headers and data are split over many reads
+  relay = Relay(SocketLink(link, chunk=1), [server.getsockname()])
+  peer_sock.sendall(HEADER.pack(OPEN, 7, 0) + HEADER.pack(DATA, 7, 5) + b'hello' + HEADER.pack(DATA, 7, 6) +
+                    b' world' + HEADER.pack(EOF, 7, 0))
+  run([relay], lambda: 7 in relay.streams and relay.streams[7].shutdown)
+  conn, _ = server.accept()
+  conn.settimeout(5.)
+  received = b''
+  while True:
+    data = conn.recv(1024)
+    if not data:
+      break
+    received += data
+  assert received == b'hello world'
+
+  conn.sendall(b'reply')
+  conn.close()
+  run([relay], lambda: any(frame[0] == EOF for frame in peer.frames), peer)
+  assert peer.frames == [(DATA, 7, 5, b'reply'), (EOF, 7, 0, b'')]
+  # Both directions reached EOF, so the stream is closed
+  run([relay], lambda: 7 not in relay.streams)
+  relay.close()
+  peer_sock.close()
+
+
+def test_credit():
+  link, peer_sock = socket.socketpair()
+  peer = Peer(peer_sock)
+  relay = Relay(SocketLink(link))
+  client, conn = socket.socketpair()
+  relay.open_stream(conn, 2)
+  sender = threading.Thread(target=client.sendall, args=(bytes(3 * WINDOW),), daemon=True)
+  sender.start()
+
+  # Without acknowledgements, at most WINDOW bytes are sent
+  run([relay], lambda: peer.data_size() >= WINDOW, peer)
+  settle([relay], peer)
+  assert peer.frames[0] == (OPEN, 1, 2, b'')
+  assert peer.data_size() == WINDOW
+
+  peer_sock.sendall(HEADER.pack(ACK, 1, 1000))
+  run([relay], lambda: peer.data_size() >= WINDOW + 1000, peer)
+  settle([relay], peer)
+  assert peer.data_size() == WINDOW + 1000
+
+  peer_sock.sendall(HEADER.pack(ACK, 1, 2 * WINDOW))
+  run([relay], lambda: peer.data_size() >= 3 * WINDOW, peer)
+  sender.join(5.)
+  relay.close()
+  client.close()
+  peer_sock.close()
+
+
+def test_acknowledge_delivered():
+  link, peer_sock = socket.socketpair()
+  peer = Peer(peer_sock)
+  relay = Relay(SocketLink(link))
+  client, conn = socket.socketpair()
+  client.setblocking(False)
+  relay.open_stream(conn, 0)
+  received = bytearray()
+
+  def deliver(size):
+    frames = bytearray()
+    for offset in range(0, size, 1000):
+      length = min(1000, size - offset)
+      frames += HEADER.pack(DATA, 1, length) + bytes(length)
+    target = len(received) + size
+    while len(received) < target:
+      if frames:
+        try:
+          del frames[:peer_sock.send(frames)]
+        except BlockingIOError:
+          pass
+      relay.run_once(0.005)
+      peer.read()
+      try:
+        received.extend(client.recv(1 << 16))
+      except BlockingIOError:
+        pass
+
+  deliver(WINDOW // 4 - 1)
+  settle([relay], peer)
+  assert [frame for frame in peer.frames if frame[0] == ACK] == []
+  deliver(1)
+  run([relay], lambda: any(frame[0] == ACK for frame in peer.frames), peer)
+  assert [frame for frame in peer.frames if frame[0] == ACK] == [(ACK, 1, WINDOW // 4, b'')]
+  relay.close()
+  client.close()
+  peer_sock.close()
+
+
+@pytest.mark.parametrize('codec', get_codecs())
+def test_compressed_round_trip(server, codec):
+  local_link, remote_link = socket.socketpair()
+  local = Relay(SocketLink(local_link))
+  remote = Relay(SocketLink(remote_link), [server.getsockname()], compress=(0,), codec=codec, threshold=1024)
+  client, conn = socket.socketpair()
+  client.setblocking(False)
+  local.open_stream(conn, 0)
+  run([local, remote], lambda: 1 in remote.streams)
+  kernel, _ = server.accept()
+  kernel.setblocking(False)
+
+  def transfer(source, dest, data):
+    pending = bytearray(data)
+    received = bytearray()
+    deadline = time.time() + 5.
+    while len(received) < len(data):
+      assert time.time() < deadline, 'Timed out'
+      if pending:
+        try:
+          del pending[:source.send(pending)]
+        except BlockingIOError:
+          pass
+      local.run_once(0.005)
+      remote.run_once(0.005)
+      try:
+        received.extend(dest.recv(1 << 16))
+      except BlockingIOError:
+        pass
+    return bytes(received)
+
+  data = b'{"header": {"msg_type": "display_data"}, "data": "0123456789abcdef"}' * 4096
+  assert transfer(kernel, client, data) == data
+  assert 0 < remote.stats['compressed_bytes'] < remote.stats['raw_bytes'] // 4
+  # The other side decompressed the same chunks
+  assert local.stats['raw_bytes'] == remote.stats['raw_bytes']
+  assert local.stats['compressed_bytes'] == remote.stats['compressed_bytes']
+
+  raw_bytes = remote.stats['raw_bytes']
+  noise = os.urandom(64 << 10)
+  assert transfer(kernel, client, noise) == noise
+  assert remote.stats['raw_bytes'] == raw_bytes
+  assert remote.stats['incompressible_bytes'] > 0
+
+  # Data sent to the kernel is not compressed
+  assert transfer(client, kernel, data[:4096]) == data[:4096]
+  assert local.stats['raw_bytes'] == raw_bytes
+  local.close()
+  remote.close()
+  client.close()
+  kernel.close()
+
+
+
+@pytest.mark.skipif(not os.path.exists('/bin/bash'), reason='Requires bash')
+@pytest.mark.parametrize('compress', [[], ['--compress', 'zlib', '1024', '0']])
+def test_command_runs_in_user_shell(compress):
+  # Like sshd, the relay runs the command in the shell of the user, so bash-only pre-commands keep working
+  command = '[[ -n "$BASH_VERSION" ]] && exit 3'
+  relay = [sys.executable, relay_module.__file__] + compress + ['127.0.0.1:1', '--', command]
+  env = dict(os.environ, SHELL='/bin/bash')
+  process = subprocess.Popen(relay, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+  try:
+    assert process.wait(10.) == 3
+  finally:
+    process.stdin.close()
+    process.stdout.close()
@@ -0,0 +1,141 @@
+import os
+import random
+import sys
+
+import pytest
+
+from remote_kernel.helpers.delta import TMP_SUFFIX
+from remote_kernel.resume import CHECKPOINT_SUFFIX, Checkpoint, get_resumable, put_resumable
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def sftp_client(ssh_client):
+  sftp_client = ssh_client.open_sftp()
+  yield sftp_client
+  sftp_client.close()
+
+
+@pytest.fixture
+def data():
+  random_state = random.Random(0)
+  return bytes(random_state.getrandbits(8) for _ in range(5 * CHUNK_SIZE + 100))
+
+
+def write(path, data):
+  with open(path, 'wb') as out_fs:
+    out_fs.write(data)
+
+
+def read(path):
+  with open(path, 'rb') as in_fs:
+    return in_fs.read()
+
+
+def interrupt(fname, direction, source, data, chunks):
+  """
+  Save the checkpoint of a transfer of ``data`` that was interrupted after ``chunks`` chunks.
+  """
+  checkpoint = Checkpoint(fname, direction, source, CHUNK_SIZE)
+  checkpoint.chunks = [checkpoint.hash_chunk(data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]) for i in range(chunks)]
+  checkpoint.save()
+
+
+def interrupt_get(sftp_client, remote, local, data, chunks, part_size=None):
+  attr = sftp_client.stat(remote)
+  interrupt(local + CHECKPOINT_SUFFIX, 'get', [attr.st_size, attr.st_mtime], data, chunks)
+  write(local + TMP_SUFFIX, data[:chunks * CHUNK_SIZE if part_size is None else part_size])
+
+
+def get(sftp_client, ssh_client, remote, local):
+  return get_resumable(sftp_client, remote, local, CHUNK_SIZE, ssh_client, sys.executable)
+
+
+def test_get(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  assert get(sftp_client, ssh_client, remote, local) == 0
+  assert read(local) == data
+  assert sorted(os.listdir(str(tmp_path))) == ['local.bin', 'remote.bin']
+
+
+def test_get_resumed(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  # The interrupted chunk was partly written
+  interrupt_get(sftp_client, remote, local, data, 3, 3 * CHUNK_SIZE + 10)
+  assert get(sftp_client, ssh_client, remote, local) == 3 * CHUNK_SIZE
+  assert read(local) == data
+  assert sorted(os.listdir(str(tmp_path))) == ['local.bin', 'remote.bin']
+
+
+def test_get_truncated_part(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  # Chunks recorded in the checkpoint that are missing from the temporary file are transferred again
+  interrupt_get(sftp_client, remote, local, data, 3, 2 * CHUNK_SIZE + 10)
+  assert get(sftp_client, ssh_client, remote, local) == 2 * CHUNK_SIZE
+  assert read(local) == data
+
+
+def test_get_corrupt_part(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  interrupt_get(sftp_client, remote, local, data, 3)
+  with open(local + TMP_SUFFIX, 'r+b') as part_fs:
+    part_fs.seek(CHUNK_SIZE + 1)
+    part_fs.write(b'\xff' if data[CHUNK_SIZE + 1] != 0xff else b'\0')
+  assert get(sftp_client, ssh_client, remote, local) == CHUNK_SIZE
+  assert read(local) == data
+
+
+def test_get_source_rewritten_in_same_second(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  interrupt_get(sftp_client, remote, local, data, 3)
+  # Same size and modified time (SFTP reports whole seconds), but the second chunk changed
+  st = os.stat(remote)
+  new_data = data[:CHUNK_SIZE] + bytes(CHUNK_SIZE) + data[2 * CHUNK_SIZE:]
+  write(remote, new_data)
+  os.utime(remote, ns=(st.st_atime_ns, st.st_mtime_ns))
+  assert get(sftp_client, ssh_client, remote, local) == CHUNK_SIZE
+  assert read(local) == new_data
+
+
+def test_get_without_remote_verification(sftp_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  interrupt_get(sftp_client, remote, local, data, 3)
+  assert get_resumable(sftp_client, remote, local, CHUNK_SIZE) == 0
+  assert read(local) == data
+
+
+def test_get_source_changed(sftp_client, ssh_client, tmp_path, data):
+  remote, local = str(tmp_path / 'remote.bin'), str(tmp_path / 'local.bin')
+  write(remote, data)
+  interrupt_get(sftp_client, remote, local, data, 3)
+  write(remote, data[:-1])
+  assert get(sftp_client, ssh_client, remote, local) == 0
+  assert read(local) == data[:-1]
+
+
+def test_put_resumed(sftp_client, tmp_path, data):
+  local, remote = str(tmp_path / 'local.bin'), str(tmp_path / 'remote.bin')
+  write(local, data)
+  st = os.stat(local)
+  interrupt(local + CHECKPOINT_SUFFIX, 'put', [st.st_size, st.st_mtime_ns], data, 3)
+  write(remote + TMP_SUFFIX, data[:3 * CHUNK_SIZE + 10])
+  assert put_resumable(sftp_client, local, remote, CHUNK_SIZE) == 3 * CHUNK_SIZE
+  assert read(remote) == data
+  assert sorted(os.listdir(str(tmp_path))) == ['local.bin', 'remote.bin']
+
+
+def test_put_part_missing(sftp_client, tmp_path, data):
+  local, remote = str(tmp_path / 'local.bin'), str(tmp_path / 'remote.bin')
+  write(local, data)
+  st = os.stat(local)
+  interrupt(local + CHECKPOINT_SUFFIX, 'put', [st.st_size, st.st_mtime_ns], data, 3)
+  write(remote + TMP_SUFFIX, data[:2 * CHUNK_SIZE])
+  assert put_resumable(sftp_client, local, remote, CHUNK_SIZE) == 0
+  assert read(remote) == data
@@ -0,0 +1,49 @@
+import os
+import sys
+
+from remote_kernel.sync import ParamikoSync
+
+
+def make_sync(ssh_client, tmp_path, kernel_name='kernel', dry_run=False, **kwargs):
+  sync = ParamikoSync(ssh_client, local_folder=str(tmp_path / 'local'), remote_folder=str(tmp_path / 'remote'),
+                      remote_python=sys.executable, **kwargs)
+  sync.set_subfolder(kernel_name, dry_run)
+  return sync.connect(dry_run=dry_run)
+
+
+def write(path, data):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as out_fs:
+    out_fs.write(data)
+
+
+def test_dry_run_of_new_kernel(ssh_client, tmp_path):
+  with make_sync(ssh_client, tmp_path, dry_run=True) as sync:
+    assert len(sync.sync(dry_run=True).transfers) == 0
+  # Neither the sync folders nor the config file of the sub-folders are created
+  assert os.listdir(str(tmp_path)) == []
+
+  write(str(tmp_path / 'local' / 'a.txt'), 'a')
+  with make_sync(ssh_client, tmp_path, dry_run=True, bi_directional=True) as sync:
+    plan = sync.sync(dry_run=True)
+  assert [(action.action, action.path) for action in plan.actions] == [('push', 'a.txt')]
+  assert os.listdir(str(tmp_path / 'local')) == ['a.txt']
+  assert not os.path.exists(str(tmp_path / 'remote'))
+
+
+def test_dry_run_of_existing_kernel(ssh_client, tmp_path):
+  with make_sync(ssh_client, tmp_path) as sync:
+    sync.sync()
+  write(str(tmp_path / 'remote' / '1' / 'a.txt'), 'a')
+  local_files = sorted(os.listdir(str(tmp_path / 'local')))
+
+  with make_sync(ssh_client, tmp_path, dry_run=True) as sync:
+    plan = sync.sync(dry_run=True)
+  assert [action.path for action in plan.get('pull')] == ['a.txt']
+  assert sorted(os.listdir(str(tmp_path / 'local'))) == local_files
+  # A new kernel is assigned the next sub-folder, which is not created
+  with make_sync(ssh_client, tmp_path, 'other', dry_run=True) as sync:
+    assert sync.remote_folder == str(tmp_path / 'remote' / '2')
+    assert len(sync.sync(dry_run=True).transfers) == 0
+  assert os.listdir(str(tmp_path / 'remote')) == ['1']
+  assert sorted(os.listdir(str(tmp_path / 'local'))) == local_files
@@ -0,0 +1,83 @@
+import os
+import threading
+
+import pytest
+
+from remote_kernel.transfer import TransferPool
+
+TIMES = (1500000000, 1600000000)
+
+
+def write(path, data):
+  with open(path, 'wb') as out_fs:
+    out_fs.write(data)
+
+
+def read(path):
+  with open(path, 'rb') as in_fs:
+    return in_fs.read()
+
+
+@pytest.fixture
+def folders(tmp_path):
+  local, remote = tmp_path / 'local', tmp_path / 'remote'
+  local.mkdir()
+  remote.mkdir()
+  return str(local), str(remote)
+
+
+def test_put_and_get(ssh_client, folders):
+  local, remote = folders
+  for i in range(20):
+    write(os.path.join(local, 'file%i' % i), b'%i' % i * (i * 1000))
+
+  uploaded = []
+  with TransferPool(ssh_client, channels=3, queue_size=2) as pool:
+    for i in range(20):
+      pool.put(os.path.join(local, 'file%i' % i), '/'.join((remote, 'file%i' % i)), TIMES,
+               lambda i=i: uploaded.append(i))
+    pool.join()
+    assert sorted(uploaded) == list(range(20))
+    for i in range(20):
+      path = os.path.join(remote, 'file%i' % i)
+      assert read(path) == b'%i' % i * (i * 1000)
+      assert os.stat(path).st_mtime == TIMES[1]
+
+    for i in range(20):
+      os.remove(os.path.join(local, 'file%i' % i))
+      pool.get('/'.join((remote, 'file%i' % i)), os.path.join(local, 'file%i' % i), TIMES)
+    pool.join()
+  for i in range(20):
+    path = os.path.join(local, 'file%i' % i)
+    assert read(path) == b'%i' % i * (i * 1000)
+    assert os.stat(path).st_mtime == TIMES[1]
+  assert pool.stats['sftp_files'] == 40
+  assert not pool.is_running
+
+
+def test_transfers_run_concurrently(ssh_client):
+  started = threading.Barrier(3, timeout=10)
+  with TransferPool(ssh_client, channels=3) as pool:
+    for _ in range(3):
+      # Each transfer waits for the others to start, which only completes if they run on separate sessions
+      pool.submit(lambda sftp_client: started.wait())
+    pool.join()
+
+
+def test_join_raises_first_error(ssh_client, folders):
+  local, remote = folders
+  write(os.path.join(local, 'file'), b'data')
+  with TransferPool(ssh_client, channels=2) as pool:
+    pool.get('/'.join((remote, 'missing')), os.path.join(local, 'missing'))
+    pool.put(os.path.join(local, 'file'), '/'.join((remote, 'file')))
+    with pytest.raises(IOError):
+      pool.join()
+    # The other transfers still complete, and the errors are only raised once
+    assert read(os.path.join(remote, 'file')) == b'data'
+    pool.join()
+
+
+def test_submit_requires_running_pool(ssh_client):
+  pool = TransferPool(ssh_client)
+  with pytest.raises(ValueError):
+    pool.submit(lambda sftp_client: None)